@@ -1,10 +1,11 @@
-from numba import njit
+from numba import njit, prange, get_num_threads, set_num_threads
 import numpy as np
 import pandas as pd
 from typing import Literal
-from sklearn.cluster import DBSCAN
 
-@njit
+from ..utils.chmap import as_tpc_channel_map_tables
+
+@njit(cache=True)
 def frugal_pedestal( adcs, median_0 = 0, acc_0 = 0, limit=10):
     """_summary_
 
@@ -42,7 +43,58 @@ def frugal_pedestal( adcs, median_0 = 0, acc_0 = 0, limit=10):
     # A somewhat trivial example
     return peds
 
-@njit
+@njit(parallel=True, cache=True)
+def frugal_pedestal_2d(adcs, median_0, acc_0, limit=10, block_size=64):
+    """Frugal pedestal of all the channels of a (time x channel) ADC matrix
+
+    Channels are processed in blocks of `block_size`, in parallel.
+    Within a block the matrix is scanned row by row, following its memory layout.
+
+    Args:
+        adcs (np.array): ADC matrix (time x channel)
+        median_0 (np.array): initial median, per channel
+        acc_0 (np.array): initial accumulator, per channel
+        limit (int, optional): accumulator limit. Defaults to 10.
+        block_size (int, optional): number of channels per block. Defaults to 64.
+
+    Returns:
+        tuple: pedestals (time x channel, int16), final medians and final accumulators (per channel, int32)
+    """
+    n_samples, n_chans = adcs.shape
+    peds = np.empty((n_samples, n_chans), dtype=np.int16)
+    medians = np.empty(n_chans, dtype=np.int32)
+    accs = np.empty(n_chans, dtype=np.int32)
+
+    n_blocks = (n_chans + block_size - 1)//block_size
+    for b in prange(n_blocks):
+        c0 = b*block_size
+        c1 = min(c0+block_size, n_chans)
+        median = median_0[c0:c1].astype(np.int32)
+        acc = acc_0[c0:c1].astype(np.int32)
+
+        for i in range(n_samples):
+            for k in range(c1-c0):
+                adc = adcs[i, c0+k]
+                m = median[k]
+                if adc > m:
+                    acc[k] += 1
+                elif adc < m:
+                    acc[k] -= 1
+
+                if acc[k] == limit:
+                    acc[k] = 0
+                    median[k] = m+1
+                elif acc[k] == -limit:
+                    acc[k] = 0
+                    median[k] = m-1
+                peds[i, c0+k] = median[k]
+
+        medians[c0:c1] = median
+        accs[c0:c1] = acc
+
+    return peds, medians, accs
+
+@njit(cache=True)
 def running_sum(adcs, r=1):
 
     rs_adcs = np.zeros_like(adcs)
@@ -54,7 +106,7 @@ def running_sum(adcs, r=1):
 
 from numba.types import List,Tuple,int64,uint16,int16,int32
 
-@njit('Tuple((int64,uint64[:],uint64[:],uint16[:],uint16[:],uint32[:]))(int64[:],int16[:],int64)')
+@njit(cache=True)
 def find_hits(ts: np.array, adcs: np.array, threshold=100):
     """Find his on a waveform by applying a threshold
 
@@ -123,23 +175,199 @@ def find_hits(ts: np.array, adcs: np.array, threshold=100):
     return (num_hits, v_time_start[:num_hits], v_time_peak[:num_hits], v_time_over_threshold[:num_hits], v_adc_peak[:num_hits], v_adc_integral[:num_hits])
     
 
-InitialPedestalEstimatorAlgo = Literal["mode", "mean"]
+@njit(parallel=True, cache=True)
+def find_hits_2d(ts, adcs, thresholds, block_cap, o_chan, o_thr, o_start, o_peak_time, o_tot, o_peak, o_integral, block_size=64):
+    """Find the hits of all the channels of a (time x channel) ADC matrix for several thresholds,
+    in a single scan and in parallel over blocks of channels
 
-def emulate_ped(df_rawadc: pd.DataFrame, limit: int=10, init_ped_algo: InitialPedestalEstimatorAlgo='mode', init_ped_range: int = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+    Hits are counted per (channel, threshold). Each block of channels stores its hits, in time order,
+    in its own region of the output arrays, starting at block*block_cap: the hits beyond block_cap
+    are counted but not stored (see `find_hits_all` for the handling of the overflowing blocks).
+    Hits still open at the end of the matrix are dropped, as in `find_hits`.
+
+    Args:
+        ts (np.array): timestamps (time)
+        adcs (np.array): pedestal subtracted ADC matrix (time x channel)
+        thresholds (np.array): hit thresholds
+        block_cap (int): number of hits stored per block of channels
+        o_chan, o_thr, o_start, o_peak_time, o_tot, o_peak, o_integral (np.array): hits output arrays
+        block_size (int, optional): number of channels per block. Defaults to 64.
+
+    Returns:
+        np.array: number of hits, per (channel, threshold)
+    """
+    n_samples, n_chans = adcs.shape
+    n_thr = len(thresholds)
+    counts = np.zeros((n_chans, n_thr), dtype=np.int64)
+    min_thr = thresholds.min() if n_thr else 0
+
+    n_blocks = (n_chans + block_size - 1)//block_size
+    for b in prange(n_blocks):
+        c0 = b*block_size
+        c1 = min(c0+block_size, n_chans)
+        n_block = 0
+        n_open = np.zeros(c1-c0, dtype=np.int64)
+        in_hit = np.zeros((c1-c0, n_thr), dtype=np.bool_)
+        h_start = np.zeros((c1-c0, n_thr), dtype=np.int64)
+        h_peak_time = np.zeros((c1-c0, n_thr), dtype=np.int64)
+        h_peak = np.zeros((c1-c0, n_thr), dtype=np.int64)
+        h_integral = np.zeros((c1-c0, n_thr), dtype=np.int64)
+
+        for i in range(n_samples):
+            t = np.int64(ts[i])
+            for k in range(c1-c0):
+                adc = np.int64(adcs[i, c0+k])
+                # Nothing to do below all thresholds when no hit is open
+                if n_open[k] == 0 and adc < min_thr:
+                    continue
+
+                c = c0+k
+                for h in range(n_thr):
+                    if in_hit[k, h]:
+                        if adc >= thresholds[h]:
+                            h_integral[k, h] += adc
+                            if adc > h_peak[k, h]:
+                                h_peak[k, h] = adc
+                                h_peak_time[k, h] = t
+                        else:
+                            in_hit[k, h] = False
+                            n_open[k] -= 1
+                            if n_block < block_cap:
+                                j = b*block_cap + n_block
+                                o_chan[j] = c
+                                o_thr[j] = h
+                                o_start[j] = h_start[k, h]
+                                o_peak_time[j] = h_peak_time[k, h]
+                                o_tot[j] = t - h_start[k, h]
+                                o_peak[j] = h_peak[k, h]
+                                o_integral[j] = h_integral[k, h]
+                            n_block += 1
+                            counts[c, h] += 1
+                    elif adc >= thresholds[h]:
+                        in_hit[k, h] = True
+                        n_open[k] += 1
+                        h_start[k, h] = t
+                        h_peak_time[k, h] = t
+                        h_peak[k, h] = adc
+                        h_integral[k, h] = adc
+
+    return counts
+
+
+@njit(parallel=True, cache=True)
+def hist_pedestal(adcs, offset, n_bins, median, block_size=64):
+    """Per-channel mode or median of an integer (time x channel) ADC matrix, from bounded-range histograms
+
+    Args:
+        adcs (np.array): ADC matrix (time x channel)
+        offset (int): value of the first histogram bin, all ADCs must be in [offset, offset+n_bins)
+        n_bins (int): number of histogram bins
+        median (bool): compute the median rather than the mode
+        block_size (int, optional): number of channels per block. Defaults to 64.
 
+    Returns:
+        np.array: mode (smallest one in case of ties) or median, per channel (int16)
+    """
+    n_samples, n_chans = adcs.shape
+    res = np.empty(n_chans, dtype=np.int16)
+
+    n_blocks = (n_chans + block_size - 1)//block_size
+    for b in prange(n_blocks):
+        c0 = b*block_size
+        c1 = min(c0+block_size, n_chans)
+        hist = np.zeros((c1-c0, n_bins), dtype=np.int32)
+        for i in range(n_samples):
+            for k in range(c1-c0):
+                hist[k, np.int64(adcs[i, c0+k])-offset] += 1
+
+        for k in range(c1-c0):
+            h = hist[k]
+            if median:
+                # Same as pandas: mean of the two central values for an even number of samples
+                lo_rank = (n_samples-1)//2
+                hi_rank = n_samples//2
+                lo = -1
+                hi = -1
+                cum = 0
+                for v in range(n_bins):
+                    cum += h[v]
+                    if lo < 0 and cum > lo_rank:
+                        lo = v
+                    if cum > hi_rank:
+                        hi = v
+                        break
+                res[c0+k] = np.int16(int((2*offset+lo+hi)/2))
+            else:
+                res[c0+k] = np.int16(offset+np.argmax(h))
+    return res
+
+InitialPedestalEstimatorAlgo = Literal["mode", "mean", "hist_mode", "hist_median"]
+
+TP_DTYPES = [
+    ('time_start', np.uint64), 
+    ('time_peak', np.uint64), 
+    ('time_over_threshold', np.uint64), 
+    ('channel',np.uint32),
+    ('adc_integral', np.uint32), 
+    ('adc_peak', np.uint16), 
+    ('flag', np.uint16),
+    ('plane', np.uint8),
+]
+
+TP_MULTI_DTYPES = TP_DTYPES + [('threshold_idx', np.uint16)]
+
+def estimate_initial_pedestal(df_rawadc: pd.DataFrame, init_ped_algo: InitialPedestalEstimatorAlgo='mode', init_ped_range: int = None, parallel: bool = True) -> pd.Series:
+    """Estimate the initial pedestal of each channel over the first init_ped_range samples
+
+    The 'hist_mode' and 'hist_median' estimators histogram the (integer) ADCs of each channel
+    and give the same results as 'mode' and the pandas median, at a fraction of the cost.
+
+    Args:
+        df_rawadc (pd.DataFrame): raw ADC frame (time x channel)
+        init_ped_algo (InitialPedestalEstimatorAlgo, optional): estimator algorithm. Defaults to 'mode'.
+        init_ped_range (int, optional): number of samples used for the estimate. Defaults to None (all).
+        parallel (bool, optional): process the channels in parallel (histogram estimators only). Defaults to True.
+
+    Returns:
+        pd.Series: initial pedestal (int16), by channel
+    """
     match init_ped_algo:
         case 'mode':
             # Calculate the initial pedestal value using the mode over 0:init_ped_range
-            adc_modes = df_rawadc[:init_ped_range].mode().iloc[0].astype('int16')
+            return df_rawadc[:init_ped_range].mode().iloc[0].astype('int16')
         case 'mean':
             # Calculate the initial pedestal value using the mean over 0:init_ped_range
-            adc_modes = df_rawadc[:init_ped_range].mean().astype('int16')
+            return df_rawadc[:init_ped_range].mean().astype('int16')
+        case 'hist_mode' | 'hist_median':
+            adcs = df_rawadc[:init_ped_range].to_numpy()
+            if adcs.dtype.kind not in 'iu':
+                raise ValueError(f"Pedestal estimator algorithm '{init_ped_algo}' requires integer ADCs, got {adcs.dtype}")
+            if adcs.size == 0:
+                raise ValueError("No samples to estimate the pedestal from")
+            offset = int(adcs.min())
+            n_bins = int(adcs.max())-offset+1
+            n_threads = get_num_threads()
+            if not parallel:
+                set_num_threads(1)
+            try:
+                peds = hist_pedestal(adcs, offset, n_bins, init_ped_algo == 'hist_median')
+            finally:
+                set_num_threads(n_threads)
+            return pd.Series(peds, index=df_rawadc.columns)
         case _:
             raise ValueError(f"Pedestal estimator algorithm '{init_ped_algo}' not recognised")
 
-    df_ped = pd.DataFrame().reindex_like(df_rawadc)
-    for c,s in df_rawadc.items():
-        df_ped[c] = frugal_pedestal(s.to_numpy(), median_0=adc_modes[c], limit=limit)
+
+def emulate_ped(df_rawadc: pd.DataFrame, limit: int=10, init_ped_algo: InitialPedestalEstimatorAlgo='mode', init_ped_range: int = None, parallel: bool = True) -> tuple[pd.DataFrame, pd.DataFrame]:
+
+    adc_modes = estimate_initial_pedestal(df_rawadc, init_ped_algo, init_ped_range, parallel)
+
+    adcs = df_rawadc.to_numpy()
+    # int32 accumulators, as in the TPG state
+    median_0 = adc_modes.to_numpy().astype(np.int32)
+    peds, _, _ = frugal_pedestal_2d(adcs, median_0, np.zeros_like(median_0), limit)
+
+    df_ped = pd.DataFrame(peds, index=df_rawadc.index, columns=df_rawadc.columns, copy=False)
     df_ped_var = df_ped-adc_modes
     return df_ped, df_ped_var
 
@@ -152,38 +380,101 @@ def emulate_running_sum(df_adc: pd.DataFrame, r: float=0.98):
     return df_rs_adc
 
 
+# Channels per block of the hit finding kernels
+_BLOCK_SIZE = 64
+
+def _hits_per_channel_hint(n_samples: int) -> int:
+    '''Room for hits per (channel, threshold) in the output of a block
+
+    Records have a few hits per channel, while a channel can close up to n_samples/2 hits
+    (alternating above and below threshold): blocks exceeding the hint are processed again.
+    '''
+    return 4 + n_samples//256
+
+
+def find_hits_all(ts: np.ndarray, adcs: np.ndarray, thresholds, hits_per_channel: int = None) -> np.ndarray:
+    """Find the hits of all the channels of a (time x channel) ADC matrix
+
+    The matrix is read once: each block of channels stores its hits in a region of the output sized
+    for `hits_per_channel` hits per (channel, threshold). The blocks that close more hits than that
+    (e.g. noisy channels) are scanned again, with room for all their hits.
+
+    Args:
+        ts (np.ndarray): timestamps
+        adcs (np.ndarray): pedestal subtracted ADC matrix (time x channel)
+        thresholds (int | array-like): hit threshold, or thresholds scanned in a single pass
+        hits_per_channel (int, optional): expected hits per (channel, threshold). Defaults to None (4 + n_samples/256).
+
+    Returns:
+        np.ndarray: hits (TP_DTYPES structured array, or TP_MULTI_DTYPES for a sequence of thresholds),
+            grouped by channel and threshold, with the channel *index* in the `channel` field
+    """
+    n_samples, n_chans = adcs.shape
+    multi = np.ndim(thresholds) > 0
+    thresholds = np.atleast_1d(np.asarray(thresholds, dtype=np.int64))
+
+    if hits_per_channel is None:
+        hits_per_channel = _hits_per_channel_hint(n_samples)
+    block_cap = _BLOCK_SIZE*len(thresholds)*hits_per_channel
+    n_blocks = (n_chans + _BLOCK_SIZE - 1)//_BLOCK_SIZE
+
+    buf = np.zeros(n_blocks*block_cap, dtype=TP_MULTI_DTYPES)
+    counts = _call_find_hits_2d(ts, adcs, thresholds, block_cap, buf, _BLOCK_SIZE)
+
+    parts = []
+    for b in range(n_blocks):
+        c0 = b*_BLOCK_SIZE
+        c1 = min(c0+_BLOCK_SIZE, n_chans)
+        n_hits = int(counts[c0:c1].sum())
+        if n_hits <= block_cap:
+            parts.append(buf[b*block_cap:b*block_cap+n_hits])
+            continue
+
+        part = np.zeros(n_hits, dtype=TP_MULTI_DTYPES)
+        _call_find_hits_2d(ts, adcs[:, c0:c1], thresholds, n_hits, part, c1-c0)
+        part['channel'] += c0
+        parts.append(part)
+
+    hits = np.concatenate(parts) if parts else np.zeros(0, dtype=TP_MULTI_DTYPES)
+    # Blocks store their hits in time order: sort them by channel and threshold (stable)
+    hits = hits[np.lexsort((hits['threshold_idx'], hits['channel']))]
+    if not multi:
+        single = np.zeros(len(hits), dtype=TP_DTYPES)
+        for name, _ in TP_DTYPES:
+            single[name] = hits[name]
+        hits = single
+    return hits
+
+
+def _call_find_hits_2d(ts, adcs, thresholds, block_cap, out, block_size):
+    return find_hits_2d(
+        ts, adcs, thresholds,
+        block_cap, out['channel'], out['threshold_idx'], out['time_start'], out['time_peak'], out['time_over_threshold'], out['adc_peak'], out['adc_integral'],
+        block_size
+    )
+
+
 def generate_tps(df_adc: pd.DataFrame, threshold: int, chmap):
-    dtypes = [
-                ('time_start', np.uint64), 
-                ('time_peak', np.uint64), 
-                ('time_over_threshold', np.uint64), 
-                ('channel',np.uint32),
-                ('adc_integral', np.uint32), 
-                ('adc_peak', np.uint16), 
-                ('flag', np.uint16),
-                ('plane', np.uint8),
-        ]
-
-    empty_tps = pd.DataFrame(np.empty(0, dtypes))
-
-    dfs_tp = []
-    ts = df_adc.index.to_numpy()
-    for c,s in df_adc.items():
-        num_hits, v_time_start, v_time_peak, v_time_over_threshold, v_adc_peak, v_adc_integral = find_hits(ts, s.to_numpy(), threshold)
-        if num_hits > 0: 
-            
-            chan_tps = empty_tps.copy()
-            chan_tps['channel']=[c]*num_hits
-            chan_tps['flag']=[0]*num_hits
-            chan_tps['plane']=[chmap.get_plane_from_offline_channel(c)]*num_hits
-            chan_tps['time_start']=v_time_start
-            chan_tps['time_peak']=v_time_peak
-            chan_tps['time_over_threshold']=v_time_over_threshold
-            chan_tps['adc_peak']=v_adc_peak
-            chan_tps['adc_integral']=v_adc_integral
 
-            dfs_tp.append(chan_tps)
-    return pd.concat(dfs_tp)
+    hits = find_hits_all(df_adc.index.to_numpy(), df_adc.to_numpy(), threshold)
+
+    hits['channel'] = df_adc.columns.to_numpy()[hits['channel']]
+    hits['plane'] = as_tpc_channel_map_tables(chmap).planes(hits['channel'])
+    return pd.DataFrame(hits)
+
+
+def generate_tps_multi(df_adc: pd.DataFrame, thresholds: list, chmap) -> pd.DataFrame:
+    """Generate the TPs for several thresholds in a single scan of the ADCs
+
+    Args:
+        df_adc (pd.DataFrame): pedestal subtracted ADC frame (time x channel)
+        thresholds (list): hit thresholds
+        chmap (TPCChannelMapTables | detchannelmaps.TPCChannelMap): channel map
+
+    Returns:
+        pd.DataFrame: TPs, with the position of their threshold in thresholds in the `threshold_idx` column
+    """
+    return generate_tps(df_adc, list(thresholds), chmap)
 
 
 def dbscan_cluster(df_tps, eps=40, min_samples=5):
@@ -200,6 +491,8 @@ def dbscan_cluster(df_tps, eps=40, min_samples=5):
     Returns:
         _type_: _description_
     """
+    from sklearn.cluster import DBSCAN
+
     points = df_tps[['time_peak','channel']].copy()
     points['time_peak'] = points['time_peak']/32
     clustering =  DBSCAN(eps=eps, min_samples=min_samples).fit(points.to_numpy())
@@ -0,0 +1,475 @@
+"""
+DBSCAN clustering of trigger primitives in the (channel, time) plane.
+
+Points are split by plane and sorted by time, so that the neighbours of a point lie in a
+contiguous window of the sorted points, found by binary search. Neighbour counts and border
+assignments are computed in parallel over the points; core points are connected with a
+union-find, run in parallel over time slabs and completed by a serial merge of the edges
+crossing the slab boundaries.
+The labels are the ones sklearn's DBSCAN gives when run on each plane separately:
+clusters are numbered in order of their first core point (in the input order) and border points
+join the lowest numbered cluster among their core neighbours.
+"""
+from numba import njit, prange, get_num_threads
+import numpy as np
+import pandas as pd
+
+from .algos import TP_DTYPES
+
+
+@njit(parallel=True, cache=True)
+def count_neighbours(chans, times, lo, hi, eps):
+    """Number of points within eps of each point, including the point itself
+
+    Args:
+        chans (np.array): channel of the sorted points
+        times (np.array): scaled time of the sorted points
+        lo, hi (np.array): per-point window of the candidate neighbours in the sorted points
+        eps (float): neighbourhood radius
+
+    Returns:
+        np.array: neighbour counts (int64)
+    """
+    n = len(chans)
+    counts = np.zeros(n, dtype=np.int64)
+    eps2 = eps*eps
+    for i in prange(n):
+        k = 0
+        for j in range(lo[i], hi[i]):
+            dc = chans[j]-chans[i]
+            dt = times[j]-times[i]
+            if dc*dc+dt*dt <= eps2:
+                k += 1
+        counts[i] = k
+    return counts
+
+
+@njit(cache=True)
+def _find(parent, i):
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+    while parent[i] != root:
+        nxt = parent[i]
+        parent[i] = root
+        i = nxt
+    return root
+
+
+@njit(cache=True)
+def _union(parent, i, j):
+    ri = _find(parent, i)
+    rj = _find(parent, j)
+    if ri < rj:
+        parent[rj] = ri
+    elif rj < ri:
+        parent[ri] = rj
+
+
+@njit(parallel=True, cache=True)
+def connect_cores(chans, times, hi, core, eps, slab_start, slab_end):
+    """Connect the core points within eps of each other
+
+    Slabs are disjoint ranges of the sorted points: edges within a slab are merged in parallel,
+    edges leaving a slab are merged serially afterwards.
+
+    Args:
+        chans (np.array): channel of the sorted points
+        times (np.array): scaled time of the sorted points
+        hi (np.array): per-point end of the window of the candidate neighbours
+        core (np.array): core point flags
+        eps (float): neighbourhood radius
+        slab_start, slab_end (np.array): slabs boundaries
+
+    Returns:
+        np.array: union-find parent array, with the lowest index of each component as root
+    """
+    n = len(chans)
+    parent = np.arange(n)
+    eps2 = eps*eps
+
+    for s in prange(len(slab_start)):
+        for i in range(slab_start[s], slab_end[s]):
+            if not core[i]:
+                continue
+            for j in range(i+1, min(hi[i], slab_end[s])):
+                if core[j]:
+                    dc = chans[j]-chans[i]
+                    dt = times[j]-times[i]
+                    if dc*dc+dt*dt <= eps2:
+                        _union(parent, i, j)
+
+    for s in range(len(slab_start)):
+        for i in range(slab_start[s], slab_end[s]):
+            if not core[i] or hi[i] <= slab_end[s]:
+                continue
+            for j in range(slab_end[s], hi[i]):
+                if core[j]:
+                    dc = chans[j]-chans[i]
+                    dt = times[j]-times[i]
+                    if dc*dc+dt*dt <= eps2:
+                        _union(parent, i, j)
+
+    for i in range(n):
+        parent[i] = _find(parent, i)
+    return parent
+
+
+@njit(parallel=True, cache=True)
+def assign_borders(chans, times, lo, hi, core, labels, eps):
+    """Assign the non-core points to the lowest numbered cluster among their core neighbours
+
+    Args:
+        chans (np.array): channel of the sorted points
+        times (np.array): scaled time of the sorted points
+        lo, hi (np.array): per-point window of the candidate neighbours in the sorted points
+        core (np.array): core point flags
+        labels (np.array): cluster labels of the core points, updated in place for the border points
+        eps (float): neighbourhood radius
+    """
+    eps2 = eps*eps
+    for i in prange(len(chans)):
+        if core[i]:
+            continue
+        best = -1
+        for j in range(lo[i], hi[i]):
+            if core[j] and (best < 0 or labels[j] < best):
+                dc = chans[j]-chans[i]
+                dt = times[j]-times[i]
+                if dc*dc+dt*dt <= eps2:
+                    best = labels[j]
+        labels[i] = best
+
+
+@njit(cache=True)
+def border_edges(chans, times, lo, hi, core, scan, eps):
+    """Core neighbours of the scanned non-core points
+
+    Args:
+        chans (np.array): channel of the sorted points
+        times (np.array): scaled time of the sorted points
+        lo, hi (np.array): per-point window of the candidate neighbours in the sorted points
+        core (np.array): core point flags
+        scan (np.array): flags of the non-core points to scan
+        eps (float): neighbourhood radius
+
+    Returns:
+        tuple: (point, core neighbour) index pairs
+    """
+    # The candidate windows bound the number of pairs
+    n_max = 0
+    for i in range(len(chans)):
+        if scan[i]:
+            n_max += hi[i]-lo[i]
+    points = np.empty(n_max, dtype=np.int64)
+    cores = np.empty(n_max, dtype=np.int64)
+
+    n = 0
+    eps2 = eps*eps
+    for i in range(len(chans)):
+        if not scan[i]:
+            continue
+        for j in range(lo[i], hi[i]):
+            if core[j]:
+                dc = chans[j]-chans[i]
+                dt = times[j]-times[i]
+                if dc*dc+dt*dt <= eps2:
+                    points[n] = i
+                    cores[n] = j
+                    n += 1
+    return points[:n], cores[:n]
+
+
+@njit(cache=True)
+def link_pairs(parent, a, b):
+    """Union the (a, b) pairs into a union-find and flatten it
+
+    Args:
+        parent (np.array): union-find parent array, updated in place
+        a, b (np.array): indices of the pairs to connect
+
+    Returns:
+        np.array: parent, with the lowest index of each component as root of all its members
+    """
+    for k in range(len(a)):
+        _union(parent, a[k], b[k])
+    for i in range(len(parent)):
+        parent[i] = _find(parent, i)
+    return parent
+
+
+def _neighbour_windows(chans: np.ndarray, times: np.ndarray, planes: np.ndarray, eps: float, n_slabs: int) -> tuple:
+    """
+    Sort points by plane and time, and find the window of candidate neighbours of each one
+
+    Args:
+        chans (np.ndarray): channels (float64)
+        times (np.ndarray): scaled times (float64)
+        planes (np.ndarray): planes
+        eps (float): neighbourhood radius
+        n_slabs (int): number of time slabs per plane
+
+    Returns:
+        tuple: sort order, sorted channels and times, neighbour windows (lo, hi) and slab boundaries (start, end)
+    """
+    n = len(chans)
+    # Stable sort, so that ties keep the input order
+    order = np.lexsort((times, planes))
+    chans = chans[order]
+    times = times[order]
+    planes = planes[order]
+
+    # Neighbour windows, restricted to the plane of each point
+    lo = np.empty(n, dtype=np.int64)
+    hi = np.empty(n, dtype=np.int64)
+    slab_start = []
+    slab_end = []
+    bounds = np.flatnonzero(np.diff(planes))+1
+    for p0, p1 in zip(np.r_[0, bounds], np.r_[bounds, n]):
+        t = times[p0:p1]
+        lo[p0:p1] = p0+np.searchsorted(t, t-eps, side='left')
+        hi[p0:p1] = p0+np.searchsorted(t, t+eps, side='right')
+        edges = np.linspace(p0, p1, min(n_slabs, p1-p0)+1).astype(np.int64)
+        slab_start.append(edges[:-1])
+        slab_end.append(edges[1:])
+    return order, chans, times, lo, hi, np.concatenate(slab_start), np.concatenate(slab_end)
+
+
+def cluster_tps(df_tps: pd.DataFrame, eps: float = 40, min_samples: int = 5, time_scale: float = 32, n_slabs: int = None) -> pd.DataFrame:
+    """
+    Cluster trigger primitives with DBSCAN, separately on each plane
+
+    Distances are computed on (channel, time_peak/time_scale), as in `dbscan_cluster`.
+
+    Args:
+        df_tps (pd.DataFrame): trigger primitives, with channel, time_peak and plane columns
+        eps (float, optional): neighbourhood radius. Defaults to 40.
+        min_samples (int, optional): minimum number of neighbours of a core point, including itself. Defaults to 5.
+        time_scale (float, optional): time units per channel unit. Defaults to 32.
+        n_slabs (int, optional): number of time slabs per plane processed in parallel. Defaults to None (number of numba threads).
+
+    Returns:
+        pd.DataFrame: copy of df_tps with a cluster_label column (-1 for noise)
+    """
+    res = df_tps.copy()
+    labels = cluster_labels(
+        df_tps['channel'].to_numpy(), df_tps['time_peak'].to_numpy(), df_tps['plane'].to_numpy(),
+        eps, min_samples, time_scale, n_slabs
+    )
+    res['cluster_label'] = labels
+    return res
+
+
+def cluster_labels(channel: np.ndarray, time_peak: np.ndarray, plane: np.ndarray, eps: float = 40, min_samples: int = 5, time_scale: float = 32, n_slabs: int = None) -> np.ndarray:
+    """
+    DBSCAN labels of trigger primitives, computed separately on each plane
+
+    Args:
+        channel (np.ndarray): TP channels
+        time_peak (np.ndarray): TP peak times
+        plane (np.ndarray): TP planes
+        eps (float, optional): neighbourhood radius. Defaults to 40.
+        min_samples (int, optional): minimum number of neighbours of a core point, including itself. Defaults to 5.
+        time_scale (float, optional): time units per channel unit. Defaults to 32.
+        n_slabs (int, optional): number of time slabs per plane processed in parallel. Defaults to None (number of numba threads).
+
+    Returns:
+        np.ndarray: cluster labels (int64, -1 for noise), in the input order
+    """
+    n = len(channel)
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    if n_slabs is None:
+        n_slabs = get_num_threads()
+
+    order, chans, times, lo, hi, slab_start, slab_end = _neighbour_windows(
+        np.asarray(channel, dtype=np.float64), np.asarray(time_peak, dtype=np.float64)/time_scale, np.asarray(plane), eps, n_slabs
+    )
+
+    core = count_neighbours(chans, times, lo, hi, eps) >= min_samples
+    roots = connect_cores(chans, times, hi, core, eps, slab_start, slab_end)
+
+    # Number the clusters by their first core point in the input order
+    labels = np.full(n, -1, dtype=np.int64)
+    core_idx = np.flatnonzero(core)
+    if len(core_idx):
+        first = np.full(n, n, dtype=np.int64)
+        np.minimum.at(first, roots[core_idx], order[core_idx])
+        cluster_roots = np.flatnonzero(first < n)
+        rank = np.empty(n, dtype=np.int64)
+        rank[cluster_roots[np.argsort(first[cluster_roots])]] = np.arange(len(cluster_roots))
+        labels[core_idx] = rank[roots[core_idx]]
+        assign_borders(chans, times, lo, hi, core, labels, eps)
+
+    res = np.empty(n, dtype=np.int64)
+    res[order] = labels
+    return res
+
+
+class IncrementalTPClusterer:
+    """
+    Incremental version of `cluster_tps`, for TPs produced in time order (e.g. by a streaming emulator).
+
+    TPs are pushed in batches together with a frontier: a lower bound of the time_peak of all the TPs
+    still to come. The TPs that can no longer be affected by future ones, i.e. noise and clusters with all
+    their members more than 2 eps (in scaled time) before the frontier, are emitted.
+
+    The clustering state of the pending TPs (neighbour counts, union-find of the core TPs and core neighbours
+    of the non-core ones) is kept between pushes. Only the neighbourhoods within eps of the previous frontier
+    can change, so each push searches neighbours among the TPs less than 3 eps before it only; the older
+    pending TPs, e.g. the ones of long clusters, are not re-clustered.
+
+    Emitted TPs keep their index. Cluster labels are unique over the stream and numbered in emission order.
+
+    Args:
+        eps (float, optional): neighbourhood radius. Defaults to 40.
+        min_samples (int, optional): minimum number of neighbours of a core point, including itself. Defaults to 5.
+        time_scale (float, optional): time units per channel unit. Defaults to 32.
+        n_slabs (int, optional): number of time slabs per plane processed in parallel. Defaults to None.
+    """
+
+    def __init__(self, eps: float = 40, min_samples: int = 5, time_scale: float = 32, n_slabs: int = None):
+        self.eps = eps
+        self.min_samples = min_samples
+        self.time_scale = time_scale
+        self.n_slabs = n_slabs
+        self.frontier = None
+        self.n_clusters = 0
+        self._buffer = None
+        # Per-TP state of the pending TPs, in push order
+        self._chans = np.zeros(0)
+        self._times = np.zeros(0)
+        self._planes = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int64)
+        # Union-find of the core TPs, rooted at the first pushed core TP of each cluster
+        self._parent = np.zeros(0, dtype=np.int64)
+        # (non-core TP, core neighbour) pairs
+        self._border_tp = np.zeros(0, dtype=np.int64)
+        self._border_core = np.zeros(0, dtype=np.int64)
+
+    def push(self, df_tps: pd.DataFrame, frontier=None) -> pd.DataFrame:
+        """
+        Add a batch of TPs and return the ones whose cluster is final
+
+        Args:
+            df_tps (pd.DataFrame): TPs, with channel, time_peak and plane columns
+            frontier (int, optional): lower bound of the time_peak of the TPs of the following batches.
+                Defaults to None (the largest time_peak of the batch).
+
+        Raises:
+            ValueError: the batch contains TPs before the current frontier, or the frontier moves backward
+
+        Returns:
+            pd.DataFrame: finalized TPs, with a cluster_label column (-1 for noise)
+        """
+        if len(df_tps):
+            if self.frontier is not None and df_tps['time_peak'].min() < self.frontier:
+                raise ValueError(f"TPs at {df_tps['time_peak'].min()} are before the current frontier {self.frontier}")
+            if frontier is None:
+                frontier = df_tps['time_peak'].max()
+        elif frontier is None:
+            frontier = self.frontier
+
+        if frontier is not None and self.frontier is not None and frontier < self.frontier:
+            raise ValueError(f"Frontier moved backward from {self.frontier} to {frontier}")
+        previous = -np.inf if self.frontier is None else float(self.frontier)/self.time_scale
+        self.frontier = frontier
+
+        if self._buffer is None:
+            self._buffer = df_tps.iloc[:0].copy()
+        if len(df_tps):
+            n = len(self._parent)
+            self._buffer = pd.concat([self._buffer, df_tps])
+            self._chans = np.r_[self._chans, df_tps['channel'].to_numpy().astype(np.float64)]
+            self._times = np.r_[self._times, df_tps['time_peak'].to_numpy().astype(np.float64)/self.time_scale]
+            self._planes = np.r_[self._planes, df_tps['plane'].to_numpy().astype(np.int64)]
+            self._counts = np.r_[self._counts, np.zeros(len(df_tps), dtype=np.int64)]
+            self._parent = np.r_[self._parent, np.arange(n, n+len(df_tps))]
+            self._update(previous)
+
+        if self.frontier is None:
+            return self._buffer.iloc[:0].assign(cluster_label=np.zeros(0, dtype=np.int64))
+        return self._emit(float(self.frontier)/self.time_scale)
+
+    def flush(self) -> pd.DataFrame:
+        """
+        Emit all the pending TPs, as at the end of the stream
+
+        Returns:
+            pd.DataFrame: finalized TPs, with a cluster_label column (-1 for noise)
+        """
+        if self._buffer is None:
+            # Nothing was pushed: the columns of the emulated TPs
+            return pd.DataFrame(np.empty(0, dtype=TP_DTYPES)).assign(cluster_label=np.zeros(0, dtype=np.int64))
+        return self._emit(np.inf)
+
+    def _update(self, previous: float):
+        """Update the clustering state with the TPs pushed after the previous frontier"""
+        eps = self.eps
+        n_slabs = get_num_threads() if self.n_slabs is None else self.n_slabs
+
+        # Pending TPs within reach of the new ones: older TPs have already been emitted or are final
+        region = np.flatnonzero(self._times >= previous - 3*eps)
+        order, chans, times, lo, hi, slab_start, slab_end = _neighbour_windows(
+            self._chans[region], self._times[region], self._planes[region], eps, n_slabs
+        )
+        pos = region[order]
+
+        # Neighbourhoods are complete from previous - eps on, the older TPs keep their counts
+        counts = count_neighbours(chans, times, lo, hi, eps)
+        recount = times >= previous - eps
+        self._counts[pos[recount]] = counts[recount]
+        core = self._counts[pos] >= self.min_samples
+
+        # New core TPs and their core neighbours are all in the region
+        local = connect_cores(chans, times, hi, core, eps, slab_start, slab_end)
+        core_idx = np.flatnonzero(core)
+        link_pairs(self._parent, pos[core_idx], pos[local[core_idx]])
+
+        # Core neighbours of the non-core TPs that may have changed
+        rescan = times >= previous - 2*eps
+        keep = ~np.isin(self._border_tp, pos[rescan])
+        points, cores = border_edges(chans, times, lo, hi, core, rescan & ~core, eps)
+        self._border_tp = np.r_[self._border_tp[keep], pos[points]]
+        self._border_core = np.r_[self._border_core[keep], pos[cores]]
+
+    def _emit(self, frontier: float) -> pd.DataFrame:
+        n = len(self._parent)
+        limit = frontier - 2*self.eps
+        roots = self._parent
+        core = self._counts >= self.min_samples
+
+        # Non-core TPs join the cluster with the first pushed root among their core neighbours
+        labels = np.where(core, roots, n)
+        np.minimum.at(labels, self._border_tp, roots[self._border_core])
+        clustered = labels < n
+        labels[~clustered] = -1
+
+        # Clusters sharing non-core TPs are final together, as a merge can still move those TPs
+        groups = link_pairs(np.arange(n), labels[self._border_tp], roots[self._border_core])
+        last = np.full(max(n, 1), -np.inf)
+        np.maximum.at(last, groups[labels[clustered]], self._times[clustered])
+        final = np.where(clustered, last[groups[np.maximum(labels, 0)]] < limit, self._times < limit)
+
+        # Number the final clusters in order of their root
+        new_ids = np.full(max(n, 1), -1, dtype=np.int64)
+        ids = np.unique(labels[final & clustered])
+        new_ids[ids] = self.n_clusters + np.arange(len(ids))
+        self.n_clusters += len(ids)
+
+        res = self._buffer[final].copy()
+        res['cluster_label'] = np.where(clustered[final], new_ids[np.maximum(labels[final], 0)], -1)
+
+        # Whole clusters are emitted: the pending TPs never refer to emitted ones
+        keep = ~final
+        new_pos = np.cumsum(keep)-1
+        self._buffer = self._buffer[keep]
+        self._chans = self._chans[keep]
+        self._times = self._times[keep]
+        self._planes = self._planes[keep]
+        self._counts = self._counts[keep]
+        self._parent = new_pos[roots[keep]]
+        keep_edges = keep[self._border_tp]
+        self._border_tp = new_pos[self._border_tp[keep_edges]]
+        self._border_core = new_pos[self._border_core[keep_edges]]
+        return res
@@ -0,0 +1,413 @@
+from numba import njit, prange
+import numpy as np
+import pandas as pd
+
+from .algos import TP_DTYPES, TP_MULTI_DTYPES, InitialPedestalEstimatorAlgo, estimate_initial_pedestal, _BLOCK_SIZE, _hits_per_channel_hint
+from ..utils.chmap import as_tpc_channel_map_tables
+
+
+@njit(parallel=True, cache=True)
+def tpg_kernel(
+        ts, adcs, thresholds, limit, rs_r, use_rs,
+        median, acc, rs, n_open, in_hit, h_start, h_peak_time, h_peak, h_integral,
+        block_cap, o_chan, o_thr, o_start, o_peak_time, o_tot, o_peak, o_integral,
+        wf_index, wf_ped, wf_adc, wf_rs,
+        block_size=64
+    ):
+    """Fused TPG chain: frugal pedestal, pedestal subtraction, running sum and hit finding.
+
+    The (time x channel) ADC matrix is processed in a single pass, in parallel over blocks of channels.
+    The per-channel state (pedestal, accumulator, running sum and open hit) is read from and written back
+    to the state arrays, so that consecutive calls continue the same streams.
+
+    Hits are searched for several thresholds at once and counted per (channel, threshold).
+    Each block of channels stores its hits, in time order, in its own region of the output arrays,
+    starting at block*block_cap: the hits beyond block_cap are counted but not stored
+    (see `run_tpg_kernel` for the handling of the overflowing blocks).
+    Hits still open at the end of the matrix are not counted, they are carried in the state.
+
+    Args:
+        ts (np.array): timestamps (time)
+        adcs (np.array): raw ADC matrix (time x channel)
+        thresholds (np.array): hit thresholds
+        limit (int): frugal pedestal accumulator limit
+        rs_r (float): running sum factor
+        use_rs (bool): find hits on the running sum rather than on the pedestal subtracted ADCs
+        median, acc, rs, n_open (np.array): per-channel state
+        in_hit, h_start, h_peak_time, h_peak, h_integral (np.array): per-(channel, threshold) open hits state
+        block_cap (int): number of hits stored per block of channels
+        o_chan, o_thr, o_start, o_peak_time, o_tot, o_peak, o_integral (np.array): hits output arrays
+        wf_index (np.array): per-channel column in the waveform arrays, -1 if not recorded
+        wf_ped, wf_adc, wf_rs (np.array): waveforms output arrays (time x recorded channel)
+        block_size (int, optional): number of channels per block. Defaults to 64.
+
+    Returns:
+        np.array: number of hits closed in this call, per (channel, threshold)
+    """
+    n_samples, n_chans = adcs.shape
+    n_thr = len(thresholds)
+    counts = np.zeros((n_chans, n_thr), dtype=np.int64)
+    min_thr = thresholds.min() if n_thr else 0
+
+    n_blocks = (n_chans + block_size - 1)//block_size
+    for b in prange(n_blocks):
+        c0 = b*block_size
+        c1 = min(c0+block_size, n_chans)
+        n_block = 0
+
+        for i in range(n_samples):
+            t = np.int64(ts[i])
+            for c in range(c0, c1):
+                adc = np.int32(adcs[i, c])
+
+                # Pedestal
+                m = median[c]
+                if adc > m:
+                    acc[c] += 1
+                elif adc < m:
+                    acc[c] -= 1
+
+                if acc[c] == limit:
+                    acc[c] = 0
+                    median[c] = m+1
+                elif acc[c] == -limit:
+                    acc[c] = 0
+                    median[c] = m-1
+
+                # Pedestal subtraction and running sum
+                sig = adc - median[c]
+                rs[c] = rs_r*rs[c] + sig
+                if use_rs:
+                    sig = np.int32(rs[c])
+
+                if wf_index[c] >= 0:
+                    k = wf_index[c]
+                    wf_ped[i, k] = median[c]
+                    wf_adc[i, k] = adc - median[c]
+                    wf_rs[i, k] = rs[c]
+
+                # Hit finding, nothing to do below all thresholds when no hit is open
+                if n_open[c] == 0 and sig < min_thr:
+                    continue
+
+                for h in range(n_thr):
+                    if in_hit[c, h]:
+                        if sig >= thresholds[h]:
+                            h_integral[c, h] += sig
+                            if sig > h_peak[c, h]:
+                                h_peak[c, h] = sig
+                                h_peak_time[c, h] = t
+                        else:
+                            in_hit[c, h] = False
+                            n_open[c] -= 1
+                            if n_block < block_cap:
+                                j = b*block_cap + n_block
+                                o_chan[j] = c
+                                o_thr[j] = h
+                                o_start[j] = h_start[c, h]
+                                o_peak_time[j] = h_peak_time[c, h]
+                                o_tot[j] = t - h_start[c, h]
+                                o_peak[j] = h_peak[c, h]
+                                o_integral[j] = h_integral[c, h]
+                            n_block += 1
+                            counts[c, h] += 1
+                    elif sig >= thresholds[h]:
+                        in_hit[c, h] = True
+                        n_open[c] += 1
+                        h_start[c, h] = t
+                        h_peak_time[c, h] = t
+                        h_peak[c, h] = sig
+                        h_integral[c, h] = sig
+
+    return counts
+
+
+# Order of the state arrays in the tpg_kernel arguments
+_STATE_FIELDS = ('median', 'acc', 'rs', 'n_open', 'in_hit', 'h_start', 'h_peak_time', 'h_peak', 'h_integral')
+
+def init_tpg_state(median_0: np.ndarray, n_thresholds: int = 1) -> dict:
+    """Initial state of the TPG chain
+
+    Args:
+        median_0 (np.ndarray): initial pedestal, per channel
+        n_thresholds (int, optional): number of hit thresholds. Defaults to 1.
+
+    Returns:
+        dict: per-channel state arrays, as expected by `tpg_kernel`
+    """
+    n_chans = len(median_0)
+    shape = (n_chans, n_thresholds)
+    return {
+        'median': np.asarray(median_0, dtype=np.int32).copy(),
+        'acc': np.zeros(n_chans, dtype=np.int32),
+        'rs': np.zeros(n_chans, dtype=np.float64),
+        'n_open': np.zeros(n_chans, dtype=np.int64),
+        'in_hit': np.zeros(shape, dtype=np.bool_),
+        'h_start': np.zeros(shape, dtype=np.int64),
+        'h_peak_time': np.zeros(shape, dtype=np.int64),
+        'h_peak': np.zeros(shape, dtype=np.int32),
+        'h_integral': np.zeros(shape, dtype=np.int64),
+    }
+
+
+def _call_tpg_kernel(ts, adcs, thresholds, limit, rs_r, hits_on_rs, state_arrays, block_cap, out, wf_index, waveforms, block_size):
+    return tpg_kernel(
+        ts, adcs, thresholds, limit, rs_r, hits_on_rs,
+        *state_arrays,
+        block_cap, out['channel'], out['threshold_idx'], out['time_start'], out['time_peak'], out['time_over_threshold'], out['adc_peak'], out['adc_integral'],
+        wf_index, waveforms['ped'], waveforms['adc'], waveforms['rs'],
+        block_size
+    )
+
+
+def run_tpg_kernel(ts: np.ndarray, adcs: np.ndarray, state: dict, threshold, limit: int, rs_r: float = 0.98, hits_on_rs: bool = False, wf_index: np.ndarray = None, hits_per_channel: int = None) -> tuple[np.ndarray, dict]:
+    """Run the fused TPG chain over a (time x channel) ADC matrix, updating state
+
+    The matrix is read once: each block of channels stores its hits in a region of the output sized
+    for `hits_per_channel` hits per (channel, threshold). The blocks that close more hits than that
+    (e.g. noisy channels) are processed again from their initial state, with room for all their hits.
+
+    Args:
+        ts (np.ndarray): timestamps
+        adcs (np.ndarray): raw ADC matrix (time x channel)
+        state (dict): per-channel state, see `init_tpg_state`
+        threshold (int | array-like): hit threshold, or thresholds scanned in a single pass (see `init_tpg_state`)
+        limit (int): frugal pedestal accumulator limit
+        rs_r (float, optional): running sum factor. Defaults to 0.98.
+        hits_on_rs (bool, optional): find hits on the running sum rather than on the pedestal subtracted ADCs. Defaults to False.
+        wf_index (np.ndarray, optional): per-channel column of the recorded waveforms, -1 if not recorded. Defaults to None.
+        hits_per_channel (int, optional): expected hits per (channel, threshold). Defaults to None (4 + n_samples/256).
+
+    Returns:
+        tuple: hits (TP_DTYPES structured array, or TP_MULTI_DTYPES for a sequence of thresholds,
+            with the channel *index* in the `channel` field), sorted by channel, threshold and time,
+            and recorded waveforms
+    """
+    n_samples, n_chans = adcs.shape
+    multi = np.ndim(threshold) > 0
+    thresholds = np.atleast_1d(np.asarray(threshold, dtype=np.int64))
+    if state['in_hit'].shape[1] != len(thresholds):
+        raise ValueError(f"State initialized for {state['in_hit'].shape[1]} thresholds, got {len(thresholds)}")
+
+    if wf_index is None:
+        wf_index = np.full(n_chans, -1, dtype=np.int64)
+    n_wf = int(wf_index.max()+1) if n_chans else 0
+    waveforms = {k: np.zeros((n_samples, n_wf), dtype=dt) for k,dt in [('ped', np.int16), ('adc', np.int16), ('rs', np.float64)]}
+
+    if hits_per_channel is None:
+        hits_per_channel = _hits_per_channel_hint(n_samples)
+    block_cap = _BLOCK_SIZE*len(thresholds)*hits_per_channel
+    n_blocks = (n_chans + _BLOCK_SIZE - 1)//_BLOCK_SIZE
+
+    # The state is small (per channel): keep a copy to reprocess the overflowing blocks
+    initial = [state[k].copy() for k in _STATE_FIELDS]
+    buf = np.zeros(n_blocks*block_cap, dtype=TP_MULTI_DTYPES)
+    counts = _call_tpg_kernel(
+        ts, adcs, thresholds, limit, float(rs_r), hits_on_rs,
+        [state[k] for k in _STATE_FIELDS], block_cap, buf, wf_index, waveforms, _BLOCK_SIZE
+    )
+
+    parts = []
+    for b in range(n_blocks):
+        c0 = b*_BLOCK_SIZE
+        c1 = min(c0+_BLOCK_SIZE, n_chans)
+        n_hits = int(counts[c0:c1].sum())
+        if n_hits <= block_cap:
+            parts.append(buf[b*block_cap:b*block_cap+n_hits])
+            continue
+
+        block_state = [state[k][c0:c1] for k in _STATE_FIELDS]
+        for arr, init in zip(block_state, initial):
+            arr[...] = init[c0:c1]
+        part = np.zeros(n_hits, dtype=TP_MULTI_DTYPES)
+        _call_tpg_kernel(
+            ts, adcs[:, c0:c1], thresholds, limit, float(rs_r), hits_on_rs,
+            block_state, n_hits, part, wf_index[c0:c1], waveforms, c1-c0
+        )
+        part['channel'] += c0
+        parts.append(part)
+
+    hits = np.concatenate(parts) if parts else np.zeros(0, dtype=TP_MULTI_DTYPES)
+    # Blocks store their hits in time order: sort them by channel and threshold (stable)
+    hits = hits[np.lexsort((hits['threshold_idx'], hits['channel']))]
+    if not multi:
+        single = np.zeros(len(hits), dtype=TP_DTYPES)
+        for name, _ in TP_DTYPES:
+            single[name] = hits[name]
+        hits = single
+    return hits, waveforms
+
+
+def emulate_tpg(
+        df_rawadc: pd.DataFrame,
+        chmap,
+        threshold = 100,
+        limit: int = 10,
+        init_ped_algo: InitialPedestalEstimatorAlgo = 'mode',
+        init_ped_range: int = None,
+        rs_r: float = 0.98,
+        hits_on_rs: bool = False,
+        waveform_channels: list = (),
+        parallel: bool = True
+    ) -> tuple[pd.DataFrame, dict]:
+    """Emulate the TPG chain (pedestal, pedestal subtraction, running sum, hit finding) in a single pass
+
+    Equivalent to `emulate_ped`, `emulate_running_sum` and `generate_tps` applied in sequence,
+    without materializing the intermediate frames.
+
+    Args:
+        df_rawadc (pd.DataFrame): raw ADC frame (time x channel)
+        chmap (TPCChannelMapTables | detchannelmaps.TPCChannelMap): channel map
+        threshold (int | list, optional): hit threshold, or list of thresholds scanned in a single pass,
+            in which case the TPs have a `threshold_idx` column. Defaults to 100.
+        limit (int, optional): frugal pedestal accumulator limit. Defaults to 10.
+        init_ped_algo (InitialPedestalEstimatorAlgo, optional): initial pedestal estimator. Defaults to 'mode'.
+        init_ped_range (int, optional): number of samples used to estimate the initial pedestal. Defaults to None.
+        rs_r (float, optional): running sum factor. Defaults to 0.98.
+        hits_on_rs (bool, optional): find hits on the running sum rather than on the pedestal subtracted ADCs. Defaults to False.
+        waveform_channels (list, optional): channels for which the intermediate waveforms are returned. Defaults to ().
+        parallel (bool, optional): estimate the initial pedestal in parallel over the channels (histogram estimators only). Defaults to True.
+
+    Returns:
+        tuple[pd.DataFrame, dict]: TPs and a {channel: waveforms dataframe} dictionary
+    """
+    channels = df_rawadc.columns.to_numpy()
+    adcs = df_rawadc.to_numpy()
+    ts = df_rawadc.index.to_numpy()
+
+    adc_modes = estimate_initial_pedestal(df_rawadc, init_ped_algo, init_ped_range, parallel)
+    state = init_tpg_state(adc_modes.to_numpy(), np.size(threshold))
+
+    wf_index = np.full(len(channels), -1, dtype=np.int64)
+    for k,ch in enumerate(waveform_channels):
+        wf_index[df_rawadc.columns.get_loc(ch)] = k
+
+    hits, waveforms = run_tpg_kernel(ts, adcs, state, threshold, limit, rs_r, hits_on_rs, wf_index)
+    df_tps = _hits_to_frame(hits, channels, as_tpc_channel_map_tables(chmap))
+
+    wfs = {}
+    for k,ch in enumerate(waveform_channels):
+        wfs[ch] = pd.DataFrame(
+            {
+                'adc_raw': df_rawadc[ch],
+                'ped': waveforms['ped'][:,k],
+                'ped_var': waveforms['ped'][:,k]-adc_modes[ch],
+                'adc': waveforms['adc'][:,k],
+                'rs_adc': waveforms['rs'][:,k],
+            },
+            index=df_rawadc.index
+        )
+
+    return df_tps, wfs
+
+
+def _hits_to_frame(hits: np.ndarray, channels: np.ndarray, tables) -> pd.DataFrame:
+    """Convert kernel hits (channel indices) into a TPs dataframe"""
+    hits['channel'] = channels[hits['channel']]
+    hits['plane'] = tables.planes(hits['channel'])
+    return pd.DataFrame(hits)
+
+
+class StreamingTPGEmulator:
+    """
+    Stateful TPG emulator over an arbitrarily long ADC stream.
+
+    The stream is fed in consecutive (time x channel) chunks, e.g. frames or records.
+    Pedestal, accumulator, running sum and open hits are carried across chunk boundaries,
+    so that the TPs are identical to the ones obtained by processing the concatenated stream at once.
+    Each call to `process` returns the TPs closed within the chunk.
+    The initial pedestal is estimated from the first chunk.
+
+    Args:
+        chmap (TPCChannelMapTables | detchannelmaps.TPCChannelMap): channel map
+        threshold (int | list, optional): hit threshold, or list of thresholds (see `emulate_tpg`). Defaults to 100.
+        limit (int, optional): frugal pedestal accumulator limit. Defaults to 10.
+        init_ped_algo (InitialPedestalEstimatorAlgo, optional): initial pedestal estimator. Defaults to 'mode'.
+        init_ped_range (int, optional): number of samples of the first chunk used to estimate the initial pedestal. Defaults to None.
+        rs_r (float, optional): running sum factor. Defaults to 0.98.
+        hits_on_rs (bool, optional): find hits on the running sum rather than on the pedestal subtracted ADCs. Defaults to False.
+        parallel (bool, optional): estimate the initial pedestal in parallel over the channels (histogram estimators only). Defaults to True.
+    """
+
+    def __init__(
+            self,
+            chmap,
+            threshold = 100,
+            limit: int = 10,
+            init_ped_algo: InitialPedestalEstimatorAlgo = 'mode',
+            init_ped_range: int = None,
+            rs_r: float = 0.98,
+            hits_on_rs: bool = False,
+            parallel: bool = True
+        ):
+        self.tables = as_tpc_channel_map_tables(chmap)
+        self.threshold = threshold
+        self.limit = limit
+        self.init_ped_algo = init_ped_algo
+        self.init_ped_range = init_ped_range
+        self.rs_r = rs_r
+        self.hits_on_rs = hits_on_rs
+        self.parallel = parallel
+        self.reset()
+
+    def reset(self):
+        """Forget the stream state. The next chunk starts a new stream."""
+        self.channels = None
+        self.state = None
+        self.n_samples = 0
+        self.n_tps = 0
+        self._last_ts = None
+
+    def process(self, df_rawadc: pd.DataFrame) -> pd.DataFrame:
+        """
+        Process the next chunk of the stream
+
+        Args:
+            df_rawadc (pd.DataFrame): raw ADC chunk (time x channel), following the previous one in time
+
+        Returns:
+            pd.DataFrame: TPs closed within the chunk
+        """
+        channels = df_rawadc.columns.to_numpy()
+        ts = df_rawadc.index.to_numpy()
+
+        if self.state is None:
+            adc_modes = estimate_initial_pedestal(df_rawadc, self.init_ped_algo, self.init_ped_range, self.parallel)
+            self.state = init_tpg_state(adc_modes.to_numpy(), np.size(self.threshold))
+            self.channels = channels
+        elif not np.array_equal(channels, self.channels):
+            raise ValueError("Chunk channels differ from the stream channels")
+        elif len(ts) and ts[0] <= self._last_ts:
+            raise ValueError(f"Chunk starts at {ts[0]}, before the end of the previous chunk ({self._last_ts})")
+
+        hits, _ = run_tpg_kernel(ts, df_rawadc.to_numpy(), self.state, self.threshold, self.limit, self.rs_r, self.hits_on_rs)
+
+        if len(ts):
+            self._last_ts = ts[-1]
+        self.n_samples += len(ts)
+        self.n_tps += len(hits)
+        return _hits_to_frame(hits, self.channels, self.tables)
+
+    @property
+    def watermark(self):
+        """Lower bound of the time_peak of the TPs emitted by the following chunks, None before the first chunk"""
+        if self._last_ts is None:
+            return None
+        watermark = int(self._last_ts)+1
+        open_hits = self.state['in_hit']
+        if open_hits.any():
+            watermark = min(watermark, int(self.state['h_start'][open_hits].min()))
+        return watermark
+
+    def process_all(self, chunks):
+        """
+        Process a sequence of chunks, yielding the TPs of each of them
+
+        Args:
+            chunks (iterable): raw ADC chunks (time x channel)
+
+        Yields:
+            pd.DataFrame: TPs closed within each chunk
+        """
+        for df_rawadc in chunks:
+            yield self.process(df_rawadc)
@@ -0,0 +1,158 @@
+"""
+Compile the numba kernels ahead of use.
+
+All kernels are compiled with `cache=True`: the machine code is stored on disk (next to the sources,
+or in NUMBA_CACHE_DIR) and reloaded by the following processes instead of being recompiled.
+`precompile` fills the cache with a variant of each kernel for every combination of the array types
+listed below, both writable and read-only (as returned by pandas with copy-on-write).
+Numba dispatches calls to the variant matching the argument types exactly, so callers can pass
+the unpacked arrays as they are, without converting them first.
+
+Usage:
+    python -m tpgsandbox.emulation.warmup
+"""
+import itertools
+import time
+
+import numpy as np
+import pandas as pd
+
+# Raw ADCs: as unpacked (uint16) or converted by the caller (int16)
+ADC_DTYPES = (np.uint16, np.int16)
+# Pedestal subtracted ADCs: int16 or uint16 raw ADCs minus int16 pedestals
+SIGNAL_DTYPES = (np.int16, np.int32)
+# Timestamps: as unpacked (uint64) or rebased by the caller (int64)
+TS_DTYPES = (np.uint64, np.int64)
+
+N_SAMPLES = 64
+N_CHANS = 8
+
+
+def _variants(arr: np.ndarray) -> list:
+    '''Writable and read-only versions of arr'''
+    ro = arr.copy()
+    ro.flags.writeable = False
+    return [arr, ro]
+
+
+def _adcs(dtype) -> np.ndarray:
+    adcs = np.full((N_SAMPLES, N_CHANS), 900, dtype=dtype)
+    adcs[10:20] += 300
+    return adcs
+
+
+def _ts(dtype) -> np.ndarray:
+    return np.arange(N_SAMPLES, dtype=dtype)*32
+
+
+def _warm_scalar_kernels():
+    '''Single channel kernels'''
+    from . import algos
+
+    for dtype in ADC_DTYPES:
+        for adcs in _variants(_adcs(dtype)[:, 0].copy()):
+            algos.frugal_pedestal(adcs, 900, 0, 10)
+
+    for dtype in SIGNAL_DTYPES:
+        for sig in _variants(_adcs(dtype)[:, 0]-900):
+            algos.running_sum(sig, 0.98)
+
+    for ts_dtype, sig_dtype in itertools.product(TS_DTYPES, SIGNAL_DTYPES):
+        for ts, sig in itertools.product(_variants(_ts(ts_dtype)), _variants(_adcs(sig_dtype)[:, 0]-900)):
+            algos.find_hits(ts, sig, 100)
+
+
+def _warm_frame_kernels(adc_dtype, ts_dtype):
+    '''Channel matrix kernels, called as the DataFrame level functions do'''
+    from . import algos, tpg
+
+    df = pd.DataFrame(_adcs(adc_dtype), index=pd.Index(_ts(ts_dtype)))
+    # Whole frames and leading samples (init_ped_range) have different memory layouts
+    for init_ped_range in (None, N_SAMPLES//2):
+        algos.estimate_initial_pedestal(df, 'hist_mode', init_ped_range)
+    df_ped, _ = algos.emulate_ped(df, init_ped_algo='hist_mode')
+    df_adc = df-df_ped
+    algos.emulate_running_sum(df_adc)
+
+    # Single threshold and threshold scans have different outputs
+    for thresholds in (100, [100, 200]):
+        # No room for hits: also compiles the reprocessing of the overflowing blocks
+        for hits_per_channel in (None, 0):
+            algos.find_hits_all(df_adc.index.to_numpy(), df_adc.to_numpy(), thresholds, hits_per_channel)
+        state = tpg.init_tpg_state(np.full(N_CHANS, 900), np.size(thresholds))
+        for wf_index in (np.full(N_CHANS, -1, dtype=np.int64), np.arange(N_CHANS, dtype=np.int64)):
+            # No room for hits: also compiles the reprocessing of the overflowing blocks
+            for hits_per_channel in (None, 0):
+                tpg.run_tpg_kernel(df.index.to_numpy(), df.to_numpy(), state, thresholds, 10, wf_index=wf_index, hits_per_channel=hits_per_channel)
+
+
+def _warm_clustering():
+    from . import clustering
+
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        'channel': rng.integers(0, 64, 64).astype(np.uint32),
+        'time_peak': np.sort(rng.integers(0, 1 << 12, 64)).astype(np.uint64),
+        'plane': rng.integers(0, 3, 64).astype(np.uint8),
+    })
+    clustering.cluster_labels(df['channel'].to_numpy(), df['time_peak'].to_numpy(), df['plane'].to_numpy())
+
+    # The incremental clusterer also links and scans borders across pushes
+    inc = clustering.IncrementalTPClusterer()
+    inc.push(df.iloc[:32], df['time_peak'].iloc[32])
+    inc.push(df.iloc[32:])
+    inc.flush()
+
+
+def _warm_plotting():
+    from ..plotting import adcimage, report
+
+    # Waveforms are converted to float64: a copy for integer columns, a read-only view for float ones
+    for y in _variants(np.linspace(0, 1, 4*N_SAMPLES)):
+        report.minmax_indices(y, N_SAMPLES//2)
+
+    for dtype in ADC_DTYPES:
+        adcimage.adc_image(pd.DataFrame(_adcs(dtype)), (N_SAMPLES//4, N_CHANS//2), 'mean', 'mean')
+
+
+def _warm_trgdtypes():
+    from ..utils import trgdtypes
+
+    dtype = trgdtypes.trigger_activity_dtype
+    trgdtypes.scan_offsets(np.zeros(dtype.itemsize, dtype=np.uint8), dtype.itemsize, dtype.fields['n_inputs'][1], 32)
+
+
+def precompile(verbose: bool = False) -> float:
+    """
+    Compile (or load from the on-disk cache) all the numba kernels of the package
+    for the array types in ADC_DTYPES, SIGNAL_DTYPES and TS_DTYPES.
+
+    Args:
+        verbose (bool, optional): print the time spent on each group of kernels. Defaults to False.
+
+    Returns:
+        float: total time spent, in seconds
+    """
+    steps = [
+        ('trgdtypes', _warm_trgdtypes),
+        ('clustering', _warm_clustering),
+        ('plotting', _warm_plotting),
+        ('scalar kernels', _warm_scalar_kernels),
+    ]
+    for adc_dtype, ts_dtype in itertools.product(ADC_DTYPES, TS_DTYPES):
+        steps.append((
+            f"frame kernels {np.dtype(adc_dtype)}/{np.dtype(ts_dtype)}",
+            lambda a=adc_dtype, t=ts_dtype: _warm_frame_kernels(a, t)
+        ))
+
+    t_start = time.perf_counter()
+    for name, step in steps:
+        t0 = time.perf_counter()
+        step()
+        if verbose:
+            print(f"{name}: {time.perf_counter()-t0:.2f}s")
+    return time.perf_counter()-t_start
+
+
+if __name__ == '__main__':
+    print(f"Kernels ready in {precompile(verbose=True):.2f}s")
@@ -0,0 +1,228 @@
+"""
+ADC images of full detector frames.
+
+A record holds millions of (sample, channel) ADCs, far more than the pixels of a plot:
+drawing the matrix cell by cell (e.g. with pcolormesh) is slow and memory hungry.
+`adc_image` reduces the matrix to a screen-sized raster in a single numba pass, binning
+samples and channels together, and optionally subtracting a per-channel baseline on the fly.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Literal
+
+import numpy as np
+import pandas as pd
+from numba import njit, prange
+
+from ..utils.chmap import as_tpc_channel_map_tables
+
+ImageReduction = Literal["mean", "min", "max"]
+BaselineAlgo = Literal["mean", "median"]
+
+_REDUCTIONS = {'mean': 0, 'min': 1, 'max': 2}
+
+
+@njit(parallel=True, cache=True)
+def bin_adcs(adcs, cols, baseline, sub_mean, n_rows, n_cols, reduction):
+    """Reduce a (time x channel) ADC matrix to a (n_rows x n_cols) image
+
+    Rows and columns of the image are equal-sized bins of samples and of the selected channels.
+
+    Args:
+        adcs (np.array): ADC matrix (time x channel)
+        cols (np.array): column indices of the image channels, in image order
+        baseline (np.array): baseline subtracted from each image channel (float64)
+        sub_mean (bool): also subtract the mean of each channel
+        n_rows (int): number of time bins, at most the number of samples
+        n_cols (int): number of channel bins, at most the number of image channels
+        reduction (int): 0 for the mean, 1 for the minimum, 2 for the maximum of each bin
+
+    Returns:
+        np.array: image (float32)
+    """
+    n_samples = adcs.shape[0]
+    n_ch = cols.size
+    img = np.empty((n_rows, n_cols), dtype=np.float32)
+
+    for j in prange(n_cols):
+        c0 = j*n_ch//n_cols
+        c1 = (j+1)*n_ch//n_cols
+        if reduction == 1:
+            acc = np.full(n_rows, np.inf)
+        elif reduction == 2:
+            acc = np.full(n_rows, -np.inf)
+        else:
+            acc = np.zeros(n_rows)
+
+        for k in range(c0, c1):
+            c = cols[k]
+            b = baseline[k]
+            if sub_mean:
+                s = 0.
+                for i in range(n_samples):
+                    s += adcs[i, c]
+                b += s/n_samples
+
+            for r in range(n_rows):
+                i0 = r*n_samples//n_rows
+                i1 = (r+1)*n_samples//n_rows
+                a = acc[r]
+                for i in range(i0, i1):
+                    v = adcs[i, c]-b
+                    if reduction == 1:
+                        a = min(a, v)
+                    elif reduction == 2:
+                        a = max(a, v)
+                    else:
+                        a += v
+                acc[r] = a
+
+        for r in range(n_rows):
+            if reduction == 0:
+                n = (r+1)*n_samples//n_rows - r*n_samples//n_rows
+                img[r, j] = acc[r]/(n*(c1-c0))
+            else:
+                img[r, j] = acc[r]
+    return img
+
+
+@dataclass
+class ADCImage:
+    """
+    ADC raster of a (time x channel) frame
+
+    `image` has one row per time bin and one column per channel bin.
+    `row_samples` and `col_channels` are the first sample (position in the frame)
+    and the first channel of each bin.
+    """
+
+    image: np.ndarray
+    row_samples: np.ndarray
+    col_channels: np.ndarray
+    n_samples: int
+    plane: int = None
+
+    def extent(self) -> tuple:
+        '''imshow extent: columns in bin units, rows in samples'''
+        return (-0.5, self.image.shape[1]-0.5, 0, self.n_samples)
+
+
+def adc_image(df_adc: pd.DataFrame, shape: tuple = (1000, 1000), reduction: ImageReduction = 'mean', baseline = None, channels = None) -> ADCImage:
+    """
+    Reduce an ADC frame to an image of at most shape pixels
+
+    Args:
+        df_adc (pd.DataFrame): ADC frame (time x channel)
+        shape (tuple, optional): maximum (rows, columns) of the image. Defaults to (1000, 1000).
+        reduction (ImageReduction, optional): value of each pixel. Defaults to 'mean'.
+        baseline (BaselineAlgo | pd.Series, optional): per-channel baseline subtracted from the ADCs:
+            'mean', 'median' or values by channel. Defaults to None.
+        channels (array-like, optional): channels in the image, in order. Defaults to None (all).
+
+    Returns:
+        ADCImage: the image
+    """
+    if reduction not in _REDUCTIONS:
+        raise ValueError(f"Image reduction '{reduction}' not recognised")
+
+    if channels is None:
+        cols = np.arange(df_adc.shape[1], dtype=np.int64)
+    else:
+        cols = df_adc.columns.get_indexer(channels).astype(np.int64)
+        if (cols < 0).any():
+            raise KeyError(f"Channels not in the frame: {np.asarray(channels)[cols < 0]}")
+    col_chans = df_adc.columns.to_numpy()[cols]
+
+    sub_mean = False
+    if baseline is None:
+        bl = np.zeros(cols.size)
+    elif isinstance(baseline, str):
+        match baseline:
+            case 'mean':
+                bl = np.zeros(cols.size)
+                sub_mean = True
+            case 'median':
+                from ..emulation.algos import estimate_initial_pedestal
+                # Estimated on the whole frame, selecting the columns would copy them
+                bl = estimate_initial_pedestal(df_adc, 'hist_median').to_numpy()[cols].astype(np.float64)
+            case _:
+                raise ValueError(f"Baseline algorithm '{baseline}' not recognised")
+    else:
+        bl = pd.Series(baseline).reindex(col_chans).to_numpy(dtype=np.float64)
+        if np.isnan(bl).any():
+            raise KeyError(f"Baseline missing for channels {col_chans[np.isnan(bl)]}")
+
+    n_samples = df_adc.shape[0]
+    n_rows = max(min(shape[0], n_samples), 1)
+    n_cols = max(min(shape[1], cols.size), 1)
+    if n_samples == 0 or cols.size == 0:
+        img = np.zeros((0, 0), dtype=np.float32)
+    else:
+        img = bin_adcs(df_adc.to_numpy(), cols, bl, sub_mean, n_rows, n_cols, _REDUCTIONS[reduction])
+
+    return ADCImage(
+        image=img,
+        row_samples=np.arange(n_rows, dtype=np.int64)*n_samples//n_rows,
+        col_channels=col_chans[np.arange(n_cols, dtype=np.int64)*cols.size//n_cols] if cols.size else col_chans,
+        n_samples=n_samples,
+    )
+
+
+def adc_images_by_plane(df_adc: pd.DataFrame, chmap, shape: tuple = (1000, 1000), reduction: ImageReduction = 'mean', baseline = None) -> dict:
+    """
+    ADC images of each plane of a frame
+
+    Args:
+        df_adc (pd.DataFrame): ADC frame (time x channel)
+        chmap (TPCChannelMapTables | detchannelmaps.TPCChannelMap): channel map
+        shape (tuple, optional): maximum (rows, columns) of each image. Defaults to (1000, 1000).
+        reduction (ImageReduction, optional): value of each pixel. Defaults to 'mean'.
+        baseline (BaselineAlgo | pd.Series, optional): per-channel baseline, as in `adc_image`. Defaults to None.
+
+    Returns:
+        dict: {plane: ADCImage}, channels sorted within each plane
+    """
+    tables = as_tpc_channel_map_tables(chmap)
+    chans = df_adc.columns.to_numpy()
+    planes = tables.planes(chans)
+
+    if isinstance(baseline, str) and baseline == 'median':
+        # Once for all the planes
+        from ..emulation.algos import estimate_initial_pedestal
+        baseline = estimate_initial_pedestal(df_adc, 'hist_median')
+
+    images = {}
+    for p in np.unique(planes):
+        img = adc_image(df_adc, shape, reduction, baseline, np.sort(chans[planes == p]))
+        img.plane = int(p)
+        images[int(p)] = img
+    return images
+
+
+def plot_adc_image(ax, img: ADCImage, n_ticks: int = 8, **kwargs):
+    """
+    Draw an ADC image on a matplotlib axis
+
+    Args:
+        ax (matplotlib.axes.Axes): axis
+        img (ADCImage): image
+        n_ticks (int, optional): number of channel ticks. Defaults to 8.
+        **kwargs: imshow arguments
+
+    Returns:
+        matplotlib.image.AxesImage: the image artist
+    """
+    opts = dict(aspect='auto', origin='lower', interpolation='nearest', extent=img.extent())
+    opts.update(kwargs)
+    im = ax.imshow(img.image, **opts)
+
+    n_cols = img.image.shape[1]
+    if n_cols:
+        xpos = np.unique(np.linspace(0, n_cols-1, min(n_ticks, n_cols)).astype(int))
+        ax.set_xticks(xpos, [str(c) for c in img.col_channels[xpos]])
+    ax.set_xlabel("channel id")
+    ax.set_ylabel("Samples (since start of RO window)")
+    if img.plane is not None:
+        ax.set_title(f"Plane {img.plane}")
+    return im
@@ -0,0 +1,161 @@
+"""
+PDF reports of plotly figures.
+
+Figures are rendered to PDF pages by kaleido in a pool of worker processes, while the caller
+keeps producing the following ones, and the pages are merged in memory into the output document.
+Long waveforms are reduced with `decimate_frame` before plotting: a vector renderer draws every
+point of a trace, while the page can only show a few thousand of them.
+"""
+from __future__ import annotations
+
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from numba import njit
+
+
+@njit(cache=True)
+def minmax_indices(y: np.ndarray, n_bins: int) -> np.ndarray:
+    """
+    Indices of the minimum and maximum of y in each of n_bins equal bins, in increasing order
+
+    Keeping the extremes of each bin preserves the envelope of the waveform (pulses and spikes
+    included) as it would be drawn at a resolution of n_bins pixels.
+
+    Args:
+        y (np.ndarray): waveform
+        n_bins (int): number of bins
+
+    Returns:
+        np.ndarray: indices of the points to keep (at most 2*n_bins)
+    """
+    n = y.size
+    if n <= 2*n_bins:
+        return np.arange(n)
+
+    out = np.empty(2*n_bins, dtype=np.int64)
+    k = 0
+    for b in range(n_bins):
+        lo = b*n//n_bins
+        hi = (b+1)*n//n_bins
+        i_min = lo
+        i_max = lo
+        for i in range(lo+1, hi):
+            if y[i] < y[i_min]:
+                i_min = i
+            if y[i] > y[i_max]:
+                i_max = i
+        if i_min == i_max:
+            out[k] = i_min
+            k += 1
+        else:
+            out[k] = min(i_min, i_max)
+            out[k+1] = max(i_min, i_max)
+            k += 2
+    return out[:k]
+
+
+def decimate_frame(df: pd.DataFrame, max_points: int = 4000) -> pd.DataFrame:
+    """
+    Reduce a frame of waveforms to the rows holding the min/max of each column in max_points/2 bins
+
+    Args:
+        df (pd.DataFrame): waveforms (time x variable)
+        max_points (int, optional): number of points kept per column. Defaults to 4000.
+
+    Returns:
+        pd.DataFrame: selected rows of df (df itself if it is short enough)
+    """
+    if len(df) <= max_points:
+        return df
+    n_bins = max(max_points//2, 1)
+    idx = [minmax_indices(df[c].to_numpy(dtype=np.float64), n_bins) for c in df.columns]
+    return df.iloc[np.unique(np.concatenate(idx))]
+
+
+def render_figure(fig_json: str, fmt: str = 'pdf', width: int = None, height: int = None, scale: float = None) -> bytes:
+    """
+    Render a figure to an image in memory
+
+    Args:
+        fig_json (str): figure, as serialized by `fig.to_json()`
+        fmt (str, optional): image format. Defaults to 'pdf'.
+        width (int, optional): image width. Defaults to the figure layout width.
+        height (int, optional): image height. Defaults to the figure layout height.
+        scale (float, optional): image scale factor. Defaults to None.
+
+    Returns:
+        bytes: the image
+    """
+    import plotly.io as pio
+
+    return pio.to_image(pio.from_json(fig_json), format=fmt, width=width, height=height, scale=scale)
+
+
+class PDFReport:
+    """
+    PDF document built from plotly figures, rendered concurrently
+
+    Each figure is submitted for rendering as soon as it is added, and the pages are
+    merged in the order the figures were added when the report is written.
+
+    Args:
+        max_workers (int, optional): number of rendering processes. Defaults to the number of cores.
+        mp_context (optional): multiprocessing context used to start the workers. Defaults to None.
+    """
+
+    def __init__(self, max_workers: int = None, mp_context=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.mp_context = mp_context
+        self._xtor = None
+        self._pages = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    def add(self, fig, width: int = None, height: int = None):
+        '''Submit a figure for rendering as the next page of the report
+
+        Args:
+            fig (plotly.graph_objects.Figure): figure
+            width (int, optional): page width. Defaults to the figure layout width.
+            height (int, optional): page height. Defaults to the figure layout height.
+        '''
+        if self._xtor is None:
+            self._xtor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self.mp_context)
+        self._pages.append(self._xtor.submit(render_figure, fig.to_json(), 'pdf', width, height))
+
+    def write(self, path):
+        '''Wait for the pages to be rendered and write them to a PDF document
+
+        Args:
+            path (str | file-like): output path or binary stream
+        '''
+        from pypdf import PdfWriter
+
+        merger = PdfWriter()
+        for f in self._pages:
+            merger.append(io.BytesIO(f.result()))
+
+        if isinstance(path, (str, os.PathLike)):
+            with open(path, 'wb') as out:
+                merger.write(out)
+        else:
+            merger.write(path)
+        merger.close()
+
+    def close(self):
+        '''Discard the pages not yet rendered and stop the workers'''
+        if self._xtor is not None:
+            self._xtor.shutdown(wait=True, cancel_futures=True)
+            self._xtor = None
+        self._pages = []
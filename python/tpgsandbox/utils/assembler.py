@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 import logging
 
 
@@ -42,6 +43,74 @@ class ADCJoiner(Assembler):
 
         return df_adc
 
+class ADCMatrixAssembler(Assembler):
+    """
+    Assemble ADC fragments into a single dense (time x channel) matrix.
+
+    The timestamp and channel axes are computed once from all fragments, the matrix is allocated
+    with an integer dtype and each fragment is copied into place.
+    Samples not covered by any fragment are set to `fill_value`; 
+    `assemble_arrays` optionally returns a mask of the valid samples.
+    """
+
+    def __init__(self, dtype='uint16', fill_value=0) -> None:
+        self.dtype = np.dtype(dtype)
+        self.fill_value = fill_value
+
+    def match(self, sid: int) -> bool:
+        return True
+
+    def assemble_arrays(self, dataframes: dict, with_mask: bool = False) -> tuple:
+        """Assemble the fragments dataframes into numpy arrays
+
+        Args:
+            dataframes (dict): fragment dataframes, indexed by timestamp and with offline channels as columns
+            with_mask (bool, optional): build the mask of valid samples. Defaults to False.
+
+        Returns:
+            tuple: timestamps, channels, adc matrix (time x channel) and validity mask (None unless with_mask)
+        """
+        dfs = [v for v in dataframes.values() if v is not None]
+        if not dfs:
+            adcs = np.empty((0,0), dtype=self.dtype)
+            return np.empty(0, dtype='uint64'), np.empty(0, dtype='int64'), adcs, (np.empty((0,0), dtype=bool) if with_mask else None)
+
+        ts = np.unique(np.concatenate([df.index.to_numpy() for df in dfs]))
+        channels = np.unique(np.concatenate([df.columns.to_numpy() for df in dfs]))
+
+        adcs = np.full((len(ts), len(channels)), self.fill_value, dtype=self.dtype)
+        mask = np.zeros(adcs.shape, dtype=bool) if with_mask else None
+
+        for df in dfs:
+            rows = self._as_slice(np.searchsorted(ts, df.index.to_numpy()))
+            cols = self._as_slice(np.searchsorted(channels, df.columns.to_numpy()))
+            if not isinstance(rows, slice) or not isinstance(cols, slice):
+                rows, cols = np.ix_(np.r_[rows], np.r_[cols])
+            adcs[rows, cols] = df.to_numpy()
+            if mask is not None:
+                mask[rows, cols] = True
+
+        return ts, channels, adcs, mask
+
+    @staticmethod
+    def _as_slice(idx: np.ndarray):
+        """Convert a contiguous increasing array of positions into a slice"""
+        if len(idx) and idx[-1]-idx[0]+1 == len(idx) and np.all(np.diff(idx) == 1):
+            return slice(idx[0], idx[-1]+1)
+        return idx
+
+    def assemble(self, dataframes: dict) -> pd.DataFrame:
+        logging.info(f"Assembling ADC Frames {len(dataframes)}")
+
+        ts, channels, adcs, _ = self.assemble_arrays(dataframes)
+        names = [df.index.name for df in dataframes.values() if df is not None]
+        df_adc = pd.DataFrame(adcs, index=pd.Index(ts, name=names[0] if names else None), columns=pd.Index(channels), copy=False)
+
+        logging.info(f"Adcs dataframe assembled {len(df_adc)}x{len(df_adc.columns)}")
+
+        return df_adc
+
+
 class TPConcatenator(Assembler):
 
     def __init__(self) -> None:
@@ -85,13 +154,27 @@ class AssemblerService:
 
         res = {}
         # for id, dfs in dataframe_dict.items():
-        for prod_id,(data_id, asm) in self.assemblers.items():
-            if not data_id in fragments:
+        for prod_id in self.assemblers:
+            r = self.assemble_product(fragments, prod_id)
+            if r is None:
                 continue
-            
-            
-            dfs = { k:v for k,v in fragments[data_id].items() if asm.match(v)}
-
-            r = asm.assemble(dfs)
             res[prod_id] = r
-        return res
\ No newline at end of file
+        return res
+
+    def assemble_product(self, fragments, product_id: str):
+        """Assemble a single product
+
+        Args:
+            fragments (Mapping): unpacked fragments, by data id
+            product_id (str): name of the product to assemble
+
+        Returns:
+            the assembled product, None if the input data is not available
+        """
+        data_id, asm = self.assemblers[product_id]
+        if not data_id in fragments:
+            return None
+
+        dfs = { k:v for k,v in fragments[data_id].items() if asm.match(v)}
+
+        return asm.assemble(dfs)
\ No newline at end of file
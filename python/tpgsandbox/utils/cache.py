@@ -0,0 +1,380 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+class ProductDiskCache:
+    """
+    On-disk cache of unpacked and assembled record products.
+
+    Each product is stored as an uncompressed npz file, with dataframes stored column-wise
+    (or as a single block when all columns share the same dtype), so that reloading a product
+    is a plain read of compact arrays.
+    Entries are keyed by the raw file identity (path, size and modification time), the record,
+    the product name and the identity of the unpacker/assembler that produced it (see `make_key`).
+    The total size of the cache is kept below `max_bytes` by evicting the least recently used entries.
+
+    Args:
+        path (str): cache directory, created if it doesn't exist
+        max_bytes (int, optional): cache size budget. Defaults to 10 GB.
+    """
+
+    format_version = 1
+    suffix = '.npz'
+
+    def __init__(self, path: str, max_bytes: int = 10*(1 << 30)):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._scan()
+
+    def __getstate__(self):
+        return {'path': self.path, 'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _scan(self):
+        '''Build the index of the entries on disk'''
+        self._entries = {}
+        for e in os.scandir(self.path):
+            if e.name.endswith(self.suffix) and e.is_file():
+                st = e.stat()
+                self._entries[e.name] = (st.st_size, st.st_mtime)
+        self._size = sum(s for s,_ in self._entries.values())
+
+    def make_key(self, file_path: str, run: int, tr: int, kind: str, product: str, producers: list) -> str:
+        """
+        Build the cache key of a product
+
+        Args:
+            file_path (str): raw data file path
+            run (int): run number
+            tr (int): trigger record number
+            kind (str): product kind ('frags' or 'record')
+            product (str): product name
+            producers (list): unpacker/assembler objects used to make the product
+
+        Returns:
+            str: cache key
+        """
+        st = os.stat(file_path)
+        ident = [
+            self.format_version,
+            os.path.abspath(file_path), st.st_size, st.st_mtime_ns,
+            run, tr, kind, product,
+            [producer_identity(p) for p in producers]
+        ]
+        return hashlib.sha1(json.dumps(ident, default=str).encode()).hexdigest()
+
+    def get(self, key: str):
+        """
+        Returns the product stored under key
+
+        Raises:
+            KeyError: the key is not in the cache
+        """
+        name = key+self.suffix
+        fpath = os.path.join(self.path, name)
+        try:
+            with np.load(fpath, allow_pickle=False) as npz:
+                value = _decode(npz)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+                self._forget(name)
+            raise KeyError(key)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            logging.warning(f"Discarding unreadable cache entry {fpath}: {e}")
+            with self._lock:
+                self.misses += 1
+                self._forget(name)
+            try:
+                os.remove(fpath)
+            except FileNotFoundError:
+                pass
+            raise KeyError(key)
+
+        now = time.time()
+        try:
+            os.utime(fpath, (now, now))
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            self.hits += 1
+            if name in self._entries:
+                self._entries[name] = (self._entries[name][0], now)
+        return value
+
+    def put(self, key: str, value):
+        """
+        Store a product under key
+
+        Args:
+            key (str): cache key
+            value: product, a DataFrame, numpy array, None or a dict of those
+        """
+        name = key+self.suffix
+        fpath = os.path.join(self.path, name)
+        tmp_path = f"{fpath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            arrays = _encode(value)
+        except TypeError as e:
+            logging.warning(f"Product not cached: {e}")
+            return
+
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, fpath)
+        except OSError as e:
+            logging.warning(f"Failed to write cache entry {fpath}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        size = os.path.getsize(fpath)
+        with self._lock:
+            self._forget(name)
+            self._entries[name] = (size, time.time())
+            self._size += size
+            self._evict()
+
+    def _forget(self, name):
+        e = self._entries.pop(name, None)
+        if e is not None:
+            self._size -= e[0]
+
+    def _evict(self):
+        '''Remove the least recently used entries until the cache fits in the budget'''
+        if self._size <= self.max_bytes:
+            return
+        for name,_ in sorted(self._entries.items(), key=lambda x: x[1][1]):
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            self._forget(name)
+            self.evictions += 1
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            for name in list(self._entries):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    pass
+                self._forget(name)
+
+    def stats(self) -> dict:
+        """Returns the cache usage counters"""
+        return {
+            'entries': len(self._entries),
+            'bytes': self._size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class RecordCache:
+    """
+    In-memory LRU cache of loaded records, bounded by their memory footprint.
+
+    The footprint of an entry is measured with its `nbytes()` method when it is added.
+    Lazily loaded records grow as their products are used: the size of each product is
+    added to its entry with `charge`. Entries are never measured again under the cache lock.
+    The least recently used entries are evicted when the total exceeds `max_bytes`.
+
+    Args:
+        max_bytes (int, optional): memory budget. Defaults to 4 GB.
+    """
+
+    def __init__(self, max_bytes: int = 4*(1 << 30)):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Returns the entry for key, None if not in the cache
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        """
+        Add value to the cache under key, evicting the least recently used entries if needed
+        """
+        # Measured before taking the lock: the value may need its own locks
+        size = value.nbytes()
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            self._evict()
+
+    def charge(self, key, value, nbytes: int):
+        """
+        Add nbytes to the footprint of the entry of key (e.g. after it loaded a product), evicting entries if needed
+
+        Nothing is charged if key is no longer cached, or was replaced by another value.
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None or entry[0] is not value:
+                return
+            self._entries[key] = (value, entry[1]+nbytes)
+            self._size += nbytes
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            _, (_, size) = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+
+    def evict(self, key):
+        """Remove key from the cache"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry[1]
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        """Returns the cache usage counters"""
+        return {
+            'entries': len(self._entries),
+            'bytes': self._size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+def producer_identity(obj) -> str:
+    """
+    Identity of an unpacker or assembler: its class and configuration attributes.
+    Objects can override it by defining a `cache_identity` method.
+    """
+    if hasattr(obj, 'cache_identity'):
+        return obj.cache_identity()
+    cls = type(obj)
+    cfg = {k: repr(v) for k,v in sorted(vars(obj).items()) if not k.startswith('_')}
+    return f"{cls.__module__}.{cls.__qualname__}{cfg}"
+
+
+###
+# Serialization
+###
+
+def _encode(value) -> dict:
+    arrays = {}
+    if isinstance(value, dict):
+        meta = {'kind': 'dict', 'items': [_encode_item(f"i{i}", k, v, arrays) for i,(k,v) in enumerate(value.items())]}
+    else:
+        meta = {'kind': 'single', 'items': [_encode_item('i0', None, value, arrays)]}
+    arrays['__meta__'] = np.array(json.dumps(meta))
+    return arrays
+
+
+def _encode_item(prefix: str, key, value, arrays: dict) -> dict:
+    item = {'key': key, 'prefix': prefix}
+    if value is None:
+        item['type'] = 'none'
+    elif isinstance(value, np.ndarray):
+        item['type'] = 'array'
+        arrays[f'{prefix}_array'] = _checked(value)
+    elif isinstance(value, pd.DataFrame):
+        item['type'] = 'df'
+        item['index_name'] = value.index.name
+        arrays[f'{prefix}_index'] = _checked(value.index.to_numpy())
+        arrays[f'{prefix}_columns'] = _checked(np.asarray(value.columns.tolist()))
+        if value.shape[1] and value.dtypes.nunique() == 1:
+            item['layout'] = 'block'
+            arrays[f'{prefix}_values'] = _checked(value.to_numpy())
+        else:
+            item['layout'] = 'columns'
+            for i,(_,s) in enumerate(value.items()):
+                arrays[f'{prefix}_c{i}'] = _checked(s.to_numpy())
+    else:
+        raise TypeError(f"Cannot cache objects of type {type(value)}")
+    return item
+
+
+def _checked(arr: np.ndarray) -> np.ndarray:
+    # Object arrays would require pickling
+    if arr.dtype.hasobject:
+        raise TypeError("Cannot cache arrays of python objects")
+    return arr
+
+
+def _decode(npz) -> object:
+    meta = json.loads(str(npz['__meta__']))
+    items = [_decode_item(item, npz) for item in meta['items']]
+    if meta['kind'] == 'dict':
+        return dict(items)
+    return items[0][1]
+
+
+def _decode_item(item: dict, npz) -> tuple:
+    prefix = item['prefix']
+    match item['type']:
+        case 'none':
+            value = None
+        case 'array':
+            value = npz[f'{prefix}_array']
+        case 'df':
+            index = pd.Index(npz[f'{prefix}_index'], name=item['index_name'])
+            columns = pd.Index(npz[f'{prefix}_columns'])
+            if item['layout'] == 'block':
+                value = pd.DataFrame(npz[f'{prefix}_values'], index=index, columns=columns, copy=False)
+            else:
+                value = pd.DataFrame({c:npz[f'{prefix}_c{i}'] for i,c in enumerate(columns)}, index=index, copy=False)
+                value.columns = columns
+        case _:
+            raise ValueError(f"Unknown cache item type {item['type']}")
+    return item['key'], value
@@ -0,0 +1,322 @@
+from __future__ import annotations
+
+import glob
+import logging
+import os
+import sqlite3
+
+import pandas as pd
+
+from . import h5layout
+
+
+class RecordCatalog:
+    """
+    Persistent index of raw data files, their records and fragments, stored in a SQLite database.
+
+    For each file the catalog stores its path, size, modification time, run number and
+    operational environment; for each record its kind (TriggerRecord or TimeSlice), number and
+    sequence number; for each fragment its subsystem, source id, type and size. Files are scanned
+    with h5py, from the HDF5 links alone (see h5layout), and rescanned only when their size or
+    modification time change. Files that h5py can't open are logged and left out.
+
+    A RecordReader can then be populated from the catalog without opening any file
+    (see `RecordReader.add_files_from_catalog`), and records can be selected by content,
+    e.g. `catalog.find_records(run=27000, fragment_type='kTriggerPrimitive')`.
+
+    Args:
+        path (str): database file, created if it doesn't exist (e.g. next to the data)
+    """
+
+    # 2: record headers are no longer stored as fragments
+    # 3: record kind
+    schema_version = 3
+
+    _schema = '''
+        CREATE TABLE files (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            run_number INTEGER,
+            operational_environment TEXT
+        );
+        CREATE TABLE records (
+            id INTEGER PRIMARY KEY,
+            file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+            run_number INTEGER,
+            kind TEXT NOT NULL,
+            record_number INTEGER NOT NULL,
+            sequence INTEGER NOT NULL,
+            group_name TEXT NOT NULL
+        );
+        CREATE TABLE fragments (
+            record_id INTEGER NOT NULL REFERENCES records(id) ON DELETE CASCADE,
+            subsystem TEXT NOT NULL,
+            source_id INTEGER NOT NULL,
+            fragment_type TEXT NOT NULL,
+            subsystem_key TEXT NOT NULL,
+            fragment_type_key TEXT NOT NULL,
+            nbytes INTEGER NOT NULL
+        );
+        CREATE INDEX records_run_tr ON records(run_number, record_number);
+        CREATE INDEX records_file ON records(file_id);
+        CREATE INDEX fragments_record ON fragments(record_id);
+        CREATE INDEX fragments_type ON fragments(fragment_type_key);
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        self._init_schema()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _init_schema(self):
+        '''Create the tables, or recreate them if they were made by another schema version'''
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version == self.schema_version:
+            return
+        with self.conn:
+            for t in ('fragments', 'records', 'files'):
+                self.conn.execute(f'DROP TABLE IF EXISTS {t}')
+            self.conn.executescript(self._schema)
+            self.conn.execute(f'PRAGMA user_version = {self.schema_version}')
+
+    def update(self, paths) -> int:
+        '''
+        Add files to the catalog, or rescan them if they changed since they were cataloged
+
+        Files that can't be read are logged and skipped, and their previous entries removed.
+
+        Args:
+            paths (iterable): raw data file paths
+
+        Returns:
+            int: number of files scanned
+        '''
+        n_scanned = 0
+        for path in paths:
+            path = os.path.abspath(path)
+            try:
+                st = os.stat(path)
+                row = self.conn.execute('SELECT size, mtime_ns FROM files WHERE path = ?', (path,)).fetchone()
+                if row == (st.st_size, st.st_mtime_ns):
+                    continue
+                logging.info(f"Scanning {path}")
+                self._scan(path, st)
+            except OSError as e:
+                logging.warning(f"Skipping unreadable file {path}: {e}")
+                self.remove([path])
+                continue
+            n_scanned += 1
+        return n_scanned
+
+    def changed_files(self, paths=None, run: int = None) -> list:
+        '''
+        Cataloged files that were modified or removed since they were scanned, checked with a stat
+
+        Args:
+            paths (iterable, optional): restrict to these files. Defaults to None (all).
+            run (int, optional): restrict to the files of a run. Defaults to None.
+
+        Returns:
+            list: paths of the files whose size or modification time differ from the catalog, or that don't exist
+        '''
+        query, params = self._files_query('path, size, mtime_ns', paths, run)
+        changed = []
+        for path, size, mtime_ns in self.conn.execute(query, params).fetchall():
+            try:
+                st = os.stat(path)
+            except OSError:
+                changed.append(path)
+                continue
+            if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+                changed.append(path)
+        return changed
+
+    def update_directory(self, directory: str, pattern: str = '*.hdf5', recursive: bool = False) -> int:
+        '''
+        Add or rescan the files of a directory matching a pattern, and forget the ones that were removed
+
+        Args:
+            directory (str): data directory
+            pattern (str, optional): file name pattern. Defaults to '*.hdf5'.
+            recursive (bool, optional): include subdirectories. Defaults to False.
+
+        Returns:
+            int: number of files scanned
+        '''
+        pattern = os.path.join(directory, '**', pattern) if recursive else os.path.join(directory, pattern)
+        n_scanned = self.update(sorted(glob.glob(pattern, recursive=recursive)))
+        self.prune()
+        return n_scanned
+
+    def prune(self) -> int:
+        '''
+        Remove the files that don't exist anymore from the catalog
+
+        Returns:
+            int: number of files removed
+        '''
+        gone = [p for p, in self.conn.execute('SELECT path FROM files') if not os.path.exists(p)]
+        self.remove(gone)
+        return len(gone)
+
+    def remove(self, paths):
+        '''Remove files, with their records and fragments, from the catalog'''
+        with self.conn:
+            self.conn.executemany('DELETE FROM files WHERE path = ?', [(os.path.abspath(p),) for p in paths])
+
+    def _scan(self, path: str, st: os.stat_result):
+        '''(Re)build the entries of a file'''
+        import h5py
+
+        with h5py.File(path, 'r') as f:
+            run_number = f.attrs.get('run_number', None)
+            run_number = None if run_number is None else int(run_number)
+            op_env = f.attrs.get('operational_environment', None)
+            if isinstance(op_env, bytes):
+                op_env = op_env.decode()
+
+            records = []
+            for (tr, seq), name in sorted(h5layout.index_records(f).items()):
+                kind = h5layout.parse_record_group_name(name).kind
+                records.append((kind, tr, seq, name, h5layout.iter_fragments(f[name])))
+
+        with self.conn:
+            self.conn.execute('DELETE FROM files WHERE path = ?', (path,))
+            file_id = self.conn.execute(
+                'INSERT INTO files (path, size, mtime_ns, run_number, operational_environment) VALUES (?, ?, ?, ?, ?)',
+                (path, st.st_size, st.st_mtime_ns, run_number, op_env)
+            ).lastrowid
+            for kind, tr, seq, name, frags in records:
+                record_id = self.conn.execute(
+                    'INSERT INTO records (file_id, run_number, kind, record_number, sequence, group_name) VALUES (?, ?, ?, ?, ?, ?)',
+                    (file_id, run_number, kind, tr, seq, name)
+                ).lastrowid
+                self.conn.executemany(
+                    'INSERT INTO fragments VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [
+                        (record_id, fr.subsystem, fr.source_id, fr.fragment_type,
+                         h5layout.canonical_name(fr.subsystem), h5layout.canonical_name(fr.fragment_type), fr.nbytes)
+                        for fr in frags
+                    ]
+                )
+
+    def file_infos(self, paths=None, run: int = None) -> list:
+        '''
+        File information, as gathered by `RecordReader.add_file`
+
+        Only trigger records are listed, as RecordReader loads those alone.
+
+        Args:
+            paths (iterable, optional): restrict to these files. Defaults to None (all).
+            run (int, optional): restrict to the files of a run. Defaults to None.
+
+        Returns:
+            list: RawdataFileInfo of each file, ordered by run and path
+        '''
+        from .reader import RawdataFileInfo, openv_2_chmap
+
+        query, params = self._files_query('id, path, run_number, operational_environment', paths, run)
+        infos = []
+        for file_id, path, run_number, op_env in self.conn.execute(query, params).fetchall():
+            # One entry per record number, as in add_file
+            trs = [tr for tr, in self.conn.execute(
+                "SELECT DISTINCT record_number FROM records WHERE file_id = ? AND kind = 'TriggerRecord' ORDER BY record_number", (file_id,)
+            )]
+            infos.append(RawdataFileInfo(path, run_number, trs, openv_2_chmap.get(op_env, None)))
+        return infos
+
+    def _files_query(self, columns: str, paths=None, run: int = None) -> tuple:
+        '''Query of the files table, restricted to paths and run when given, ordered by run and path'''
+        query = f'SELECT {columns} FROM files'
+        where, params = [], []
+        if paths is not None:
+            paths = [os.path.abspath(p) for p in paths]
+            where.append(f"path IN ({','.join('?'*len(paths))})")
+            params += paths
+        if run is not None:
+            where.append('run_number = ?')
+            params.append(run)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        return query + ' ORDER BY run_number, path', params
+
+    def find_records(self, run: int = None, fragment_type: str = None, subsystem: str = None, source_id: int = None, kind: str = 'TriggerRecord') -> list:
+        '''
+        Records matching the criteria. Criteria left to None are not applied.
+
+        Args:
+            run (int, optional): run number. Defaults to None.
+            fragment_type (str, optional): records with at least one fragment of this type,
+                e.g. 'kTriggerPrimitive' or 'Trigger_Primitive'. Defaults to None.
+            subsystem (str, optional): records with at least one fragment of this subsystem. Defaults to None.
+            source_id (int, optional): records with a fragment of this source id. Defaults to None.
+            kind (str, optional): record kind, 'TriggerRecord' or 'TimeSlice'. Defaults to 'TriggerRecord'.
+
+        Returns:
+            list: sorted (run, tr) pairs
+        '''
+        query = 'SELECT DISTINCT r.run_number, r.record_number FROM records r'
+        where, params = [], []
+        if kind is not None:
+            where.append('r.kind = ?')
+            params.append(kind)
+        if run is not None:
+            where.append('r.run_number = ?')
+            params.append(run)
+        frag_where, frag_params = self._fragment_criteria(fragment_type, subsystem, source_id)
+        if frag_where:
+            where.append(f"EXISTS (SELECT 1 FROM fragments f WHERE f.record_id = r.id AND {' AND '.join(frag_where)})")
+            params += frag_params
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY r.run_number, r.record_number'
+        return [tuple(row) for row in self.conn.execute(query, params)]
+
+    def fragments(self, run: int = None, tr: int = None, fragment_type: str = None, subsystem: str = None, source_id: int = None) -> pd.DataFrame:
+        '''
+        Fragments matching the criteria. Criteria left to None are not applied.
+
+        Returns:
+            pd.DataFrame: one row per fragment (path, run_number, kind, record_number, sequence, subsystem, source_id, fragment_type, nbytes)
+        '''
+        query = '''
+            SELECT fi.path, r.run_number, r.kind, r.record_number, r.sequence, f.subsystem, f.source_id, f.fragment_type, f.nbytes
+            FROM fragments f JOIN records r ON f.record_id = r.id JOIN files fi ON r.file_id = fi.id
+        '''
+        where, params = self._fragment_criteria(fragment_type, subsystem, source_id)
+        if run is not None:
+            where.append('r.run_number = ?')
+            params.append(run)
+        if tr is not None:
+            where.append('r.record_number = ?')
+            params.append(tr)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY r.run_number, r.kind, r.record_number, r.sequence, f.source_id'
+        return pd.read_sql_query(query, self.conn, params=params)
+
+    @staticmethod
+    def _fragment_criteria(fragment_type, subsystem, source_id) -> tuple:
+        where, params = [], []
+        if fragment_type is not None:
+            where.append('f.fragment_type_key = ?')
+            params.append(h5layout.canonical_name(fragment_type))
+        if subsystem is not None:
+            where.append('f.subsystem_key = ?')
+            params.append(h5layout.canonical_name(subsystem))
+        if source_id is not None:
+            where.append('f.source_id = ?')
+            params.append(int(source_id))
+        return where, params
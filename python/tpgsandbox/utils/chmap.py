@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import threading
+
+import numpy as np
+
+
+class TPCChannelMapTables:
+    """
+    Numpy lookup tables built on top of a TPC channel map.
+
+    The detchannelmaps lookups are one call per channel. The tables query the channel map
+    once per (crate, slot, stream) and once per offline channel, store the results in numpy arrays
+    and serve all subsequent lookups vectorially.
+    Tables are filled on demand and are safe to use from multiple threads.
+    """
+
+    n_chan_per_stream = 64
+    # Channels beyond this limit (e.g. invalid channel markers) are not stored in the plane table
+    max_table_size = 1 << 20
+
+    def __init__(self, tpc_chan_map: detchannelmaps.TPCChannelMap):
+        self.tpc_chan_map = tpc_chan_map
+        self._stream_chans = {}
+        # (planes, known) pair, replaced as a whole when the table grows
+        self._plane_table = (np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=bool))
+        self._lock = threading.Lock()
+
+    def offline_channels(self, crate: int, slot: int, stream: int) -> np.ndarray:
+        """
+        Returns the offline channels of the 64 channels of a WIB stream
+
+        Args:
+            crate (int): crate number
+            slot (int): slot number
+            stream (int): stream number
+
+        Returns:
+            np.ndarray: offline channel ids (int64), indexed by the channel number in the stream
+        """
+        key = (int(crate), int(slot), int(stream))
+        chans = self._stream_chans.get(key, None)
+        if chans is None:
+            chans = np.array(
+                [self.tpc_chan_map.get_offline_channel_from_crate_slot_stream_chan(*key, c) for c in range(self.n_chan_per_stream)],
+                dtype=np.int64
+            )
+            chans.flags.writeable = False
+            self._stream_chans[key] = chans
+        return chans
+
+    def offline_channel(self, crate, slot, stream, chan) -> np.ndarray:
+        """
+        Vectorized version of get_offline_channel_from_crate_slot_stream_chan.
+
+        Arguments are broadcast against each other.
+
+        Returns:
+            np.ndarray: offline channel ids (int64)
+        """
+        crate, slot, stream, chan = np.broadcast_arrays(crate, slot, stream, chan)
+        res = np.empty(crate.shape, dtype=np.int64)
+        keys = np.stack([crate.ravel(), slot.ravel(), stream.ravel()], axis=1)
+        ukeys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        flat = res.reshape(-1)
+        flat_chan = chan.ravel()
+        for i, key in enumerate(ukeys):
+            sel = (inverse == i)
+            flat[sel] = self.offline_channels(*key)[flat_chan[sel]]
+        return res
+
+    def planes(self, channels) -> np.ndarray:
+        """
+        Vectorized version of get_plane_from_offline_channel
+
+        Args:
+            channels (array-like): offline channel ids
+
+        Returns:
+            np.ndarray: plane ids (uint8), with the same shape as channels
+        """
+        channels = np.asarray(channels)
+        if channels.size == 0:
+            return np.empty(channels.shape, dtype=np.uint8)
+
+        in_range = (channels >= 0) & (channels < self.max_table_size)
+        if not in_range.all():
+            res = np.empty(channels.shape, dtype=np.uint8)
+            res[in_range] = self.planes(channels[in_range])
+            out = channels[~in_range]
+            res[~in_range] = [self.tpc_chan_map.get_plane_from_offline_channel(int(c)) for c in out]
+            return res
+
+        planes, known = self._plane_table
+        if channels.max() >= len(planes) or not known[channels].all():
+            planes = self._fill_planes(channels)
+        return planes[channels]
+
+    def _fill_planes(self, channels: np.ndarray) -> np.ndarray:
+        """Add the planes of channels to the table"""
+        with self._lock:
+            old_planes, old_known = self._plane_table
+            size = max(len(old_planes), int(channels.max())+1)
+            planes = np.zeros(size, dtype=np.uint8)
+            known = np.zeros(size, dtype=bool)
+            planes[:len(old_planes)] = old_planes
+            known[:len(old_known)] = old_known
+
+            for c in np.unique(channels[~known[channels]]):
+                planes[c] = self.tpc_chan_map.get_plane_from_offline_channel(int(c))
+                known[c] = True
+
+            self._plane_table = (planes, known)
+            return planes
+
+
+_tables_cache = {}
+_tables_cache_lock = threading.Lock()
+
+def get_tpc_channel_map_tables(ch_map_id: str) -> TPCChannelMapTables:
+    """
+    Returns the lookup tables for the channel map ch_map_id.
+    Tables are created once per channel map id and cached.
+
+    Args:
+        ch_map_id (str): TPC channel map identifier
+
+    Returns:
+        TPCChannelMapTables: lookup tables
+    """
+    with _tables_cache_lock:
+        tables = _tables_cache.get(ch_map_id, None)
+        if tables is None:
+            import detchannelmaps
+            tables = TPCChannelMapTables(detchannelmaps.make_map(ch_map_id))
+            _tables_cache[ch_map_id] = tables
+        return tables
+
+
+def as_tpc_channel_map_tables(chmap) -> TPCChannelMapTables:
+    """
+    Returns chmap if it's already a TPCChannelMapTables, otherwise wraps it in one.
+
+    Args:
+        chmap (TPCChannelMapTables | detchannelmaps.TPCChannelMap): channel map
+
+    Returns:
+        TPCChannelMapTables: lookup tables
+    """
+    if isinstance(chmap, TPCChannelMapTables):
+        return chmap
+    return TPCChannelMapTables(chmap)
@@ -0,0 +1,177 @@
+"""
+Layout of the DUNE-DAQ HDF5 raw data files.
+
+Records are top-level groups named after the record type, number and sequence number,
+e.g. `TriggerRecord00042.0000` or `TimeSlice000042`.
+Fragments are datasets within the record group, named `<Subsystem>_0x<source id>_<FragmentType>`,
+e.g. `RawData/Detector_Readout_0x00000064_WIBEth`.
+Record headers follow the same naming (e.g. `RawData/TR_Builder_0x00000000_TriggerRecordHeader`)
+but are not fragments: they are recognised by their `Header` suffix.
+The functions below parse these names, so that records and fragments can be indexed and selected
+from the links of the file alone, without reading or decoding any data.
+"""
+import re
+from dataclasses import dataclass
+
+RECORD_GROUP_RE = re.compile(r'^(?P<kind>TriggerRecord|TimeSlice)(?P<number>\d+)(?:\.(?P<sequence>\d+))?$')
+FRAGMENT_DATASET_RE = re.compile(r'^(?P<subsystem>\w+?)_0x(?P<source_id>[0-9a-fA-F]{8})_(?P<fragment_type>\w+)$')
+
+
+@dataclass(frozen=True)
+class RecordGroupName:
+    """
+    Parsed record group name
+    """
+    kind: str
+    number: int
+    sequence: int
+
+
+@dataclass(frozen=True)
+class FragmentDataset:
+    """
+    Fragment dataset of a record group
+    """
+    path: str
+    subsystem: str
+    source_id: int
+    fragment_type: str
+    nbytes: int
+
+
+def canonical_name(name: str) -> str:
+    """
+    Normalize a subsystem or fragment type name for comparisons
+
+    Names appear as enum labels in the bindings (`kTriggerPrimitive`) and as strings in the
+    dataset names (`Trigger_Primitive`): both are reduced to `triggerprimitive`.
+
+    Args:
+        name (str): subsystem or fragment type name
+
+    Returns:
+        str: lower case name, without the 'k' prefix and underscores
+    """
+    if len(name) > 1 and name[0] == 'k' and name[1].isupper():
+        name = name[1:]
+    return name.replace('_', '').lower()
+
+
+def parse_record_group_name(name: str) -> RecordGroupName:
+    """
+    Parse a top-level record group name
+
+    Args:
+        name (str): group name, e.g. 'TriggerRecord00042.0000'
+
+    Returns:
+        RecordGroupName: kind, record number and sequence number, or None if name is not a record group
+    """
+    m = RECORD_GROUP_RE.match(name)
+    if m is None:
+        return None
+    return RecordGroupName(m['kind'], int(m['number']), int(m['sequence'] or 0))
+
+
+def is_header_dataset_name(name: str) -> bool:
+    """
+    Check whether a dataset holds a record header (TriggerRecordHeader, TimeSliceHeader)
+
+    Args:
+        name (str): dataset name (last path component)
+
+    Returns:
+        bool: True for record headers
+    """
+    return name.endswith('Header')
+
+
+def parse_fragment_dataset_name(name: str) -> tuple:
+    """
+    Parse a fragment dataset name
+
+    Args:
+        name (str): dataset name (last path component), e.g. 'Detector_Readout_0x00000064_WIBEth'
+
+    Returns:
+        tuple: (subsystem, source_id, fragment_type), or None if name is not a fragment dataset
+    """
+    m = FRAGMENT_DATASET_RE.match(name)
+    if m is None or is_header_dataset_name(name):
+        return None
+    return m['subsystem'], int(m['source_id'], 16), m['fragment_type']
+
+
+def index_records(h5file) -> dict:
+    """
+    Index the record groups of a file
+
+    Args:
+        h5file (h5py.File): raw data file
+
+    Returns:
+        dict: {(record number, sequence number): group name}
+    """
+    index = {}
+    for name in h5file.keys():
+        rec = parse_record_group_name(name)
+        if rec is not None:
+            index[(rec.number, rec.sequence)] = name
+    return index
+
+
+def iter_datasets(group) -> list:
+    """
+    List the datasets of a group and its subgroups
+
+    Args:
+        group (h5py.Group): group
+
+    Returns:
+        list: (path relative to group, h5py.Dataset) pairs
+    """
+    import h5py
+
+    datasets = []
+    group.visititems(lambda path, obj: datasets.append((path, obj)) if isinstance(obj, h5py.Dataset) else None)
+    return datasets
+
+
+def iter_fragments(record_group) -> list:
+    """
+    List the fragment datasets of a record group
+
+    Args:
+        record_group (h5py.Group): record group
+
+    Returns:
+        list: FragmentDataset of each fragment, other datasets (e.g. record headers) are skipped
+    """
+    frags = []
+    for path, ds in iter_datasets(record_group):
+        parsed = parse_fragment_dataset_name(path.rsplit('/', 1)[-1])
+        if parsed is not None:
+            frags.append(FragmentDataset(path, *parsed, ds.nbytes))
+    return frags
+
+
+def select_fragment(frag: FragmentDataset, source_ids=None, subsystems=None, fragment_types=None) -> bool:
+    """
+    Check whether a fragment passes the selection. Empty criteria select everything.
+
+    Args:
+        frag (FragmentDataset): fragment
+        source_ids (collection, optional): accepted source ids. Defaults to None.
+        subsystems (collection, optional): accepted subsystem names, in any form accepted by `canonical_name`. Defaults to None.
+        fragment_types (collection, optional): accepted fragment type names, in any form accepted by `canonical_name`. Defaults to None.
+
+    Returns:
+        bool: True if the fragment is selected
+    """
+    if source_ids and frag.source_id not in source_ids:
+        return False
+    if subsystems and canonical_name(frag.subsystem) not in {canonical_name(s) for s in subsystems}:
+        return False
+    if fragment_types and canonical_name(frag.fragment_type) not in {canonical_name(t) for t in fragment_types}:
+        return False
+    return True
@@ -1,12 +1,24 @@
+from __future__ import annotations
+
 import pandas as pd
+import numpy as np
+import logging
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from dataclasses import dataclass
-from rich import print
 from typing import Generator, Any
 
-import hdf5libs
-from . import unpacker
 from . import assembler
-import detchannelmaps
+from .chmap import TPCChannelMapTables, get_tpc_channel_map_tables
+from .cache import ProductDiskCache, RecordCache
+from .catalog import RecordCatalog
+
+# The DAQ bindings (hdf5libs, dataformats, channel maps) and rich are imported on first use,
+# to keep the startup of short scripts and of pool workers fast.
 
 openv_2_chmap = {
     'np04hd': 'PD2HDChannelMap',
@@ -25,16 +37,193 @@ class RawdataFileInfo:
     tr_list : list[int]
     tpc_chan_map_id : str
 
+class RawDataFilePool:
+    """
+    Bounded pool of open raw data files.
+
+    Opening a HDF5RawDataFile parses the file metadata, which is expensive for large files.
+    The pool keeps up to `max_open` files open and closes the least recently used one when
+    the limit is exceeded. Hits and misses are counted for monitoring.
+    """
+
+    def __init__(self, max_open: int = 8):
+        if max_open < 1:
+            raise ValueError(f"max_open must be at least 1, got {max_open}")
+        self.max_open = max_open
+        self.hits = 0
+        self.misses = 0
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, path):
+        return path in self._files
+
+    def get(self, path: str) -> hdf5libs.HDF5RawDataFile:
+        """
+        Returns the open raw data file for path, opening it if not already in the pool.
+
+        Args:
+            path (str): path of the raw data file
+
+        Returns:
+            hdf5libs.HDF5RawDataFile: the open file
+        """
+        with self._lock:
+            rdf = self._files.get(path, None)
+            if rdf is not None:
+                self.hits += 1
+                self._files.move_to_end(path)
+                return rdf
+
+            self.misses += 1
+            import hdf5libs
+            rdf = hdf5libs.HDF5RawDataFile(path)
+            self._files[path] = rdf
+            while len(self._files) > self.max_open:
+                # Dropping the last reference closes the file
+                self._files.popitem(last=False)
+            return rdf
+
+    def close(self, path: str):
+        """Close path if open"""
+        with self._lock:
+            self._files.pop(path, None)
+
+    def clear(self):
+        """Close all open files"""
+        with self._lock:
+            self._files.clear()
+
+    def stats(self) -> dict:
+        """Returns the pool usage counters"""
+        return {'open': len(self._files), 'max_open': self.max_open, 'hits': self.hits, 'misses': self.misses}
+
+
+class ProductLoadLock:
+    """
+    Re-entrant lock of the lazy products of a record.
+
+    The products of a record (fragments and assembled products) share one lock, as loading
+    an assembled product loads fragments. Callbacks deferred while the lock is held run in
+    the loading thread once its outermost acquisition is released, so that they never run
+    while other threads wait for the products.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def __enter__(self):
+        self._lock.acquire()
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0:
+            self._local.deferred = []
+        self._local.depth = depth+1
+        return self
+
+    def __exit__(self, *exc):
+        self._local.depth -= 1
+        deferred = self._local.deferred if self._local.depth == 0 else ()
+        self._lock.release()
+        for func, args in deferred:
+            func(*args)
+
+    def defer(self, func, *args):
+        """Call func(*args) when the outermost acquisition is released. Must be called with the lock held."""
+        self._local.deferred.append((func, args))
+
+
+class LazyProducts(Mapping):
+    """
+    Read-only mapping of products, each computed on first access and then memoized.
+
+    The loader is called with the product name and returns the product,
+    or None if the product is not available in the record.
+    `on_load`, if given, is called with the footprint in bytes of each product loaded
+    (e.g. to account for its memory), once the outermost load holding `lock` has returned.
+    Mappings whose loaders depend on each other should share their lock.
+    """
+
+    def __init__(self, names, loader, on_load=None, lock: ProductLoadLock = None):
+        self._names = list(names)
+        self._loader = loader
+        self._on_load = on_load
+        self._values = {}
+        self._lock = lock if lock is not None else ProductLoadLock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._values:
+                if name not in self._names:
+                    raise KeyError(name)
+                value = self._loader(name)
+                self._values[name] = value
+                if self._on_load is not None:
+                    self._lock.defer(self._on_load, _nbytes(value))
+            value = self._values[name]
+
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __iter__(self):
+        return (n for n in self._names if n in self)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(loaded={list(self.loaded())}, pending={[n for n in self._names if n not in self._values]})"
+
+    def loaded(self) -> dict:
+        """Returns the products loaded so far, without triggering any load"""
+        with self._lock:
+            return {k:v for k,v in self._values.items() if v is not None}
+
+    def materialize(self) -> dict:
+        """Load all products and return them as a dict"""
+        return dict(self.items())
+
+
 @dataclass
 class RecordData:
     """
     DAQ Record Data 
+
+    `frags` and `record` are either dicts or LazyProducts, 
+    in which case each product is unpacked and assembled on first access.
     """
 
     frags : dict
     record : dict
     tpc_chan_map_id : str
 
+    def nbytes(self) -> int:
+        """
+        Returns the memory footprint of the unpacked and assembled products in bytes
+        """
+        return _nbytes(self.frags) + _nbytes(self.record)
+
+
+def _nbytes(obj) -> int:
+    """Approximate memory footprint of (nested containers of) dataframes and arrays"""
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=False).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(index=True, deep=False))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, LazyProducts):
+        return _nbytes(obj.loaded())
+    if isinstance(obj, dict):
+        return sum(_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(v) for v in obj)
+    return 0
+
     
 class RecordReader():
     """
@@ -45,21 +234,36 @@ class RecordReader():
     The operational environment for each file is stored as well for later use.
 
     The fragment unpacking and assemble into Dataframes is configured by adding "products".
-    
-    
+
+    Open files are kept in a bounded pool (see RawDataFilePool), so that consecutive records
+    from the same file don't pay the file opening cost. `max_open_files` sets the pool size.
+
+    Optionally, unpacked and assembled products are stored in a `disk_cache` (see ProductDiskCache)
+    and reloaded from there instead of being decoded again.
+    Recently loaded records can also be kept in memory, in a `record_cache` (see RecordCache).
     """
 
-    def __init__(self, files: list[str] = None):
+    def __init__(self, files: list[str] = None, max_open_files: int = 8, disk_cache: ProductDiskCache = None, record_cache: RecordCache = None):
+        self.file_pool = RawDataFilePool(max_open_files)
+        self.disk_cache = disk_cache
+        self.record_cache = record_cache
         self.raw_files = {}
         self.record_list = {}
-        self.tpc_chan_map_cache = {}
-        self.unpacker = unpacker.UnpackerService()
+        self._unpacker = None
         self.assembler = assembler.AssemblerService()
         if not files is None:
             for f in files:
                 self.add_file(f)
 
 
+    @property
+    def unpacker(self) -> unpacker.UnpackerService:
+        '''Unpacker service, created on first use'''
+        if self._unpacker is None:
+            from .unpacker import UnpackerService
+            self._unpacker = UnpackerService()
+        return self._unpacker
+
     def get_tpc_channel_map(self, ch_map_id) -> detchannelmaps.TPCChannelMap:
         """
         Returns the channel map object associated to ch_map_id from the local cache.
@@ -71,8 +275,21 @@ class RecordReader():
         Returns:
             detchannelmaps.TPCChannelMap: The channel map object
         """
-        return self.tpc_chan_map_cache.setdefault(ch_map_id, detchannelmaps.make_map(ch_map_id))
-            
+        return get_tpc_channel_map_tables(ch_map_id).tpc_chan_map
+
+    def get_tpc_channel_map_tables(self, ch_map_id) -> TPCChannelMapTables:
+        """
+        Returns the vectorized lookup tables of the channel map associated to ch_map_id.
+        Tables are shared by all readers and unpackers in the process.
+
+        Args:
+            ch_map_id (str): TPC channel map identifier
+
+        Returns:
+            TPCChannelMapTables: The channel map lookup tables
+        """
+        return get_tpc_channel_map_tables(ch_map_id)
+
 
     def add_file(self, path):
         '''
@@ -82,7 +299,7 @@ class RecordReader():
         if path in self.raw_files:
             raise KeyError(f"file {path} already added")
         
-        rdf = hdf5libs.HDF5RawDataFile(path)
+        rdf = self.file_pool.get(path)
         op_env = rdf.get_attribute('operational_environment')
         run_number=rdf.get_int_attribute('run_number')
         
@@ -97,10 +314,46 @@ class RecordReader():
             tpc_chan_map_id
         )
 
-        self.raw_files[path] = rfi
+        self._add_file_info(rfi)
+
+    def add_files_from_catalog(self, catalog: RecordCatalog, paths=None, run: int = None, rescan: bool = True):
+        '''
+        Add files from a RecordCatalog, without opening them
+
+        The files are checked against the catalog with a stat: the ones modified since they were
+        cataloged are rescanned (or reported only, when rescan is False), the removed ones are skipped.
+
+        Args:
+            catalog (RecordCatalog): catalog of the files
+            paths (iterable, optional): files to add. Defaults to None (all the files in the catalog).
+            run (int, optional): add only the files of this run. Defaults to None.
+            rescan (bool, optional): rescan the modified files. Defaults to True.
+        '''
+        changed = catalog.changed_files(paths, run)
+        missing = {p for p in changed if not os.path.exists(p)}
+        for p in sorted(missing):
+            logging.warning(f"Skipping {p}: cataloged but not found")
+        modified = [p for p in changed if p not in missing]
+        if rescan:
+            catalog.update(modified)
+        else:
+            for p in modified:
+                logging.warning(f"{p} changed since it was cataloged, its records may be out of date")
+
+        for rfi in catalog.file_infos(paths, run):
+            if rfi.path in missing:
+                continue
+            if rfi.path in self.raw_files:
+                raise KeyError(f"file {rfi.path} already added")
+            self._add_file_info(rfi)
+
+    def _add_file_info(self, rfi: RawdataFileInfo):
+        '''Register the trigger records of a file without opening it'''
+
+        self.raw_files[rfi.path] = rfi
 
         # Warning, missing protection against existing 
-        self.record_list.setdefault(run_number,{}).update( { tr:rfi for tr in tr_list} )
+        self.record_list.setdefault(rfi.run_number,{}).update( { tr:rfi for tr in rfi.tr_list} )
 
     
     def remove_file(self, path):
@@ -109,6 +362,7 @@ class RecordReader():
             raise KeyError(f"file {path} not known")
 
         r = self.raw_files.pop(path)
+        self.file_pool.close(path)
 
         for i in r.tr_list:
             del self.record_list[r.run_number][i]
@@ -120,8 +374,51 @@ class RecordReader():
         if assembler is not None:
             self.assembler.add(product, product, assembler)
 
-    def load_record(self, run, tr):
-        '''Load a trigger record from a specific run'''
+    def load_record(self, run, tr, lazy: bool = True) -> RecordData:
+        '''Load a trigger record from a specific run
+
+        Args:
+            run (int): run number
+            tr (int): trigger record number
+            lazy (bool, optional): unpack and assemble each product on first access. Defaults to True.
+        '''
+        return self._get_record(run, tr, self._find_record(run, tr), lazy)
+
+    def _get_record(self, run, tr, r: RawdataFileInfo, lazy: bool) -> RecordData:
+        '''Load a record through the in-memory record cache'''
+        if self.record_cache is None:
+            return self._load_record(r, tr, lazy)
+
+        key = (run, tr)
+        data = self.record_cache.get(key)
+        if data is None:
+            if lazy:
+                # Products are charged to the cache as they are decoded
+                data = self._lazy_record(r, tr, on_load=lambda nbytes: self.record_cache.charge(key, data, nbytes))
+            else:
+                data = self._load_record(r, tr, lazy)
+            self.record_cache.put(key, data)
+        elif not lazy and isinstance(data.record, LazyProducts):
+            # Cached lazily: decode the remaining products now, in the calling thread
+            data = RecordData(data.frags.materialize(), data.record.materialize(), data.tpc_chan_map_id)
+            self.record_cache.put(key, data)
+        return data
+
+    def evict_record(self, run, tr):
+        '''Remove a record from the in-memory record cache'''
+        if self.record_cache is not None:
+            self.record_cache.evict((run, tr))
+
+    def clear_record_cache(self):
+        '''Remove all records from the in-memory record cache'''
+        if self.record_cache is not None:
+            self.record_cache.clear()
+
+    def get_record_cache_stats(self) -> dict:
+        '''Get the in-memory record cache counters'''
+        return self.record_cache.stats() if self.record_cache is not None else {}
+
+    def _find_record(self, run, tr) -> RawdataFileInfo:
 
         if not run in self.record_list:
             raise KeyError(f"Run {run} not found")
@@ -129,12 +426,28 @@ class RecordReader():
         if not tr in self.record_list[run]:
             raise KeyError(f"Trigger record {tr} not found in run {run}")
 
-        r = self.record_list[run][tr]
+        return self.record_list[run][tr]
+
+    def _open(self, r: RawdataFileInfo):
+        if r.path not in self.file_pool:
+            from rich import print
+            print(f"Opening {r.path}")
+        return self.file_pool.get(r.path)
+
+    def _load_record(self, r: RawdataFileInfo, tr: int, lazy: bool = False) -> RecordData:
 
-        print(f"Opening {r.path}")
-        rdf = hdf5libs.HDF5RawDataFile(r.path)
+        if lazy:
+            return self._lazy_record(r, tr)
+
+        if self.disk_cache is not None:
+            # Go through the per-product cache
+            data = self._lazy_record(r, tr)
+            return RecordData(data.frags.materialize(), data.record.materialize(), r.tpc_chan_map_id)
+
+        rdf = self._open(r)
 
         # Run unpackers
+        from rich import print
         print(f"Loading record {tr}")
         df_frags = self.unpacker.unpack(rdf, tr, tpc_chan_map_id=r.tpc_chan_map_id)
 
@@ -143,12 +456,223 @@ class RecordReader():
 
         return RecordData(df_frags, df_tr, r.tpc_chan_map_id )
 
+    def _lazy_record(self, r: RawdataFileInfo, tr: int, on_load=None) -> RecordData:
+
+        def unpack_product(name):
+            from rich import print
+            print(f"Loading {name} from record {tr}")
+            res = self.unpacker.unpack(self._open(r), tr, tpc_chan_map_id=r.tpc_chan_map_id, products=[name])
+            return res.get(name, None)
+
+        def load_frags(name):
+            return self._cached(r, tr, 'frags', name, [self.unpacker.get(name)], lambda: unpack_product(name))
+
+        def load_record(name):
+            data_id, asm = self.assembler.get(name)
+            producers = [self.unpacker.fragment_unpackers.get(data_id, None), asm]
+            return self._cached(r, tr, 'record', name, producers, lambda: self.assembler.assemble_product(frags, name))
+
+        lock = ProductLoadLock()
+        frags = LazyProducts(self.unpacker.fragment_unpackers, load_frags, on_load, lock)
+        record = LazyProducts(self.assembler.assemblers, load_record, on_load, lock)
+
+        return RecordData(frags, record, r.tpc_chan_map_id)
+
+    def _cached(self, r: RawdataFileInfo, tr: int, kind: str, name: str, producers: list, make):
+        '''Get a product from the disk cache, or make it and store it in the cache'''
+        if self.disk_cache is None:
+            return make()
+
+        key = self.disk_cache.make_key(r.path, r.run_number, tr, kind, name, producers)
+        try:
+            return self.disk_cache.get(key)
+        except KeyError:
+            pass
+
+        value = make()
+        self.disk_cache.put(key, value)
+        return value
+
     def get_records(self) -> dict:
         '''Get the records known to the reader'''
         return { run:list(tr_infos.keys()) for run,tr_infos in self.record_list.items() }
 
-    def iter_records(self) -> Generator[Any,Any,Any]:
-        '''Iterate over all trigger records of all runs'''
+    def iter_records(self, load: bool = False, prefetch: int = 0, max_prefetch_bytes: int = None) -> Generator[Any,Any,Any]:
+        '''Iterate over all trigger records of all runs
+
+        Args:
+            load (bool, optional): yield (run, tr, RecordData) instead of (run, tr). Defaults to False.
+            prefetch (int, optional): number of records loaded in background ahead of the current one, see `iter_load`. Defaults to 0.
+            max_prefetch_bytes (int, optional): memory cap for the prefetched records, see `iter_load`. Defaults to None.
+        '''
+        if load:
+            yield from self.iter_load(self.iter_records(), prefetch, max_prefetch_bytes)
+            return
+
         for run,tr_infos in self.record_list.items():
             for tr in tr_infos:
-                yield run,tr
\ No newline at end of file
+                yield run,tr
+
+    def iter_load(self, records, prefetch: int = 2, max_prefetch_bytes: int = None) -> Generator[Any,Any,Any]:
+        '''Load a sequence of trigger records, yielding (run, tr, RecordData)
+
+        With prefetch > 0 the next records are read and unpacked by a background thread 
+        while the caller processes the current one. Otherwise records are loaded lazily (see `load_record`).
+        Prefetching stops when the records already loaded and waiting to be consumed
+        exceed max_prefetch_bytes, so that memory usage stays bounded for large records.
+
+        Args:
+            records (iterable): (run, tr) pairs to load
+            prefetch (int, optional): number of records loaded ahead of the current one. Defaults to 2.
+            max_prefetch_bytes (int, optional): memory cap for the records waiting to be consumed. Defaults to None (no cap).
+        '''
+        records = ((run, tr, self._find_record(run, tr)) for run, tr in records)
+
+        if prefetch < 1:
+            for run, tr, r in records:
+                yield run, tr, self._get_record(run, tr, r, lazy=True)
+            return
+
+        xtor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tpgsb-prefetch')
+        pending = deque()
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) <= prefetch and not self._prefetch_cap_reached(pending, max_prefetch_bytes):
+                    try:
+                        run, tr, r = next(records)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending.append((run, tr, xtor.submit(self._get_record, run, tr, r, False)))
+
+                if not pending:
+                    return
+
+                run, tr, f = pending.popleft()
+                yield run, tr, f.result()
+        finally:
+            xtor.shutdown(wait=True, cancel_futures=True)
+
+    def load_records(self, records, max_workers: int = None, ordered: bool = True, mp_context=None) -> Generator[Any,Any,Any]:
+        '''Load a list of trigger records in parallel on a pool of processes, yielding (run, tr, RecordData)
+
+        Each worker process holds its own reader, with the same files, products and disk cache as this one,
+        and therefore its own open files and channel maps.
+        Workers run without an in-memory record cache: each record is loaded by one worker only,
+        and the records they load are not added to this reader's record cache.
+        Unpackers and assemblers must be picklable.
+
+        Args:
+            records (iterable): (run, tr) pairs to load
+            max_workers (int, optional): number of worker processes. Defaults to the number of cores.
+            ordered (bool, optional): yield the records in the requested order rather than as they complete. Defaults to True.
+            mp_context (optional): multiprocessing context used to start the workers.
+                Defaults to None ('spawn': forked workers would inherit the HDF5 library state and open files of this process).
+        '''
+        yield from self._run_on_workers(_worker_load_record, (), records, max_workers, ordered, mp_context)
+
+    def map_records(self, func, records, max_workers: int = None, ordered: bool = True, mp_context=None) -> Generator[Any,Any,Any]:
+        '''Apply a function to a list of trigger records on a pool of processes, yielding (run, tr, result)
+
+        The records are loaded and processed in the workers, as in `load_records`,
+        and only the results of `func(run, tr, data)` are sent back.
+        func must be picklable (a module level function or a functools.partial of one),
+        data is a lazy RecordData: only the products accessed by func are unpacked.
+
+        Args:
+            func (callable): function of (run, tr, RecordData)
+            records (iterable): (run, tr) pairs to process
+            max_workers (int, optional): number of worker processes. Defaults to the number of cores.
+            ordered (bool, optional): yield the results in the requested order rather than as they complete. Defaults to True.
+            mp_context (optional): multiprocessing context used to start the workers.
+                Defaults to None ('spawn': forked workers would inherit the HDF5 library state and open files of this process).
+        '''
+        yield from self._run_on_workers(_worker_map_record, (func,), records, max_workers, ordered, mp_context)
+
+    def _run_on_workers(self, task, task_args: tuple, records, max_workers: int, ordered: bool, mp_context) -> Generator[Any,Any,Any]:
+        '''Submit task(*task_args, run, tr) for each record to a pool of worker readers'''
+        records = list(records)
+        # Check records before starting the workers
+        for run, tr in records:
+            self._find_record(run, tr)
+
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        max_workers = min(max_workers, len(records)) or 1
+        max_pending = 2*max_workers
+        if mp_context is None:
+            # HDF5 is not fork-safe
+            mp_context = multiprocessing.get_context('spawn')
+
+        initargs = (
+            list(self.raw_files.values()),
+            self.unpacker.fragment_unpackers,
+            self.assembler.assemblers,
+            self.file_pool.max_open,
+            self.disk_cache,
+        )
+
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context, initializer=_init_worker, initargs=initargs) as xtor:
+            todo = iter(records)
+            pending = deque()
+            try:
+                while True:
+                    # Limit the number of results waiting to be consumed
+                    for run, tr in todo:
+                        pending.append(xtor.submit(task, *task_args, run, tr))
+                        if len(pending) >= max_pending:
+                            break
+
+                    if not pending:
+                        return
+
+                    if ordered:
+                        f = pending.popleft()
+                    else:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        f = next(f for f in pending if f in done)
+                        pending.remove(f)
+
+                    yield f.result()
+            finally:
+                for f in pending:
+                    f.cancel()
+
+    @staticmethod
+    def _prefetch_cap_reached(pending, max_bytes) -> bool:
+        '''Check the memory footprint of the records loaded and not yet consumed'''
+        if max_bytes is None or not pending:
+            return False
+        size = sum(f.result().nbytes() for _,_,f in pending if f.done() and f.exception() is None)
+        return size >= max_bytes
+
+    def get_file_pool_stats(self) -> dict:
+        '''Get the open file pool counters'''
+        return self.file_pool.stats()
+
+
+###
+# Process pool workers
+###
+
+_worker_reader = None
+
+def _init_worker(raw_files: list, fragment_unpackers: dict, assemblers: dict, max_open_files: int, disk_cache: ProductDiskCache):
+    '''Create the worker-local reader, without a record cache (see `RecordReader.load_records`)'''
+    global _worker_reader
+
+    rr = RecordReader(max_open_files=max_open_files, disk_cache=disk_cache)
+    for rfi in raw_files:
+        rr._add_file_info(rfi)
+    rr.unpacker.fragment_unpackers.update(fragment_unpackers)
+    rr.assembler.assemblers.update(assemblers)
+    _worker_reader = rr
+
+
+def _worker_load_record(run, tr) -> tuple:
+    return run, tr, _worker_reader.load_record(run, tr, lazy=False)
+
+
+def _worker_map_record(func, run, tr) -> tuple:
+    return run, tr, func(run, tr, _worker_reader.load_record(run, tr, lazy=True))
@@ -0,0 +1,135 @@
+"""
+Numpy views of the trgdataformats objects stored in trigger fragments.
+
+The dtypes mirror the in-memory layout of the C++ structures (natural alignment),
+so that fragment payloads can be decoded with numpy without creating python overlay objects.
+The layouts are checked against the trgdataformats bindings by the unpackers before use.
+"""
+import numpy as np
+from numba import njit
+
+# trgdataformats::TriggerPrimitive
+trigger_primitive_dtype = np.dtype([
+    ('version', np.uint16),
+    ('time_start', np.uint64),
+    ('time_peak', np.uint64),
+    ('time_over_threshold', np.uint64),
+    ('channel', np.uint32),
+    ('adc_integral', np.uint32),
+    ('adc_peak', np.uint16),
+    ('detid', np.uint16),
+    ('type', np.int32),
+    ('algorithm', np.int32),
+    ('flag', np.uint16),
+], align=True)
+
+# trgdataformats::TriggerActivityData
+trigger_activity_data_dtype = np.dtype([
+    ('version', np.uint16),
+    ('time_start', np.uint64),
+    ('time_end', np.uint64),
+    ('time_peak', np.uint64),
+    ('time_activity', np.uint64),
+    ('channel_start', np.int32),
+    ('channel_end', np.int32),
+    ('channel_peak', np.int32),
+    ('adc_integral', np.uint64),
+    ('adc_peak', np.uint16),
+    ('detid', np.uint16),
+    ('type', np.int32),
+    ('algorithm', np.int32),
+], align=True)
+
+# trgdataformats::TriggerCandidateData
+trigger_candidate_data_dtype = np.dtype([
+    ('version', np.uint16),
+    ('time_start', np.uint64),
+    ('time_end', np.uint64),
+    ('time_candidate', np.uint64),
+    ('detid', np.uint16),
+    ('type', np.int32),
+    ('algorithm', np.int32),
+], align=True)
+
+
+def variable_size_header_dtype(data_dtype: np.dtype) -> np.dtype:
+    """
+    Header of the variable size trgdataformats objects (TriggerActivity, TriggerCandidate):
+    the object data followed by the number of inputs. The inputs follow the header.
+
+    Args:
+        data_dtype (np.dtype): dtype of the object data
+
+    Returns:
+        np.dtype: header dtype
+    """
+    return np.dtype([('data', data_dtype), ('n_inputs', np.uint64)], align=True)
+
+
+trigger_activity_dtype = variable_size_header_dtype(trigger_activity_data_dtype)
+trigger_candidate_dtype = variable_size_header_dtype(trigger_candidate_data_dtype)
+
+
+@njit(cache=True)
+def scan_offsets(buf, header_size, n_inputs_offset, input_size):
+    """
+    Find the offsets of a sequence of variable size objects packed in buf.
+
+    Args:
+        buf (np.array): payload bytes (uint8)
+        header_size (int): size of the fixed part of the object
+        n_inputs_offset (int): offset of the uint64 number of inputs in the header
+        input_size (int): size of each input
+
+    Returns:
+        np.array: offsets of the objects (int64)
+
+    Raises:
+        ValueError: if the payload is truncated, or the number of inputs of an object
+            runs past the end of buf
+    """
+    offsets = np.empty(len(buf)//header_size+1, dtype=np.int64)
+    n = 0
+    o = 0
+    while o < len(buf):
+        if o + header_size > len(buf):
+            raise ValueError("Truncated object header at the end of the payload")
+        offsets[n] = o
+        n += 1
+        p = o + n_inputs_offset
+        n_inputs = 0
+        for k in range(8):
+            n_inputs |= np.int64(buf[p+k]) << (8*k)
+        # Checked before the multiplication, which a corrupt count could overflow
+        remaining = len(buf) - o - header_size
+        if n_inputs < 0 or (input_size > 0 and n_inputs > remaining//input_size):
+            raise ValueError("Object inputs run past the end of the payload")
+        o += header_size + n_inputs*input_size
+    return offsets[:n]
+
+
+def gather_headers(buf: np.ndarray, offsets: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """
+    Return the headers at offsets in buf as a structured array.
+
+    When the objects are evenly spaced the result is a strided view of buf,
+    otherwise the header bytes are gathered in a single vectorized copy.
+
+    Args:
+        buf (np.ndarray): payload bytes (uint8)
+        offsets (np.ndarray): header offsets, as returned by scan_offsets
+        dtype (np.dtype): header dtype
+
+    Returns:
+        np.ndarray: structured array of headers
+    """
+    if len(offsets) == 0:
+        return np.empty(0, dtype=dtype)
+
+    strides = np.diff(offsets)
+    if len(offsets) == 1 or (strides[0] >= dtype.itemsize and np.all(strides == strides[0])):
+        stride = int(strides[0]) if len(strides) else dtype.itemsize
+        return np.ndarray(shape=(len(offsets),), dtype=dtype, buffer=buf, offset=int(offsets[0]), strides=(stride,))
+
+    raw = buf[offsets[:, None] + np.arange(dtype.itemsize)]
+    return raw.view(dtype)[:, 0]
@@ -1,9 +1,10 @@
 # import pathlib
+from __future__ import annotations
+
 import collections
 import fddetdataformats
 import trgdataformats
 import daqdataformats
-import detchannelmaps
 
 import logging
 
@@ -13,6 +14,9 @@ import numpy as np
 import rawdatautils.unpack.wibeth as wibeth_unpack
 import rawdatautils.unpack.triggerprimitive as tp_unpack
 
+from .chmap import get_tpc_channel_map_tables
+from . import trgdtypes
+
 from rich import print
 from abc import ABC, abstractmethod
 from typing import Any
@@ -21,15 +25,21 @@ class UnpakerContext:
     """Class representing the context in which a fragment is unpacked.
 
     tpc_chan_map: TPC channel map object
+    tpc_chan_map_tables: vectorized lookup tables for tpc_chan_map
     """
     def __init__(self):
         self.tpc_chan_map = None
+        self.tpc_chan_map_tables = None
 
 class FragmentUnpacker(ABC):
 
     def __init__(self):
         pass
 
+    def match_source_id(self, sid: daqdataformats.SourceID) -> bool:
+        """Preselection on the source id alone, used to skip reading fragments that can't match"""
+        return True
+
     @abstractmethod
     def match(self, frag: daqdataformats.Fragment, sid: daqdataformats.SourceID) -> bool:
         pass
@@ -45,6 +55,9 @@ class WIBEthFragmentNumpyUnpacker(FragmentUnpacker):
         super().__init__()
     
 
+    def match_source_id(self, sid: daqdataformats.SourceID) -> bool:
+        return sid.subsystem == daqdataformats.SourceID.kDetectorReadout
+
     def match(self, frag: daqdataformats.Fragment, sid: daqdataformats.SourceID) -> bool:
         return (frag.get_fragment_type() == daqdataformats.FragmentType.kWIBEth) and (sid.subsystem == daqdataformats.SourceID.kDetectorReadout)
     
@@ -89,28 +102,44 @@ class WIBEthFragmentPandasUnpacker(WIBEthFragmentNumpyUnpacker):
 
         logging.info(f"ts: 0x{ts:016x} (15 lsb: 0x{ts&0x7fff:04x}) cd_ts_0: 0x{wh.colddata_timestamp_0:04x} cd_ts_1: 0x{wh.colddata_timestamp_1:04x} crate: {crate_no}, slot: {slot_no}, stream: {stream_no}")
 
-        if ctx.tpc_chan_map:
-            off_chans = [ctx.tpc_chan_map.get_offline_channel_from_crate_slot_stream_chan(crate_no, slot_no, stream_no, c) for c in range(n_chan_per_stream)]
+        if ctx.tpc_chan_map_tables is not None:
+            off_chans = ctx.tpc_chan_map_tables.offline_channels(crate_no, slot_no, stream_no)
         else:
-            first_chan += (stream_no >> 6)*n_chan_per_stream*n_streams_per_link
-            off_chans = [c for c in range(first_chan,first_chan+n_chan_per_stream)]
+            first_chan = (stream_no >> 6)*n_chan_per_stream*n_streams_per_link
+            off_chans = np.arange(first_chan,first_chan+n_chan_per_stream)
 
         ts, adcs = super().unpack(frag, ctx)
 
         if ts is None or adcs is None:
             return None
 
-        df = pd.DataFrame(collections.OrderedDict([('ts', ts)]+[(off_chans[c], adcs[:,c]) for c in range(64)]))
-        df = df.set_index('ts')
+        df = pd.DataFrame(adcs[:,:n_chan_per_stream], index=pd.Index(ts, name='ts'), columns=off_chans)
 
         return df
 
 
 class TPFragmentPandasUnpacker(FragmentUnpacker):
+    """
+    Trigger Primitive fragment unpacker.
 
-    def __init__(self):
+    The fragment payload is read as an array of TPs (see `trgdtypes.trigger_primitive_dtype`)
+    and the requested columns are views of that array: the TPs are not decoded or copied.
+    Only the `plane` column, derived from the channel map, is allocated.
+    Large fragments (e.g. TPStream) can be unpacked in chunks with `iter_chunks`.
+
+    Args:
+        columns (list[str], optional): columns to unpack. Defaults to all the columns in `dtypes`.
+        as_numpy (bool, optional): return numpy structured arrays instead of DataFrames. Defaults to False.
+    """
+
+    def __init__(self, columns: list[str] = None, as_numpy: bool = False):
         super().__init__()
+        self.columns = list(columns) if columns is not None else [n for (n,_) in self.dtypes()]
+        self.as_numpy = as_numpy
     
+    def match_source_id(self, sid: daqdataformats.SourceID) -> bool:
+        return sid.subsystem == daqdataformats.SourceID.kTrigger
+
     def match(self, frag: daqdataformats.Fragment, sid: daqdataformats.SourceID) -> bool:
         return (frag.get_fragment_type() == daqdataformats.FragmentType.kTriggerPrimitive) and (sid.subsystem == daqdataformats.SourceID.kTrigger)
     
@@ -131,16 +160,67 @@ class TPFragmentPandasUnpacker(FragmentUnpacker):
     def empty(cls) -> pd.DataFrame:
         return pd.DataFrame(np.empty(0, cls.dtypes()))
     
-    def unpack(self, frag: daqdataformats.Fragment, ctx: UnpakerContext) -> pd.DataFrame:
-        # Convert fragment into a numpy record array
-        arr = tp_unpack.get_tp_array(frag)
-        # and into a dataframe
-        df = pd.DataFrame(arr)
-        # Filter extra fields
-        df = df.filter(items=[ n for (n,_) in self.dtypes()])
+    def unpack(self, frag: daqdataformats.Fragment, ctx: UnpakerContext) -> pd.DataFrame | np.ndarray:
+        return self._project(self._tp_array(frag), ctx)
+
+    def iter_chunks(self, frag: daqdataformats.Fragment, ctx: UnpakerContext, chunk_size: int = 1 << 16):
+        """Unpack the fragment in chunks of chunk_size TPs
+
+        Each chunk is a slice of the payload view: only the plane column of the chunk is allocated.
+
+        Args:
+            frag (daqdataformats.Fragment): TP fragment
+            ctx (UnpakerContext): unpacking context
+            chunk_size (int, optional): number of TPs per chunk. Defaults to 65536.
+
+        Yields:
+            pd.DataFrame | np.ndarray: unpacked TPs
+        """
+        tps = self._tp_array(frag)
+        for i in range(0, len(tps), chunk_size):
+            yield self._project(tps[i:i+chunk_size], ctx)
+
+    def _tp_array(self, frag: daqdataformats.Fragment) -> np.ndarray:
+        """TPs of the fragment, as a structured view of the payload
+
+        The numpy layout is checked against the trgdataformats overlay of the first TP.
+        If it doesn't match, the TPs are decoded (and copied) by rawdatautils.
+        """
+        dtype = trgdtypes.trigger_primitive_dtype
+        buf = np.frombuffer(frag.get_data_bytes(), dtype=np.uint8)
+        if dtype.itemsize == trgdataformats.TriggerPrimitive.sizeof() and len(buf) % dtype.itemsize == 0:
+            tps = buf.view(dtype)
+            if len(tps) == 0:
+                return tps
+            first = trgdataformats.TriggerPrimitive(frag.get_data(0))
+            if first.time_start == tps[0]['time_start'] and first.channel == tps[0]['channel'] and first.adc_integral == tps[0]['adc_integral']:
+                return tps
+
+        logging.warning("TriggerPrimitive layout mismatch, falling back to rawdatautils unpacking")
+        return tp_unpack.get_tp_array(frag)
+
+    def _project(self, arr: np.ndarray, ctx: UnpakerContext) -> pd.DataFrame | np.ndarray:
+        # Select the fields (multi-field indexing returns a view)
+        fields = [n for n in self.columns if n in arr.dtype.names]
+        view = arr[fields]
+
+        if 'plane' not in self.columns:
+            return view if self.as_numpy else pd.DataFrame({n: view[n] for n in fields}, copy=False)
+
         # add plane information
-        df['plane'] = df['channel'].apply(lambda x: ctx.tpc_chan_map.get_plane_from_offline_channel(x)).astype(np.uint8)
-        return df
+        planes = ctx.tpc_chan_map_tables.planes(arr['channel'])
+
+        if self.as_numpy:
+            # The plane is not part of the fragment, a new array is needed
+            res = np.empty(len(view), dtype=[(n, view.dtype[n]) for n in fields]+[('plane', np.uint8)])
+            for n in fields:
+                res[n] = view[n]
+            res['plane'] = planes
+            return res
+
+        cols = {n: view[n] for n in fields}
+        cols['plane'] = planes
+        return pd.DataFrame(cols, copy=False)
 
 
 # class TPFragmentPandasUnpackerOld(FragmentUnpacker):
@@ -209,11 +289,61 @@ class TPFragmentPandasUnpacker(FragmentUnpacker):
 #         return df
 
 
+def _decode_variable_size_objects(frag: daqdataformats.Fragment, buf: np.ndarray, header_dtype: np.dtype, input_size: int, overlay_cls) -> np.ndarray:
+    """Decode the headers of the variable size trigger objects (TAs, TCs) packed in a fragment payload
+
+    The object offsets are found with a compiled scan of the payload and the headers are read as a numpy structured array.
+    The numpy layout is checked against the trgdataformats overlay of the first object.
+
+    Args:
+        frag (daqdataformats.Fragment): trigger fragment
+        buf (np.ndarray): fragment payload bytes
+        header_dtype (np.dtype): numpy layout of the object header
+        input_size (int): size of the object inputs
+        overlay_cls: trgdataformats overlay class of the object
+
+    Returns:
+        np.ndarray: structured array of object headers, None if the layout doesn't match the fragment
+    """
+    try:
+        offsets = trgdtypes.scan_offsets(buf, header_dtype.itemsize, header_dtype.fields['n_inputs'][1], input_size)
+    except ValueError as e:
+        # The payload doesn't split into objects of this layout
+        logging.warning(f"{overlay_cls.__name__} scan failed ({e}), falling back to overlay unpacking")
+        return None
+    hdrs = trgdtypes.gather_headers(buf, offsets, header_dtype)
+
+    if len(hdrs) == 0:
+        return hdrs
+
+    first = overlay_cls(frag.get_data(0))
+    if (
+        first.sizeof() != header_dtype.itemsize + int(hdrs[0]['n_inputs'])*input_size
+        or first.data.time_start != hdrs[0]['data']['time_start']
+    ):
+        logging.warning(f"{overlay_cls.__name__} layout mismatch, falling back to overlay unpacking")
+        return None
+
+    return hdrs
+
+
+def _project(arr: np.ndarray, dtypes: list) -> np.ndarray:
+    """Copy the fields of arr listed in dtypes into a new array, leaving missing fields zeroed"""
+    res = np.zeros(len(arr), dtype=dtypes)
+    for name, _ in dtypes:
+        if name in arr.dtype.names:
+            res[name] = arr[name]
+    return res
+
+
 class TAFragmentPandasUnpacker(FragmentUnpacker):
 
     def __init__(self):
         super().__init__()
     
+    def match_source_id(self, sid: daqdataformats.SourceID) -> bool:
+        return sid.subsystem == daqdataformats.SourceID.kTrigger
+
     def match(self, frag: daqdataformats.Fragment, sid: daqdataformats.SourceID) -> bool:
         return (frag.get_fragment_type() == daqdataformats.FragmentType.kTriggerActivity) and (sid.subsystem == daqdataformats.SourceID.kTrigger)
     
@@ -270,6 +400,31 @@ adc: [
 
     def unpack(self, frag: daqdataformats.Fragment, ctx: UnpakerContext) -> pd.DataFrame:
 
+        buf = np.frombuffer(frag.get_data_bytes(), dtype=np.uint8)
+        tas = _decode_variable_size_objects(
+            frag, 
+            buf, 
+            trgdtypes.trigger_activity_dtype, 
+            trgdataformats.TriggerPrimitive.sizeof(), 
+            trgdataformats.TriggerActivityOverlay
+        )
+
+        if tas is None:
+            ta_array = self._unpack_overlays(frag)
+        else:
+            ta_array = _project(tas['data'], self.dtypes())
+
+        # Add plane information (here or in user code?)
+        ta_array['plane'] = ctx.tpc_chan_map_tables.planes(ta_array['channel_peak'])
+
+        # Create the dataframe
+        df = pd.DataFrame(ta_array)
+        # logging.debug(f"TA Dataframe size {len(df)}")
+        return df
+
+    def _unpack_overlays(self, frag: daqdataformats.Fragment) -> np.ndarray:
+        """Unpack the fragment by walking it with TriggerActivityOverlay objects"""
+
         # self.test_wrapper(frag)
         data_size = frag.get_data_size()
 
@@ -308,14 +463,7 @@ adc: [
                 9999 # placeholder, not set
             )
 
-
-        # Create the dataframe
-        df = pd.DataFrame(ta_array)
-        # logging.debug(f"TA Dataframe size {len(df)}")
-        # print(df)
-        # Add plane information (here or in user code?)
-        df['plane'] = df['channel_peak'].apply(lambda x: ctx.tpc_chan_map.get_plane_from_offline_channel(x)).astype(np.uint8)
-        return df
+        return ta_array
 
 
 class TCFragmentPandasUnpacker(FragmentUnpacker):
@@ -323,6 +471,9 @@ class TCFragmentPandasUnpacker(FragmentUnpacker):
     def __init__(self):
         super().__init__()
 
+    def match_source_id(self, sid: daqdataformats.SourceID) -> bool:
+        return sid.subsystem == daqdataformats.SourceID.kTrigger
+
     def match(self, frag: daqdataformats.Fragment, sid: daqdataformats.SourceID) -> bool:
         return (frag.get_fragment_type() == daqdataformats.FragmentType.kTriggerCandidate) and (sid.subsystem == daqdataformats.SourceID.kTrigger)
 
@@ -340,6 +491,28 @@ class TCFragmentPandasUnpacker(FragmentUnpacker):
 
     def unpack(self, frag: daqdataformats.Fragment, ctx: UnpakerContext) -> pd.DataFrame:
 
+        buf = np.frombuffer(frag.get_data_bytes(), dtype=np.uint8)
+        tcs = _decode_variable_size_objects(
+            frag, 
+            buf, 
+            trgdtypes.trigger_candidate_dtype, 
+            trgdtypes.trigger_activity_data_dtype.itemsize, 
+            trgdataformats.TriggerCandidateOverlay
+        )
+
+        if tcs is None:
+            tc_array = self._unpack_overlays(frag)
+        else:
+            tc_array = _project(tcs['data'], self.dtypes())
+
+        # Create the dataframe
+        df = pd.DataFrame(tc_array)
+        logging.debug(f"TC Dataframe size {len(df)}")
+        return df
+
+    def _unpack_overlays(self, frag: daqdataformats.Fragment) -> np.ndarray:
+        """Unpack the fragment by walking it with TriggerCandidateOverlay objects"""
+
         data_size = frag.get_data_size()
 
         offset=0
@@ -371,11 +544,7 @@ class TCFragmentPandasUnpacker(FragmentUnpacker):
                 ta.data.time_candidate,
             )
 
-
-        # Create the dataframe
-        df = pd.DataFrame(tc_array)
-        logging.debug(f"TC Dataframe size {len(df)}")
-        return df
+        return tc_array
     
 
 class DAPHNEStreamFragmentPandasUnpacker(FragmentUnpacker):
@@ -383,6 +552,9 @@ class DAPHNEStreamFragmentPandasUnpacker(FragmentUnpacker):
     def __init__(self):
         super().__init__()
     
+    def match_source_id(self, sid: daqdataformats.SourceID) -> bool:
+        return sid.subsystem == daqdataformats.SourceID.kDetectorReadout
+
     def match(self, frag: daqdataformats.Fragment, sid: daqdataformats.SourceID) -> bool:
         return (frag.get_fragment_type() == daqdataformats.FragmentType.kDAPHNE) and (sid.subsystem == daqdataformats.SourceID.kDetectorReadout)
 
@@ -426,11 +598,10 @@ class UnpackerService:
 
     def __init__(self):
         self.fragment_unpackers = {}
-        self._tpc_chan_map_cache = {}
 
     def _get_tpc_channel_map(self, ch_map_id) -> detchannelmaps.TPCChannelMap:
         '''Get the channel map'''
-        return self._tpc_chan_map_cache.setdefault(ch_map_id, detchannelmaps.make_map(ch_map_id))
+        return get_tpc_channel_map_tables(ch_map_id).tpc_chan_map
         
 
     def add(self, prod_name, unpacker):
@@ -444,7 +615,7 @@ class UnpackerService:
         return self.fragment_unpackers[prod_name]
         
 
-    def unpack(self, raw_data_file, tr_id: int, seq_id: int=0, max_thread=10, tpc_chan_map_id=None) -> dict:
+    def unpack(self, raw_data_file, tr_id: int, seq_id: int=0, max_thread=10, tpc_chan_map_id=None, products: list=None) -> dict:
         """Unpack trigger record
 
         Args:   
@@ -453,6 +624,7 @@ class UnpackerService:
             seq_id (int, optional): _description_. Defaults to 0.
             max_thread (int, optional): _description_. Defaults to 10.
             op_env (str, optional): _description_. Defaults to None.
+            products (list, optional): products to unpack. Defaults to None (all products).
 
         Returns:
             dict: _description_
@@ -468,17 +640,24 @@ class UnpackerService:
 
         ctx = UnpakerContext()
         ctx.tpc_chan_map_id = tpc_chan_map_id
-        ctx.tpc_chan_map = self._get_tpc_channel_map(tpc_chan_map_id)
+        ctx.tpc_chan_map_tables = get_tpc_channel_map_tables(tpc_chan_map_id)
+        ctx.tpc_chan_map = ctx.tpc_chan_map_tables.tpc_chan_map
 
         
         tr_source_ids = raw_data_file.get_source_ids((tr_id, seq_id))
 
+        unpackers = {prod:upk for prod,upk in self.fragment_unpackers.items() if products is None or prod in products}
+
         unpack_list = []
         for sid in tr_source_ids:
+            candidates = [(prod,upk) for prod,upk in unpackers.items() if upk.match_source_id(sid)]
+            if not candidates:
+                continue
+
             # Get the fragment
             frag = raw_data_file.get_frag((tr_id, seq_id),sid)
 
-            for prod,upk in self.fragment_unpackers.items():
+            for prod,upk in candidates:
                 if not upk.match(frag, sid):
                     continue
 
@@ -3,32 +3,125 @@ import click
 import h5py
 from rich import print
 
+from tpgsandbox.utils import h5layout
+
+
+def parse_tr_selection(specs) -> set:
+    '''Parse trigger record selections: numbers, ranges (3-7, inclusive) and comma separated lists of both'''
+    trs = set()
+    for spec in specs:
+        for item in spec.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            try:
+                if '-' in item:
+                    first, last = (int(x) for x in item.split('-', 1))
+                    trs.update(range(first, last+1))
+                else:
+                    trs.add(int(item))
+            except ValueError:
+                raise click.BadParameter(f"'{item}' is not a trigger record number or range", param_hint='--keep')
+    return trs
+
+
+def copy_attrs(src, dest):
+    for a in src.attrs:
+        dest.attrs[a] = src.attrs[a]
+
+
+def copy_record(src, dest, name, keep_fragment=None) -> int:
+    '''Copy a record group, or only the fragments selected by keep_fragment and the non-fragment datasets
+
+    Datasets are copied with H5Ocopy: the stored chunks are copied as they are,
+    without being decompressed and compressed again.
+
+    Returns:
+        int: number of fragments copied
+    '''
+    grp = src[name]
+    frags = {f.path: f for f in h5layout.iter_fragments(grp)}
+    if keep_fragment is None:
+        src.copy(grp, dest, name)
+        return len(frags)
+
+    dest_grp = dest.create_group(name)
+    copy_attrs(grp, dest_grp)
+    n_frags = 0
+    for path, ds in h5layout.iter_datasets(grp):
+        f = frags.get(path, None)
+        if f is not None:
+            if not keep_fragment(f):
+                continue
+            n_frags += 1
+
+        # Recreate the intermediate groups, with their attributes
+        parent = dest_grp
+        parts = path.split('/')
+        for i, part in enumerate(parts[:-1]):
+            if part not in parent:
+                copy_attrs(grp['/'.join(parts[:i+1])], parent.create_group(part))
+            parent = parent[part]
+        src.copy(ds, parent, parts[-1])
+    return n_frags
+
+
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.argument('src_path',type=click.Path(file_okay=True, dir_okay=False, exists=True))
-@click.argument('dest_path',type=click.Path(file_okay=True, dir_okay=False, exists=False))
-@click.option('-k','--keep', type=int, multiple=True, help="List of trigger record ids to copy to the new file")
-def cli(src_path, dest_path, keep):
+@click.argument('dest_path',type=click.Path(file_okay=True, dir_okay=False, exists=False), required=False)
+@click.option('-k','--keep', type=str, multiple=True, help="Trigger records to copy: numbers, ranges (3-7) or comma separated lists. Defaults to all records")
+@click.option('-s','--source-id', type=str, multiple=True, help="Keep only the fragments of these source ids (decimal or 0x hex)")
+@click.option('--subsystem', type=str, multiple=True, help="Keep only the fragments of these subsystems (e.g. Detector_Readout or kDetectorReadout)")
+@click.option('-t','--fragment-type', type=str, multiple=True, help="Keep only the fragments of these types (e.g. Trigger_Primitive or kTriggerPrimitive)")
+@click.option('-l','--list', 'list_only', is_flag=True, default=False, help="List the selected records and fragments instead of copying them")
+def cli(src_path, dest_path, keep, source_id, subsystem, fragment_type, list_only):
     """
     Utility script to copy a subset of trigger records from a DUNE-DAQ raw-data file to another.
 
+    Records are selected by exact trigger record number, fragments optionally by source id,
+    subsystem and fragment type. Record headers are always copied.
+
 
     \b
     SRC_PATH : Path of the original data file
     DEST_PATH : Path of the destination file
     """
-    tr_list = [str(tr) for tr in keep]
-    # return
-    with h5py.File(src_path) as src, h5py.File(dest_path,'w') as dest:
-        for a in src.attrs:
-            dest.attrs[a] = src.attrs[a]
-
-        for name, grp in src.items():
-            if not any((tr in name) for tr in tr_list):
-                continue
-            dest.copy(grp,dest,name)
-            print(f"Trigger record {name} copied")
+    if dest_path is None and not list_only:
+        raise click.UsageError("Missing argument 'DEST_PATH'")
+
+    tr_sel = parse_tr_selection(keep)
+    try:
+        source_ids = {int(s, 0) for s in source_id}
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--source-id')
+
+    keep_fragment = None
+    if source_ids or subsystem or fragment_type:
+        keep_fragment = lambda f: h5layout.select_fragment(f, source_ids, subsystem, fragment_type)
+
+    with h5py.File(src_path, 'r') as src:
+        index = h5layout.index_records(src)
+        selected = sorted(k for k in index if not tr_sel or k[0] in tr_sel)
+
+        missing = tr_sel - {tr for tr, _ in index}
+        if missing:
+            print(f"[yellow]Trigger records not found in {src_path}: {sorted(missing)}[/yellow]")
+
+        if list_only:
+            for k in selected:
+                frags = [f for f in h5layout.iter_fragments(src[index[k]]) if keep_fragment is None or keep_fragment(f)]
+                print(f"{index[k]}: {len(frags)} fragments, {sum(f.nbytes for f in frags)} bytes")
+                for f in frags:
+                    print(f"  {f.path}: {f.subsystem} 0x{f.source_id:08x} {f.fragment_type}, {f.nbytes} bytes")
+            return
+
+        with h5py.File(dest_path,'w') as dest:
+            copy_attrs(src, dest)
+            for k in selected:
+                n_frags = copy_record(src, dest, index[k], keep_fragment)
+                print(f"Trigger record {index[k]} copied ({n_frags} fragments)")
 
 
 if __name__ == '__main__':
-    cli()
\ No newline at end of file
+    cli()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Headless batch emulation: run the TPG (pedestal, hit finding) and clustering chain
+over the selected records of one or more files, on a pool of processes.
+
+The emulated TPs, with their cluster labels, are written by the workers as a dataset
+partitioned by run and trigger record, e.g.
+
+    <output_dir>/run=<run>/tr=<tr>/tps.parquet
+
+which can be read back with `pd.read_parquet(output_dir)`.
+"""
+
+import functools
+import importlib.util
+import os
+import pathlib
+import time
+
+import click
+import pandas as pd
+from rich import print
+
+from tpgsandbox.utils.reader import RecordReader
+from tpgsandbox.utils.cache import ProductDiskCache
+from tpgsandbox.utils.catalog import RecordCatalog
+
+
+def process_record(run, tr, data, output_dir, fmt, thresholds, emu_opts, cluster_opts, n_threads) -> dict:
+    '''Emulate and cluster the TPs of a record, and write them to the output dataset
+
+    Runs in the worker processes: only the counters are sent back.
+    '''
+    import numba
+    from tpgsandbox.utils.chmap import get_tpc_channel_map_tables
+    from tpgsandbox.emulation.tpg import emulate_tpg
+    from tpgsandbox.emulation.clustering import cluster_tps
+
+    if n_threads:
+        numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+
+    t_start = time.perf_counter()
+    df_tpc = data.record['bde_eth']
+    chmap = get_tpc_channel_map_tables(data.tpc_chan_map_id)
+    t_load = time.perf_counter()
+
+    df_tps, _ = emulate_tpg(df_tpc, chmap, thresholds, **emu_opts)
+    # Clusters are built from the TPs of each threshold separately
+    if 'threshold_idx' in df_tps and len(df_tps):
+        groups = [g for _, g in df_tps.groupby('threshold_idx', sort=True)]
+    else:
+        groups = [df_tps]
+    groups = [cluster_tps(g, **cluster_opts) for g in groups]
+    n_clusters = sum(int(g['cluster_label'].max())+1 for g in groups if len(g))
+    df_tps = pd.concat(groups)
+    t_emu = time.perf_counter()
+
+    part_dir = pathlib.Path(output_dir) / f"run={run}" / f"tr={tr}"
+    part_dir.mkdir(parents=True, exist_ok=True)
+    df_tps = df_tps.reset_index(drop=True)
+    if fmt == 'parquet':
+        df_tps.to_parquet(part_dir / 'tps.parquet', index=False)
+    else:
+        df_tps.to_feather(part_dir / 'tps.arrow')
+
+    return {
+        'n_ticks': df_tpc.shape[0],
+        'n_channels': df_tpc.shape[1],
+        'n_samples': df_tpc.size,
+        'n_tps': len(df_tps),
+        'n_clusters': n_clusters,
+        't_load': t_load-t_start,
+        't_emu': t_emu-t_load,
+        't_write': time.perf_counter()-t_emu,
+    }
+
+
+@click.command()
+@click.option('-o', '--output-dir', type=click.Path(file_okay=False), required=True, help="Output dataset directory")
+@click.option('-n', '--num-records', default=0, help="Maximum number of records to process (0: all)")
+@click.option('-r', '--records', type=(int, int), multiple=True, help="(run, tr) pairs to process. Defaults to all the records of the files")
+@click.option('-t', '--threshold', 'thresholds', type=int, multiple=True, default=[100], show_default=True, help="Hit threshold, repeat to scan several thresholds in one pass")
+@click.option('--format', 'fmt', type=click.Choice(['parquet', 'arrow']), default='parquet', show_default=True)
+@click.option('--init-ped-algo', type=click.Choice(['mode', 'mean', 'hist_mode', 'hist_median']), default='hist_mode', show_default=True)
+@click.option('--init-ped-range', type=int, default=100, show_default=True)
+@click.option('--rs-r', type=float, default=0.98, show_default=True)
+@click.option('--eps', type=float, default=40, show_default=True)
+@click.option('--min-samples', type=int, default=5, show_default=True)
+@click.option('-j', '--jobs', type=int, default=None, help="Number of worker processes. Defaults to the number of cores")
+@click.option('--threads-per-job', type=int, default=None, help="numba threads per worker. Defaults to cores/jobs")
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None, help="Directory of the on-disk cache of unpacked products")
+@click.option('--catalog', type=click.Path(dir_okay=False), default=None, help="Record catalog database: updated with the raw files, which are then added without being opened. Without raw files, all the cataloged files are used")
+@click.argument('raw_files', type=click.Path(exists=True, dir_okay=False), nargs=-1)
+def cli(output_dir, num_records, records, thresholds, fmt, init_ped_algo, init_ped_range, rs_r, eps, min_samples, jobs, threads_per_job, cache_dir, catalog, raw_files):
+
+    # Fail before emulating anything, rather than in every worker after the emulation
+    if importlib.util.find_spec('pyarrow') is None:
+        raise click.ClickException(f"Writing {fmt} files requires pyarrow, which is not installed (pip install pyarrow)")
+
+    import tpgsandbox.utils.unpacker as unpacker
+    import tpgsandbox.utils.assembler as assembler
+    from tpgsandbox.emulation.warmup import precompile
+
+    rr = RecordReader(disk_cache=ProductDiskCache(cache_dir) if cache_dir else None)
+    if catalog:
+        with RecordCatalog(catalog) as cat:
+            print(f"- [cyan]{cat.update(raw_files)} files scanned into {catalog}[/cyan]")
+            rr.add_files_from_catalog(cat, raw_files or None)
+    else:
+        for f in raw_files:
+            print(f'Adding {f}')
+            rr.add_file(f)
+    rr.add_product('bde_eth', unpacker.WIBEthFragmentPandasUnpacker(), assembler.ADCMatrixAssembler())
+
+    selected = [(run,tr) for run,tr in rr.iter_records() if not records or (run,tr) in records]
+    if num_records:
+        selected = selected[:num_records]
+    if not selected:
+        print("[yellow]No records selected[/yellow]")
+        return
+
+    n_cores = os.cpu_count() or 1
+    jobs = min(jobs or n_cores, len(selected))
+    threads_per_job = threads_per_job or max(n_cores//jobs, 1)
+
+    # Fill the kernel cache once, rather than in every worker at the same time
+    print(f"- [cyan]Kernels ready in {precompile():.2f}s[/cyan]")
+
+    task = functools.partial(
+        process_record,
+        output_dir=output_dir,
+        fmt=fmt,
+        thresholds=thresholds[0] if len(thresholds) == 1 else list(thresholds),
+        emu_opts=dict(init_ped_algo=init_ped_algo, init_ped_range=init_ped_range, rs_r=rs_r, parallel=threads_per_job > 1),
+        cluster_opts=dict(eps=eps, min_samples=min_samples),
+        n_threads=threads_per_job,
+    )
+
+    print(f"- [cyan]Processing {len(selected)} records on {jobs} workers x {threads_per_job} threads[/cyan]")
+    totals = dict.fromkeys(['n_samples', 'n_tps', 'n_clusters', 't_load', 't_emu', 't_write'], 0)
+    t_start = time.perf_counter()
+    for run, tr, stats in rr.map_records(task, selected, max_workers=jobs, ordered=False):
+        print(f"({run}, {tr}): {stats['n_ticks']} ticks x {stats['n_channels']} channels, {stats['n_tps']} TPs, {stats['n_clusters']} clusters")
+        for k in totals:
+            totals[k] += stats[k]
+    elapsed = time.perf_counter()-t_start
+
+    print(f"[green]Processed {len(selected)} records in {elapsed:.2f}s[/green]")
+    print(f"  {len(selected)/elapsed:.2f} records/s, {totals['n_samples']/elapsed:.3g} ADC samples/s")
+    print(f"  {totals['n_tps']} TPs, {totals['n_clusters']} clusters written to {output_dir}")
+    print(f"  worker time: load {totals['t_load']:.2f}s, emulation {totals['t_emu']:.2f}s, write {totals['t_write']:.2f}s")
+
+
+if __name__ == '__main__':
+    cli()
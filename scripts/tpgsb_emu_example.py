@@ -5,15 +5,8 @@ import pandas as pd
 from rich import print
 
 from tpgsandbox.utils.reader import RecordReader
-import tpgsandbox.utils.unpacker as unpacker
-import tpgsandbox.utils.assembler as assembler
-from tpgsandbox.emulation.algos import emulate_ped, emulate_running_sum, generate_tps, dbscan_cluster
+from tpgsandbox.utils.cache import ProductDiskCache
 
-import detchannelmaps
-
-from sklearn.cluster import DBSCAN
-
-import click
 import ast
 
 class PythonLiteralOption(click.Option):
@@ -25,84 +18,80 @@ class PythonLiteralOption(click.Option):
             raise click.BadParameter(value)
 
 
-import plotly.express as px
-from plotly.subplots import make_subplots
-# from plotly.offline import plot
-import plotly.io as pio
-from pypdf import PdfWriter
-
 @click.command()
 @click.option('-l', '--list-records', is_flag=True, default=False)
 @click.option('-n', '--num-records', default=1)
 # @click.option('-r', '--records', cls=PythonLiteralOption, default=[])
 @click.option('-r', '--records', type=(int, int), multiple=True)
 @click.option('-c', '--channels', type=int, multiple=True)
+@click.option('--prefetch', type=int, default=1, help="Number of records loaded in background while processing the current one")
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None, help="Directory of the on-disk cache of unpacked products")
+@click.option('-o', '--output', type=click.Path(dir_okay=False), default='document-output.pdf', show_default=True, help="Output PDF report")
+@click.option('--plot-jobs', type=int, default=None, help="Number of processes rendering the report pages. Defaults to the number of cores")
+@click.option('--max-points', type=int, default=4000, show_default=True, help="Maximum number of points per waveform trace")
 @click.argument('raw_files', type=click.Path(exists=True, dir_okay=False), nargs=-1)
-def cli(list_records, num_records, records, channels, raw_files):
+def cli(list_records, num_records, records, channels, prefetch, cache_dir, output, plot_jobs, max_points, raw_files):
 
 
     
 
-    rr = RecordReader()
+    rr = RecordReader(disk_cache=ProductDiskCache(cache_dir) if cache_dir else None)
     for f in raw_files:
         print(f'Adding {f}')
         rr.add_file(f)
 
-    rr.add_product('bde_eth', unpacker.WIBEthFragmentPandasUnpacker(), assembler.ADCJoiner())
-    rr.add_product('tp', unpacker.TPFragmentPandasUnpacker(), assembler.TPConcatenator())
-
     if list_records:
         for i,(run,tr) in enumerate(rr.iter_records()):
             print(f"{i:04d}: ({run}, {tr})")
         return
 
+    # Not needed to list the records, imported here to keep the startup fast
+    import tpgsandbox.utils.unpacker as unpacker
+    import tpgsandbox.utils.assembler as assembler
+    from tpgsandbox.emulation.tpg import emulate_tpg
+    from tpgsandbox.emulation.clustering import cluster_tps
+    from tpgsandbox.plotting.report import PDFReport, decimate_frame
+    import plotly.express as px
+    from plotly.subplots import make_subplots
 
-    merger = PdfWriter()
-
-    done=0
+    rr.add_product('bde_eth', unpacker.WIBEthFragmentPandasUnpacker(), assembler.ADCMatrixAssembler())
+    rr.add_product('tp', unpacker.TPFragmentPandasUnpacker(), assembler.TPConcatenator())
 
-    for i,(run,tr) in enumerate(rr.iter_records()):
-        if done >= num_records:
-            break
+    # Pages are rendered in the background while the next records are processed
+    report = PDFReport(max_workers=plot_jobs)
 
-        if records:
-            if not (run,tr) in records:
-                continue
-        done += 1
+    selected = [(run,tr) for run,tr in rr.iter_records() if not records or (run,tr) in records][:num_records]
 
-        data = rr.load_record(run, tr)
-        chmap = detchannelmaps.make_map(data.tpc_chan_map_id)
+    for run, tr, data in rr.iter_load(selected, prefetch=prefetch):
+        chmap = rr.get_tpc_channel_map_tables(data.tpc_chan_map_id)
 
         # Prepare dataframes
         dfs = data.record
 
-        df_tpc = dfs['bde_eth'].astype('int16')
+        # The kernels take the unpacked uint16 ADCs and uint64 timestamps as they are
+        df_tpc = dfs['bde_eth']
 
-        # Reindex from the start of the frame
+        # Reindex from the start of the frame (a new frame sharing the ADCs, the record is left untouched)
         t0 = df_tpc.index.min()
-        
-        df_tpc.index = df_tpc.index.astype('int64')-t0
+        df_tpc = df_tpc.set_axis(df_tpc.index-t0, axis=0)
 
         # TODO: distinguish between readout TPs and Trigger TPs
         df_tps = data.frags['tp'][0]
-        df_tps['time_start']=df_tps['time_start'].astype('int64')-t0
-        df_tps['time_peak']=df_tps['time_peak'].astype('int64')-t0
+        df_tps = df_tps.assign(
+            time_start=df_tps['time_start'].astype('int64')-int(t0),
+            time_peak=df_tps['time_peak'].astype('int64')-int(t0)
+        )
 
         ## Processing starts here
-        print("- [cyan]Emulating pedestal[/cyan]")
-        df_ped, df_ped_var = emulate_ped(df_tpc, init_ped_range=100)
-        df_adc = df_tpc-df_ped
-
-        print("- [cyan]Running Sum[/cyan]")
-        df_rs_adc = emulate_running_sum(df_adc, 0.98)
-
-        print("- [cyan]Generating hits [/cyan]")
-        df_emu_tps_100 = generate_tps(df_adc, 100, chmap)
-        df_emu_tps_200 = generate_tps(df_adc, 200, chmap)
+        print("- [cyan]Emulating TPG[/cyan]")
+        thresholds = [100, 200]
+        df_emu_tps, wfs = emulate_tpg(df_tpc, chmap, thresholds, init_ped_algo='hist_mode', init_ped_range=100, rs_r=0.98, waveform_channels=channels)
+        df_emu_tps_100 = df_emu_tps[df_emu_tps['threshold_idx'] == thresholds.index(100)]
+        df_emu_tps_200 = df_emu_tps[df_emu_tps['threshold_idx'] == thresholds.index(200)]
 
         print("- [cyan]Clustering[/cyan]")
-        df_emu_tps_100_cluster = dbscan_cluster(df_emu_tps_100)
-        df_emu_tps_200_cluster = dbscan_cluster(df_emu_tps_200)
+        df_emu_tps_100_cluster = cluster_tps(df_emu_tps_100)
+        df_emu_tps_200_cluster = cluster_tps(df_emu_tps_200)
 
 
 
@@ -111,19 +100,13 @@ def cli(list_records, num_records, records, channels, raw_files):
             ## Generate plosts
             tps = df_emu_tps_100_cluster[df_emu_tps_100_cluster['plane']==p]
             fig = px.scatter(x=tps['channel'],y=tps['time_peak'],color=tps['cluster_label'])
-            # Save to a temp file
-            pio.write_image(fig, f'tmp_img.pdf', format='pdf')
-            # Append to the merger
-            merger.append(f'tmp_img.pdf')
+            report.add(fig)
 
         for p in [2,1,0]:
 
             tps = df_emu_tps_200_cluster[df_emu_tps_200_cluster['plane']==p]
             fig = px.scatter(x=tps['channel'],y=tps['time_peak'],color=tps['cluster_label'])
-            # Save to a temp file
-            pio.write_image(fig, f'tmp_img.pdf', format='pdf')
-            # Append to the merger
-            merger.append(f'tmp_img.pdf')
+            report.add(fig)
 
         # # Plot emulated TPS
         # tps = df_emu_tps_100[df_emu_tps_100_cluster['plane']==2]
@@ -145,16 +128,10 @@ def cli(list_records, num_records, records, channels, raw_files):
         for ch in channels:
             print(f"- [green]Plotting channel {ch}[/green]")
 
-            wf = pd.DataFrame(
-                {
-                    'adc_raw':df_tpc[ch],
-                    'ped': df_ped[ch], 
-                    'ped_var': df_ped_var[ch],
-                    'adc': df_adc[ch],
-                    'rs_adc': df_rs_adc[ch],
-                    'rs_adc_n': df_rs_adc[ch]/df_rs_adc[ch].std()*df_adc[ch].std()
-                }
-            )
+            wf = wfs[ch]
+            wf['rs_adc_n'] = wf['rs_adc']/wf['rs_adc'].std()*wf['adc'].std()
+            # Keep the min/max envelope of each trace
+            wf = decimate_frame(wf, max_points)
 
 
             # cdm={'adc_raw': 'black', 'adc': 'black', 'ped': 'red', 'ped_var': 'red', 'rs_adc': 'orange', 'rs_adc_n': 'orange'}
@@ -173,17 +150,12 @@ def cli(list_records, num_records, records, channels, raw_files):
                 for trace in range(len(figure["data"])):
                     fig.append_trace(figure["data"][trace], row=j+1, col=1)
             fig.update_layout(width=1600, height=1600, title_text=f"Channel {ch} [Run {run}, TR {tr}]")
-            pio.write_image(fig, f'tmp_img.pdf', format='pdf')
-            
-            merger.append(f'tmp_img.pdf')
+            report.add(fig)
 
     # Write to an output PDF document
-    with open("document-output.pdf", "wb") as output:
-        merger.write(output)
-
-        # Close file descriptors
-        merger.close()
-        output.close()
+    print(f"- [green]Writing {len(report)} pages to {output}[/green]")
+    with report:
+        report.write(output)
     return
 
 
@@ -9,6 +9,7 @@ import click
 import tpgsandbox.utils.unpacker as unpacker
 import tpgsandbox.utils.assembler as assembler
 import tpgsandbox.utils.reader as recordreader
+from tpgsandbox.utils.cache import ProductDiskCache, RecordCache
 
 from rich import print
 from rich.logging import RichHandler
@@ -21,7 +22,9 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 @click.option('-p', '--plot', type=str, default=None, help="Generate example ADC plots")
 @click.option('-o', '--tr-offset', type=int, default=0, help="Offset of the first Trigger Record to process")
 @click.option('-n', '--num-trs', type=int, default=1, help="Number of trigger records to process")
-def cli(rawfile, interactive, plot, tr_offset, num_trs):
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None, help="Directory of the on-disk cache of unpacked products")
+@click.option('--record-cache-mb', type=int, default=2048, help="Memory budget of the loaded records cache in MB (0 to disable)")
+def cli(rawfile, interactive, plot, tr_offset, num_trs, cache_dir, record_cache_mb):
     """
     This is an example script to demonstrate the usage of the Record Reader utility to 
     demonstrate how to unpack, pre-process DUNE raw data for a selection of fragments
@@ -37,11 +40,14 @@ def cli(rawfile, interactive, plot, tr_offset, num_trs):
     - Optionally: start an IPython shell to interactlvely play with the unpacket dataframes
     """
 
-    rr = recordreader.RecordReader()
+    rr = recordreader.RecordReader(
+        disk_cache=ProductDiskCache(cache_dir) if cache_dir else None,
+        record_cache=RecordCache(record_cache_mb << 20) if record_cache_mb > 0 else None
+    )
     rr.add_file(rawfile)
 
 
-    rr.add_product('bde_eth', unpacker.WIBEthFragmentPandasUnpacker(), assembler.ADCJoiner())
+    rr.add_product('bde_eth', unpacker.WIBEthFragmentPandasUnpacker(), assembler.ADCMatrixAssembler())
     rr.add_product('tp', unpacker.TPFragmentPandasUnpacker(), assembler.TPConcatenator())
 
     trs = [ i for i in rr.iter_records()]
@@ -59,29 +65,21 @@ def cli(rawfile, interactive, plot, tr_offset, num_trs):
 
         if plot and not df_tpc.empty:
             import matplotlib.pyplot as plt
+            from tpgsandbox.plotting.adcimage import adc_images_by_plane, plot_adc_image
 
-            print("Plotting all samples")
-
-            fig, ax = plt.subplots(figsize=(10,8))
-            pcm = ax.pcolormesh(df_tpc)
-            fig.colorbar(pcm)
-            ax.set_xticks(xpos, [df_tpc.columns[i] for i in xpos])
-            ax.set_xlabel("channel id")
-            ax.set_ylabel("Samples (since start of RO window)")
-            # pdf.savefig()
-            fig.savefig(f'wibeth_frame_{tr}_{plot}.png')
-
-
-            print("Plotting all samples (baseline subtracted)")
-            df_tpc_sub = df_tpc-df_tpc.mean()
-            fig, ax = plt.subplots(figsize=(10,8))
-            pcm = ax.pcolormesh(df_tpc_sub)
-            fig.colorbar(pcm)
-            ax.set_xticks(xpos, [df_tpc_sub.columns[i] for i in xpos])
-            ax.set_xlabel("channel id")
-            ax.set_ylabel("Samples (since start of RO window)")
-            # pdf.savefig()
-            fig.savefig(f'wibeth_frame_{tr}_{plot}_sub.png')
+            chmap = rr.get_tpc_channel_map_tables(data.tpc_chan_map_id)
+
+            for baseline, suffix in [(None, ''), ('mean', '_sub')]:
+                print(f"Plotting all samples{' (baseline subtracted)' if baseline else ''}")
+
+                # Screen-sized rasters of each plane, binned in numba
+                images = adc_images_by_plane(df_tpc, chmap, shape=(1000, 1000), baseline=baseline)
+                fig, axes = plt.subplots(1, len(images), figsize=(10*len(images),8), squeeze=False)
+                for ax, img in zip(axes[0], images.values()):
+                    im = plot_adc_image(ax, img)
+                    fig.colorbar(im, ax=ax)
+                fig.savefig(f'wibeth_frame_{tr}_{plot}{suffix}.png')
+                plt.close(fig)
 
 
             print("Plotting done")
@@ -0,0 +1,40 @@
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# The package is not installed by the build: import it from the source tree
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / 'python'))
+sys.path.insert(0, str(ROOT / 'scripts'))
+
+
+class ChannelMap:
+    '''Channel map with the planes assigned round-robin to the offline channels'''
+
+    def get_plane_from_offline_channel(self, channel):
+        return channel % 3
+
+
+@pytest.fixture
+def chmap():
+    return ChannelMap()
+
+
+@pytest.fixture
+def raw_adcs() -> pd.DataFrame:
+    '''Noisy raw ADC frame (2000 ticks x 48 channels) with pulses of various amplitudes'''
+    rng = np.random.default_rng(0)
+    n_ticks, n_chans = 2000, 48
+    adcs = rng.normal(900, 20, (n_ticks, n_chans))
+    for _ in range(150):
+        c = rng.integers(n_chans)
+        t = rng.integers(n_ticks-40)
+        adcs[t:t+30, c] += rng.integers(50, 400)*np.hanning(30)
+    return pd.DataFrame(
+        adcs.astype(np.int16),
+        index=pd.Index(np.arange(n_ticks, dtype=np.uint64)*32, name='ts'),
+        columns=np.arange(1000, 1000+n_chans),
+    )
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+
+from tpgsandbox.utils.assembler import ADCJoiner, ADCMatrixAssembler
+
+
+def make_fragments(rng) -> dict:
+    '''ADC fragments on the same timestamps, with interleaved and unsorted channels'''
+    ts = pd.Index(np.arange(1000, dtype=np.uint64)*32+123456, name='ts')
+    chans = rng.permutation(np.arange(2000, 2256))
+    return {
+        sid: pd.DataFrame(rng.integers(0, 1 << 14, (len(ts), 64)).astype(np.uint16), index=ts, columns=chans[k*64:(k+1)*64])
+        for k, sid in enumerate([0x64, 0x65, 0x66, 0x67])
+    } | {0x68: None}
+
+
+def test_matrix_assembler_matches_joiner():
+    frags = make_fragments(np.random.default_rng(0))
+    ref = ADCJoiner().assemble(frags)
+    res = ADCMatrixAssembler().assemble(frags)
+    # The joiner drops the index name
+    pd.testing.assert_frame_equal(res, ref, check_index_type=False, check_column_type=False, check_names=False)
+    assert res.index.name == 'ts'
+    assert res.columns.is_monotonic_increasing
+
+
+def test_matrix_assembler_fill_and_mask():
+    frags = make_fragments(np.random.default_rng(1))
+    # Shift a fragment by half its length: samples outside it are filled
+    shifted = frags[0x65].iloc[500:].copy()
+    shifted.index = shifted.index+500*32
+    frags[0x65] = shifted
+
+    ts, channels, adcs, mask = ADCMatrixAssembler(fill_value=7).assemble_arrays(frags, with_mask=True)
+    assert len(ts) == 1500 and len(channels) == 256
+    cols = np.isin(channels, shifted.columns)
+    rows = np.isin(ts, shifted.index)
+    assert mask[np.ix_(rows, cols)].all() and not mask[np.ix_(~rows, cols)].any()
+    assert (adcs[~mask] == 7).all()
+    np.testing.assert_array_equal(adcs[np.ix_(rows, cols)], shifted[channels[cols]].to_numpy())
@@ -0,0 +1,96 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from tpgsandbox.emulation.algos import TP_DTYPES
+from tpgsandbox.utils.cache import ProductDiskCache
+
+
+class Producer:
+    '''Unpacker-like object, identified by its configuration'''
+
+    def __init__(self, columns=None):
+        self.columns = columns
+
+
+def make_product(rng) -> dict:
+    adcs = pd.DataFrame(
+        rng.integers(0, 1 << 14, (100, 16)).astype(np.uint16),
+        index=pd.Index(np.arange(100, dtype=np.uint64)*32, name='ts'),
+        columns=np.arange(2000, 2016),
+    )
+    tps = pd.DataFrame(np.zeros(50, dtype=TP_DTYPES))
+    tps['channel'] = rng.integers(0, 3000, 50)
+    return {0x64: adcs, 0x65: tps, 0x66: None, 'ts': adcs.index.to_numpy()}
+
+
+def assert_same_product(res: dict, ref: dict):
+    assert list(res) == list(ref)
+    for k, v in ref.items():
+        if isinstance(v, pd.DataFrame):
+            pd.testing.assert_frame_equal(res[k], v)
+        elif isinstance(v, np.ndarray):
+            np.testing.assert_array_equal(res[k], v)
+            assert res[k].dtype == v.dtype
+        else:
+            assert res[k] is v
+
+
+def test_disk_cache_round_trip(tmp_path):
+    cache = ProductDiskCache(str(tmp_path / 'cache'))
+    product = make_product(np.random.default_rng(0))
+    cache.put('k1', product)
+    cache.put('k2', product[0x65])
+
+    assert_same_product(cache.get('k1'), product)
+    pd.testing.assert_frame_equal(cache.get('k2'), product[0x65])
+    with pytest.raises(KeyError):
+        cache.get('k3')
+    assert cache.stats()['entries'] == 2 and cache.stats()['hits'] == 2 and cache.stats()['misses'] == 1
+
+    # Entries survive the process: a new cache on the same directory, e.g. in a worker
+    cache = pickle.loads(pickle.dumps(cache))
+    assert_same_product(cache.get('k1'), product)
+
+
+def test_disk_cache_key_follows_raw_file(tmp_path):
+    raw = tmp_path / 'raw.hdf5'
+    raw.write_bytes(b'0'*10)
+    cache = ProductDiskCache(str(tmp_path / 'cache'))
+    producer = Producer()
+
+    key = cache.make_key(str(raw), 7, 1, 'record', 'tps', [producer])
+    assert key == cache.make_key(str(raw), 7, 1, 'record', 'tps', [Producer()])
+    assert key != cache.make_key(str(raw), 7, 2, 'record', 'tps', [producer])
+    assert key != cache.make_key(str(raw), 7, 1, 'record', 'tps', [Producer(columns=['channel'])])
+
+    raw.write_bytes(b'0'*20)
+    assert key != cache.make_key(str(raw), 7, 1, 'record', 'tps', [producer])
+
+
+def test_disk_cache_discards_corrupt_entries(tmp_path):
+    cache = ProductDiskCache(str(tmp_path))
+    cache.put('k1', np.arange(10))
+    (tmp_path / 'k1.npz').write_bytes(b'not a zip file')
+    with pytest.raises(KeyError):
+        cache.get('k1')
+    assert not (tmp_path / 'k1.npz').exists()
+    assert cache.stats()['entries'] == 0
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = ProductDiskCache(str(tmp_path))
+    cache.put('k1', np.zeros(1000))
+    size = cache.stats()['bytes']
+    cache.max_bytes = 2*size
+    cache.put('k2', np.zeros(1000))
+    now = os.path.getmtime(tmp_path / 'k2.npz')
+    os.utime(tmp_path / 'k1.npz', (now-10, now-10))
+    cache._entries['k1.npz'] = (size, now-10)
+
+    cache.put('k3', np.zeros(1000))
+    assert sorted(os.listdir(tmp_path)) == ['k2.npz', 'k3.npz']
+    assert cache.stats()['evictions'] == 1 and cache.stats()['bytes'] == 2*size
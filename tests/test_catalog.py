@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+import pytest
+
+from tpgsandbox.utils.catalog import RecordCatalog
+from tpgsandbox.utils.reader import RecordReader
+from test_h5layout import make_file
+
+
+def test_catalog(tmp_path):
+    pytest.importorskip('h5py')
+    make_file(tmp_path / 'a.hdf5', trs=(1, 2))
+    with RecordCatalog(str(tmp_path / 'catalog.sqlite')) as cat:
+        assert cat.update_directory(str(tmp_path)) == 1
+        assert cat.update_directory(str(tmp_path)) == 0
+
+        frags = cat.fragments(run=7, tr=1)
+        # Record headers are not fragments
+        assert sorted(frags['fragment_type']) == ['Trigger_Primitive', 'WIBEth']
+        assert cat.find_records(run=7, fragment_type='kTriggerPrimitive') == [(7, 1), (7, 2)]
+        assert cat.find_records(subsystem='TR_Builder') == []
+
+        infos = cat.file_infos()
+        assert [(i.run_number, i.tr_list) for i in infos] == [(7, [1, 2])]
+
+
+def test_catalog_lists_trigger_records_only(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    make_file(tmp_path / 'a.hdf5', trs=(1,))
+    with h5py.File(tmp_path / 'a.hdf5', 'a') as f:
+        f.create_group('TimeSlice000005').create_group('RawData').create_dataset(
+            'Trigger_0x00000001_Trigger_Primitive', data=np.ones(50, dtype=np.uint8)
+        )
+    with RecordCatalog(str(tmp_path / 'catalog.sqlite')) as cat:
+        cat.update_directory(str(tmp_path))
+        assert [i.tr_list for i in cat.file_infos()] == [[1]]
+        assert cat.find_records() == [(7, 1)]
+        assert cat.find_records(kind='TimeSlice') == [(7, 5)]
+        assert sorted(cat.fragments(run=7)['kind']) == ['TimeSlice', 'TriggerRecord', 'TriggerRecord']
+
+
+def test_catalog_skips_unreadable_files(tmp_path, caplog):
+    pytest.importorskip('h5py')
+    make_file(tmp_path / 'a.hdf5', trs=(1,))
+    (tmp_path / 'b.hdf5').write_bytes(b'not an hdf5 file')
+    with RecordCatalog(str(tmp_path / 'catalog.sqlite')) as cat:
+        assert cat.update_directory(str(tmp_path)) == 1
+        assert [os.path.basename(i.path) for i in cat.file_infos()] == ['a.hdf5']
+    assert 'b.hdf5' in caplog.text
+
+
+def test_add_files_from_catalog_checks_files(tmp_path, caplog):
+    pytest.importorskip('h5py')
+    for name, trs in [('a.hdf5', (1,)), ('b.hdf5', (2,)), ('c.hdf5', (3,))]:
+        make_file(tmp_path / name, trs=trs)
+    with RecordCatalog(str(tmp_path / 'catalog.sqlite')) as cat:
+        cat.update_directory(str(tmp_path))
+        assert cat.changed_files() == []
+
+        make_file(tmp_path / 'b.hdf5', trs=(2, 4, 5))
+        os.remove(tmp_path / 'c.hdf5')
+        changed = [os.path.basename(p) for p in cat.changed_files()]
+        assert changed == ['b.hdf5', 'c.hdf5']
+
+        rr = RecordReader()
+        rr.add_files_from_catalog(cat, rescan=False)
+        assert 'changed since it was cataloged' in caplog.text and 'c.hdf5: cataloged but not found' in caplog.text
+        assert sorted(rr.record_list[7]) == [1, 2]
+
+        rr = RecordReader()
+        rr.add_files_from_catalog(cat)
+        assert sorted(rr.record_list[7]) == [1, 2, 4, 5]
+        assert [os.path.basename(p) for p in cat.changed_files()] == ['c.hdf5']
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from tpgsandbox.emulation.algos import TP_DTYPES
+from tpgsandbox.emulation.clustering import IncrementalTPClusterer, cluster_tps
+
+
+def reference_dbscan(df: pd.DataFrame, eps: float, min_samples: int, time_scale: float = 32) -> np.ndarray:
+    '''Brute-force DBSCAN, with sklearn's labelling, separately on each plane'''
+    x = np.c_[df['channel'].to_numpy(np.float64), df['time_peak'].to_numpy(np.float64)/time_scale]
+    plane = df['plane'].to_numpy()
+    dist = np.sqrt(((x[:, None, :]-x[None, :, :])**2).sum(-1))
+    neighbours = [np.flatnonzero((dist[i] <= eps) & (plane == plane[i])) for i in range(len(df))]
+    core = np.array([len(nb) >= min_samples for nb in neighbours])
+
+    labels = np.full(len(df), -1)
+    n_clusters = 0
+    for i in np.flatnonzero(core):
+        if labels[i] >= 0:
+            continue
+        labels[i] = n_clusters
+        stack = [i]
+        while stack:
+            for j in neighbours[stack.pop()]:
+                if labels[j] < 0:
+                    labels[j] = n_clusters
+                    if core[j]:
+                        stack.append(j)
+        n_clusters += 1
+    return labels
+
+
+def random_tps(rng, n_noise: int, n_blobs: int, n_chans: int, t_max: int, spread: int) -> pd.DataFrame:
+    '''Uniform noise TPs and compact blobs, on 3 planes'''
+    chans = [rng.integers(0, n_chans, n_noise)]
+    times = [rng.integers(0, t_max, n_noise)]
+    for _ in range(n_blobs):
+        m = rng.integers(5, 40)
+        chans.append(rng.integers(10, n_chans-10)+rng.integers(-10, 10, m))
+        times.append(rng.integers(spread, t_max)+rng.integers(-spread, spread, m))
+    chans, times = np.concatenate(chans), np.concatenate(times)
+    return pd.DataFrame({
+        'channel': chans.astype(np.uint32),
+        'time_peak': times.astype(np.uint64),
+        'plane': rng.integers(0, 3, len(chans)).astype(np.uint8),
+    })
+
+
+def same_partition(a: np.ndarray, b: np.ndarray) -> bool:
+    '''Same noise points and same clusters, up to the cluster numbering'''
+    if not np.array_equal(a < 0, b < 0):
+        return False
+    pairs = set(zip(a[a >= 0], b[b >= 0]))
+    return len(pairs) == len(set(a[a >= 0])) == len(set(b[b >= 0]))
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_cluster_tps_matches_dbscan(seed):
+    rng = np.random.default_rng(seed)
+    df = random_tps(rng, 500, 20, 300, 300000, 600)
+    eps, min_samples = [(10, 2), (20, 3), (40, 5), (40, 2)][seed]
+
+    ref = reference_dbscan(df, eps, min_samples)
+    for n_slabs in (1, 3, 8):
+        res = cluster_tps(df, eps, min_samples, n_slabs=n_slabs)
+        np.testing.assert_array_equal(res['cluster_label'].to_numpy(), ref)
+    pd.testing.assert_frame_equal(res.drop(columns='cluster_label'), df)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_incremental_matches_full(seed):
+    rng = np.random.default_rng(seed)
+    df = random_tps(rng, 2000, 40, 200, 300000, 3000).sort_values('time_peak', kind='stable').reset_index(drop=True)
+    eps, min_samples = [(10, 2), (20, 3), (40, 5)][seed]
+    full = cluster_tps(df, eps, min_samples)
+
+    inc = IncrementalTPClusterer(eps, min_samples)
+    cuts = np.sort(rng.choice(len(df), 30, replace=False))
+    outs = []
+    for a, b in zip(np.r_[0, cuts], np.r_[cuts, len(df)]):
+        outs.append(inc.push(df.iloc[a:b], df['time_peak'].iloc[b] if b < len(df) else None))
+    outs.append(inc.flush())
+    res = pd.concat(outs)
+
+    assert len(res) == len(df) and res.index.is_unique
+    assert same_partition(res['cluster_label'].reindex(df.index).to_numpy(), full['cluster_label'].to_numpy())
+    assert inc.n_clusters == full['cluster_label'].max()+1
+
+
+def test_incremental_flush_without_tps():
+    res = IncrementalTPClusterer().flush()
+    assert len(res) == 0
+    assert list(res.columns) == [n for n, _ in TP_DTYPES] + ['cluster_label']
+    assert res['cluster_label'].dtype == np.int64
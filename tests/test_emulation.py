@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from tpgsandbox.emulation import algos, tpg
+
+TP_KEY = ['channel', 'time_start']
+THRESHOLDS = [100, 50, 200, 150]
+
+
+def sorted_tps(df: pd.DataFrame, key=TP_KEY) -> pd.DataFrame:
+    return df.sort_values(key).reset_index(drop=True)
+
+
+def staged_tps(df_rawadc, threshold, chmap, init_ped_algo='mode') -> tuple:
+    '''Reference chain: pedestal, pedestal subtraction and hit finding as separate steps'''
+    df_ped, _ = algos.emulate_ped(df_rawadc, init_ped_algo=init_ped_algo, init_ped_range=100)
+    df_adc = df_rawadc-df_ped
+    return algos.generate_tps(df_adc, threshold, chmap), df_ped, df_adc
+
+
+@pytest.mark.parametrize('dtype, offset', [(np.uint16, 0), (np.int16, 0), (np.int16, -950)])
+def test_frugal_pedestal_2d_matches_per_channel(raw_adcs, dtype, offset):
+    adcs = (raw_adcs.to_numpy().astype(np.int32)+offset).astype(dtype)
+    rng = np.random.default_rng(1)
+    median_0 = adcs[0].astype(np.int32)+rng.integers(-30, 30, adcs.shape[1]).astype(np.int32)
+    acc_0 = rng.integers(-9, 10, adcs.shape[1]).astype(np.int32)
+
+    # Several channel blocks, the last one partial
+    peds, medians, accs = algos.frugal_pedestal_2d(adcs, median_0, acc_0, 10, 20)
+    for c in range(adcs.shape[1]):
+        ref = algos.frugal_pedestal(adcs[:, c], median_0[c], acc_0[c], 10)
+        np.testing.assert_array_equal(peds[:, c], ref)
+    np.testing.assert_array_equal(medians, peds[-1])
+    assert (np.abs(accs) < 10).all()
+
+
+@pytest.mark.parametrize('init_ped_algo', ['mode', 'hist_mode'])
+def test_fused_tpg_matches_staged_chain(raw_adcs, chmap, init_ped_algo):
+    ref, df_ped, df_adc = staged_tps(raw_adcs, 100, chmap, init_ped_algo)
+    ch = raw_adcs.columns[5]
+    tps, wfs = tpg.emulate_tpg(raw_adcs, chmap, 100, init_ped_algo=init_ped_algo, init_ped_range=100, waveform_channels=[ch])
+
+    assert len(tps) > 0
+    pd.testing.assert_frame_equal(tps, ref)
+    np.testing.assert_array_equal(wfs[ch]['ped'], df_ped[ch])
+    np.testing.assert_array_equal(wfs[ch]['adc'], df_adc[ch])
+    np.testing.assert_allclose(wfs[ch]['rs_adc'], algos.emulate_running_sum(df_adc)[ch], atol=1)
+
+
+def test_tpg_kernel_output_overflow(raw_adcs):
+    '''Hits overflowing the per-block output buffers give the same result as a large enough buffer'''
+    adcs = raw_adcs.to_numpy()
+    ts = raw_adcs.index.to_numpy()
+    median_0 = algos.estimate_initial_pedestal(raw_adcs, 'hist_mode', 100).to_numpy()
+
+    res = []
+    for hits_per_channel in (None, 0):
+        state = tpg.init_tpg_state(median_0, len(THRESHOLDS))
+        hits, _ = tpg.run_tpg_kernel(ts, adcs, state, THRESHOLDS, 10, hits_per_channel=hits_per_channel)
+        res.append((hits, state))
+
+    (hits, state), (ref_hits, ref_state) = res
+    np.testing.assert_array_equal(hits, ref_hits)
+    for k in ref_state:
+        np.testing.assert_array_equal(state[k], ref_state[k])
+
+
+def test_batched_hits_match_per_channel(raw_adcs, chmap):
+    _, _, df_adc = staged_tps(raw_adcs, 100, chmap)
+    tps = algos.generate_tps(df_adc, 100, chmap)
+    ts = df_adc.index.to_numpy()
+
+    n_hits = 0
+    for c in df_adc.columns:
+        n, time_start, time_peak, tot, adc_peak, adc_integral = algos.find_hits(ts, df_adc[c].to_numpy(), 100)
+        sel = tps[tps['channel'] == c]
+        np.testing.assert_array_equal(sel['time_start'], time_start)
+        np.testing.assert_array_equal(sel['time_peak'], time_peak)
+        np.testing.assert_array_equal(sel['time_over_threshold'], tot)
+        np.testing.assert_array_equal(sel['adc_peak'], adc_peak)
+        np.testing.assert_array_equal(sel['adc_integral'], adc_integral)
+        n_hits += n
+    assert len(tps) == n_hits > 0
+    assert (tps['plane'] == tps['channel'] % 3).all()
+
+
+@pytest.mark.parametrize('threshold', [100, THRESHOLDS])
+def test_batched_hits_output_overflow(raw_adcs, chmap, threshold):
+    '''Blocks overflowing their output region are scanned again, with the same result'''
+    _, _, df_adc = staged_tps(raw_adcs, 100, chmap)
+    ts, adcs = df_adc.index.to_numpy(), df_adc.to_numpy()
+    np.testing.assert_array_equal(algos.find_hits_all(ts, adcs, threshold, hits_per_channel=0), algos.find_hits_all(ts, adcs, threshold))
+
+
+@pytest.mark.parametrize('threshold', [100, THRESHOLDS])
+def test_streaming_matches_batch(raw_adcs, chmap, threshold):
+    batch, _ = tpg.emulate_tpg(raw_adcs, chmap, threshold, init_ped_range=100)
+
+    em = tpg.StreamingTPGEmulator(chmap, threshold, init_ped_range=100)
+    stream = pd.concat(em.process_all(raw_adcs.iloc[i:i+137] for i in range(0, len(raw_adcs), 137)))
+
+    key = TP_KEY if np.ndim(threshold) == 0 else ['threshold_idx']+TP_KEY
+    pd.testing.assert_frame_equal(sorted_tps(stream, key), sorted_tps(batch, key))
+    assert em.n_samples == len(raw_adcs) and em.n_tps == len(batch)
+
+    with pytest.raises(ValueError):
+        em.process(raw_adcs.iloc[:10])
+
+
+@pytest.mark.parametrize('algo, reference', [
+    ('hist_mode', lambda df: df.mode().iloc[0]),
+    ('hist_median', lambda df: df.median()),
+])
+def test_hist_pedestal_estimators(raw_adcs, algo, reference):
+    peds = algos.estimate_initial_pedestal(raw_adcs, algo, 101)
+    pd.testing.assert_series_equal(peds, reference(raw_adcs[:101]).astype('int16'), check_names=False)
+    pd.testing.assert_series_equal(algos.estimate_initial_pedestal(raw_adcs, algo, 101, parallel=False), peds)
+
+
+def test_multi_threshold_matches_single_thresholds(raw_adcs, chmap):
+    _, _, df_adc = staged_tps(raw_adcs, 100, chmap)
+    multi = algos.generate_tps_multi(df_adc, THRESHOLDS, chmap)
+    for i, t in enumerate(THRESHOLDS):
+        single = algos.generate_tps(df_adc, t, chmap)
+        pd.testing.assert_frame_equal(sorted_tps(multi[multi['threshold_idx'] == i].drop(columns='threshold_idx')), sorted_tps(single))
+
+    fused, _ = tpg.emulate_tpg(raw_adcs, chmap, THRESHOLDS, init_ped_range=100)
+    key = ['threshold_idx']+TP_KEY
+    pd.testing.assert_frame_equal(sorted_tps(fused, key), sorted_tps(multi, key))
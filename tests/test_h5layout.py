@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from tpgsandbox.utils import h5layout
+
+
+def test_parse_record_group_name():
+    assert h5layout.parse_record_group_name('TriggerRecord00042.0001') == h5layout.RecordGroupName('TriggerRecord', 42, 1)
+    assert h5layout.parse_record_group_name('TimeSlice000042') == h5layout.RecordGroupName('TimeSlice', 42, 0)
+    assert h5layout.parse_record_group_name('TriggerRecord00042x') is None
+
+
+def test_parse_fragment_dataset_name():
+    assert h5layout.parse_fragment_dataset_name('Detector_Readout_0x00000064_WIBEth') == ('Detector_Readout', 0x64, 'WIBEth')
+    assert h5layout.parse_fragment_dataset_name('Trigger_0x00000001_Trigger_Primitive') == ('Trigger', 1, 'Trigger_Primitive')
+
+
+@pytest.mark.parametrize('name', ['TR_Builder_0x00000000_TriggerRecordHeader', 'TimeSlice_Builder_0x00000000_TimeSliceHeader', 'TriggerRecordHeader'])
+def test_headers_are_not_fragments(name):
+    assert h5layout.parse_fragment_dataset_name(name) is None
+
+
+def test_canonical_name():
+    assert h5layout.canonical_name('kTriggerPrimitive') == h5layout.canonical_name('Trigger_Primitive')
+    assert h5layout.canonical_name('kDetectorReadout') == h5layout.canonical_name('Detector_Readout')
+
+
+def make_file(path, trs=(1, 2, 10, 11)):
+    h5py = pytest.importorskip('h5py')
+    with h5py.File(path, 'w') as f:
+        f.attrs['run_number'] = 7
+        for tr in trs:
+            rd = f.create_group(f'TriggerRecord{tr:05d}.0000').create_group('RawData')
+            rd.create_dataset('TR_Builder_0x00000000_TriggerRecordHeader', data=np.arange(8, dtype=np.uint8))
+            rd.create_dataset('Detector_Readout_0x00000064_WIBEth', data=np.zeros(1000, dtype=np.uint8), compression='gzip')
+            rd.create_dataset('Trigger_0x00000001_Trigger_Primitive', data=np.ones(50, dtype=np.uint8))
+
+
+def test_index_and_fragments(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    make_file(tmp_path / 'raw.hdf5')
+    with h5py.File(tmp_path / 'raw.hdf5') as f:
+        index = h5layout.index_records(f)
+        assert sorted(index) == [(1, 0), (2, 0), (10, 0), (11, 0)]
+        frags = h5layout.iter_fragments(f[index[(1, 0)]])
+    assert sorted(fr.fragment_type for fr in frags) == ['Trigger_Primitive', 'WIBEth']
+
+
+def test_filtered_copy_keeps_header(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    copier = pytest.importorskip('tpgsb_copy_filter_file')
+    make_file(tmp_path / 'raw.hdf5')
+
+    keep = lambda fr: h5layout.select_fragment(fr, fragment_types=['kTriggerPrimitive'])
+    with h5py.File(tmp_path / 'raw.hdf5') as src, h5py.File(tmp_path / 'out.hdf5', 'w') as dest:
+        assert copier.copy_record(src, dest, 'TriggerRecord00001.0000', keep) == 1
+
+    with h5py.File(tmp_path / 'out.hdf5') as f:
+        assert sorted(f['TriggerRecord00001.0000/RawData'].keys()) == [
+            'TR_Builder_0x00000000_TriggerRecordHeader', 'Trigger_0x00000001_Trigger_Primitive'
+        ]
+
+
+def test_tr_selection_is_exact():
+    copier = pytest.importorskip('tpgsb_copy_filter_file')
+    assert copier.parse_tr_selection(['1', '3-5,10']) == {1, 3, 4, 5, 10}
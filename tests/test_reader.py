@@ -0,0 +1,101 @@
+import threading
+
+import numpy as np
+
+from tpgsandbox.utils.cache import RecordCache
+from tpgsandbox.utils.reader import LazyProducts, ProductLoadLock, RecordReader, RawdataFileInfo
+
+
+class FakeUnpacker:
+    '''Unpacks a single 'adc' product of 1000 float64'''
+
+    fragment_unpackers = {'adc': None}
+
+    def __init__(self):
+        self.calls = 0
+
+    def get(self, name):
+        return None
+
+    def unpack(self, rdf, tr, tpc_chan_map_id=None, products=None):
+        self.calls += 1
+        return {'adc': np.zeros(1000)}
+
+
+def make_reader(max_bytes=1 << 30):
+    rr = RecordReader(record_cache=RecordCache(max_bytes))
+    rr._unpacker = FakeUnpacker()
+    rr._open = lambda r: None
+    rr._add_file_info(RawdataFileInfo('raw.hdf5', 7, [1, 2], None))
+    return rr
+
+
+def test_record_cache_charges_lazy_products():
+    rr = make_reader()
+    data = rr.load_record(7, 1)
+    assert rr.get_record_cache_stats()['bytes'] == 0
+    data.frags['adc']
+    assert rr.get_record_cache_stats()['bytes'] == 8000
+
+
+def test_record_cache_budget_applies_on_decode():
+    rr = make_reader(max_bytes=12000)
+    rr.load_record(7, 1).frags['adc']
+    rr.load_record(7, 2).frags['adc']
+    stats = rr.get_record_cache_stats()
+    assert stats['entries'] == 1 and stats['bytes'] == 8000
+
+
+def test_eager_load_of_lazily_cached_record():
+    rr = make_reader()
+    rr.load_record(7, 1)
+    data = rr.load_record(7, 1, lazy=False)
+    assert isinstance(data.frags, dict)
+    assert rr.unpacker.calls == 1
+    assert rr.get_record_cache_stats()['bytes'] == 8000
+
+
+def test_on_load_runs_after_the_outermost_load():
+    seen = []
+
+    def on_load(nbytes):
+        # Another thread must be able to inspect the products: the lock is released
+        t = threading.Thread(target=lambda: seen.append((nbytes, len(frags.loaded()), len(record.loaded()))))
+        t.start()
+        t.join(5)
+        assert not t.is_alive()
+
+    lock = ProductLoadLock()
+    frags = LazyProducts(['adc'], lambda name: np.zeros(1000), on_load, lock)
+    record = LazyProducts(['sum'], lambda name: frags['adc'][:2]+1, on_load, lock)
+    record['sum']
+    assert seen == [(8000, 1, 1), (16, 1, 1)]
+
+
+class Entry:
+    def __init__(self, size):
+        self.size = size
+        self.calls = 0
+
+    def nbytes(self):
+        self.calls += 1
+        return self.size
+
+
+def test_record_cache_measures_entries_once():
+    cache = RecordCache(max_bytes=250)
+    entries = [Entry(100) for _ in range(3)]
+    for i, e in enumerate(entries):
+        cache.put(i, e)
+        cache.get(0)
+    assert [e.calls for e in entries] == [1, 1, 1]
+    # The least recently used entry was evicted
+    assert 1 not in cache and cache.stats()['bytes'] == 200
+
+    # Entry 0 grows past the budget, entry 2 is now the least recently used
+    cache.charge(0, entries[0], 100)
+    assert 2 not in cache and cache.stats()['bytes'] == 200
+    # Charges of evicted or replaced values are ignored
+    cache.charge(2, entries[2], 100)
+    cache.charge(0, Entry(0), 100)
+    assert cache.stats()['bytes'] == 200 and cache.stats()['evictions'] == 2
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from tpgsandbox.utils import trgdtypes
+
+HEADER = trgdtypes.trigger_activity_dtype
+INPUT_SIZE = 32
+
+
+def make_payload(n_inputs) -> np.ndarray:
+    '''Pack one TA header per entry of n_inputs, followed by its (zeroed) inputs'''
+    chunks = []
+    for i, n in enumerate(n_inputs):
+        hdr = np.zeros(1, dtype=HEADER)
+        hdr['data']['time_start'] = 1000+i
+        hdr['n_inputs'] = n
+        chunks += [hdr.view(np.uint8), np.zeros(n*INPUT_SIZE, dtype=np.uint8)]
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.uint8)
+
+
+def scan(buf):
+    return trgdtypes.scan_offsets(buf, HEADER.itemsize, HEADER.fields['n_inputs'][1], INPUT_SIZE)
+
+
+def test_scan_offsets():
+    buf = make_payload([3, 0, 5])
+    offsets = scan(buf)
+    size = HEADER.itemsize
+    assert offsets.tolist() == [0, size+3*INPUT_SIZE, 2*size+3*INPUT_SIZE]
+    hdrs = trgdtypes.gather_headers(buf, offsets, HEADER)
+    assert hdrs['data']['time_start'].tolist() == [1000, 1001, 1002]
+    assert hdrs['n_inputs'].tolist() == [3, 0, 5]
+    assert len(scan(make_payload([]))) == 0
+
+
+@pytest.mark.parametrize('n_inputs', [6, 1 << 40, (1 << 63)+1, (1 << 64)-1])
+def test_scan_offsets_rejects_inputs_past_the_end(n_inputs):
+    buf = make_payload([3, 5])
+    hdr = buf[HEADER.itemsize+3*INPUT_SIZE:]
+    hdr[HEADER.fields['n_inputs'][1]:HEADER.fields['n_inputs'][1]+8] = np.frombuffer(np.uint64(n_inputs).tobytes(), np.uint8)
+    with pytest.raises(ValueError):
+        scan(buf)
+
+
+def test_scan_offsets_rejects_truncated_header():
+    buf = make_payload([3, 5])
+    with pytest.raises(ValueError):
+        scan(buf[:-5*INPUT_SIZE-1])